@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+MICRO-BENCHMARK — rút field từ JSON chi tiết đơn Shopee
+
+So sánh:
+    - multi-pass : find_first_key từng key (cách cũ của format_order_simple, ~15 lần BFS)
+    - single-pass: find_first_keys 1 lần BFS cho mọi key
+
+Chạy với payload ghi lại từ Shopee (file JSON: 1 detail hoặc list detail):
+    python bench_order_format.py payloads/*.json
+Không truyền file → dùng payload giả lập cùng độ sâu / kích thước với get_order_detail
+    python bench_order_format.py --orders 5 --rounds 2000
+"""
+
+import sys
+import json
+import time
+import argparse
+from collections import deque
+from typing import Any, Dict
+
+from bot_loader import load_bot
+
+WANTED = {"find_first_key", "find_first_keys", "ORDER_SUMMARY_KEYS"}
+
+
+def load_bot_helpers() -> Dict[str, Any]:
+    return load_bot(WANTED, {"deque": deque, "Any": Any, "Dict": Dict})
+
+
+def synthetic_detail(i: int) -> dict:
+    """Payload giống cấu trúc get_order_detail (các field cần nằm sâu 3-5 tầng)"""
+    items = [{"item_id": 1000 + k, "name": f"Sản phẩm {i}-{k}", "model_name": "Mặc định",
+              "amount": 1, "price": 12_900_000_00, "image": "x" * 32} for k in range(3)]
+    return {
+        "error": 0,
+        "data": {
+            "order_id": 100000 + i,
+            "status": {"header_text": "Đang giao", "list_view_text": "Đang giao", "status_label": {"text": "label"}},
+            "info_card": {
+                "order_id": 100000 + i,
+                "parcel_cards": [{
+                    "shop_info": {"shop_id": 1, "shop_name": "Shop", "badges": [{"id": k} for k in range(5)]},
+                    "product_info": {"item_groups": [{"items": items}]},
+                    "shipping_info": {
+                        "tracking_number": f"SPXVN{i:010d}",
+                        "tracking_info": {"description": "Đơn hàng đang được giao", "ctime": 1700000000},
+                        "driver_name": "Tài xế",
+                        "driver_phone": "0900000000",
+                    },
+                }],
+            },
+            "processing_info": {"logs": [{"ctime": 1700000000 + k, "text": "log", "meta": {"k": k}} for k in range(15)]},
+            "payment_info": {"cod_amount": 0, "total_cod": 129000, "buyer_total_amount": 12900000000},
+            "address": {
+                "recipient_address": {"name": "Người nhận", "phone": "84*****00", "full_address": "Hà Nội"},
+                "shipping_name": "Người nhận",
+                "shipping_phone": "84*****00",
+                "shipping_address": "Hà Nội",
+            },
+        },
+    }
+
+
+def load_payloads(paths) -> list:
+    out = []
+    for p in paths:
+        with open(p, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        out.extend(d for d in (data if isinstance(data, list) else [data]) if isinstance(d, dict))
+    return out
+
+
+def bench(fn, payloads, rounds: int) -> float:
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        for d in payloads:
+            fn(d)
+    return (time.perf_counter() - t0) / (rounds * len(payloads)) * 1e6  # µs / đơn
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark rút field JSON đơn Shopee")
+    ap.add_argument("payloads", nargs="*", help="file JSON detail đơn ghi lại từ Shopee")
+    ap.add_argument("--orders", type=int, default=5)
+    ap.add_argument("--rounds", type=int, default=2000)
+    args = ap.parse_args()
+
+    h = load_bot_helpers()
+    keys = h["ORDER_SUMMARY_KEYS"]
+    find_first_key, find_first_keys = h["find_first_key"], h["find_first_keys"]
+
+    payloads = load_payloads(args.payloads) if args.payloads else [synthetic_detail(i) for i in range(args.orders)]
+    if not payloads:
+        raise SystemExit("[BENCH] Không có payload")
+
+    def multi_pass(d):
+        return {k: find_first_key(d, k) for k in keys}
+
+    def single_pass(d):
+        return find_first_keys(d, keys)
+
+    # Cùng kết quả trước khi so tốc độ
+    for d in payloads:
+        expect = {k: v for k, v in multi_pass(d).items() if v is not None}
+        got = {k: v for k, v in single_pass(d).items() if v is not None}
+        assert expect == got, "find_first_keys khác find_first_key"
+
+    src = "recorded" if args.payloads else "synthetic"
+    print(f"[BENCH] {len(payloads)} {src} payloads, {len(keys)} keys, {args.rounds} rounds")
+    t_multi = bench(multi_pass, payloads, args.rounds)
+    t_single = bench(single_pass, payloads, args.rounds)
+    print(f"  multi-pass  (find_first_key x{len(keys)}): {t_multi:8.1f} µs/order")
+    print(f"  single-pass (find_first_keys)    : {t_single:8.1f} µs/order  ({t_multi / t_single:.1f}x)")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+MICRO-BENCHMARK — chi phí chống spam cho mỗi lượt check
+
+So sánh:
+    - minute-bucket: cách cũ (key "%Y-%m-%d %H:%M" + prune 3 phút gần nhất mỗi lượt)
+    - GCRA         : RateLimiter của bot.py (1 float / key / action)
+
+    python bench_rate_limit.py --users 5000 --checks 200000
+"""
+
+import sys
+import time
+import random
+import argparse
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Tuple
+
+from bot_loader import load_bot
+
+WANTED = {"RateLimiter", "parse_rate_limits"}
+
+
+def load_bot_helpers() -> Dict[str, Any]:
+    return load_bot(WANTED, {
+        "time": time, "threading": threading, "OrderedDict": OrderedDict,
+        "Any": Any, "Dict": Dict, "List": List, "Tuple": Tuple,
+    })
+
+
+# ==================================================
+# CÁCH CŨ (copy từ _handle_message trước khi đổi)
+# ==================================================
+spam_cache: Dict[str, Dict[str, int]] = {}
+spam_lock = threading.Lock()
+
+
+def _prune_spam_cache_for_user(tid: str, keep_minutes: int = 3) -> None:
+    try:
+        now_dt = datetime.now().replace(second=0, microsecond=0)
+        allowed = set()
+        for i in range(keep_minutes):
+            allowed.add((now_dt - timedelta(minutes=i)).strftime("%Y-%m-%d %H:%M"))
+
+        with spam_lock:
+            mp = spam_cache.get(tid, {})
+            for k in list(mp.keys()):
+                if k not in allowed:
+                    mp.pop(k, None)
+            spam_cache[tid] = mp
+    except Exception:
+        pass
+
+
+def legacy_hit(tid: str, limit: int) -> bool:
+    minute_key = datetime.now().strftime("%Y-%m-%d %H:%M")
+    _prune_spam_cache_for_user(tid, keep_minutes=3)
+    with spam_lock:
+        spam_cache.setdefault(tid, {})
+        spam_cache[tid][minute_key] = spam_cache[tid].get(minute_key, 0) + 1
+        count_min = spam_cache[tid][minute_key]
+    return count_min <= limit
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark chống spam / lượt check")
+    ap.add_argument("--users", type=int, default=5000)
+    ap.add_argument("--checks", type=int, default=200000)
+    ap.add_argument("--limit", type=int, default=20)
+    args = ap.parse_args()
+
+    h = load_bot_helpers()
+    limits = h["parse_rate_limits"](f"any={args.limit}/60,cookie={args.limit}/60")
+    limiter = h["RateLimiter"](limits, 100000)
+
+    random.seed(1)
+    keys = [str(random.randint(10**8, 10**10)) for _ in range(args.users)]
+    seq = [random.choice(keys) for _ in range(args.checks)]
+
+    t0 = time.perf_counter()
+    for k in seq:
+        legacy_hit(k, args.limit)
+    t_legacy = (time.perf_counter() - t0) / len(seq) * 1e6
+
+    t0 = time.perf_counter()
+    for k in seq:
+        limiter.hit(k, [("cookie", 1), ("any", 1)])
+    t_gcra = (time.perf_counter() - t0) / len(seq) * 1e6
+
+    print(f"[BENCH] {args.checks} checks, {args.users} users, limit {args.limit}/60s")
+    print(f"  minute-bucket + prune : {t_legacy:6.2f} µs/check  ({len(spam_cache)} keys giữ lại)")
+    print(f"  GCRA (cookie + any)   : {t_gcra:6.2f} µs/check  ({len(limiter)} keys, tự dọn key rảnh)")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,7 +7,7 @@ NgânMiu.Store — BOT CHECK ĐƠN HÀNG SHOPEE + TRA MÃ VẬN ĐƠN SPX + GET
 🔧 FIXED (Jan 2026):
 - Fix logic get_qr_cookie(): nếu session đã có cookie thì trả ngay (không gọi API lại)
 - Fix logic check_shopee_orders_with_payment(): tách rõ error và result để không hiểu nhầm
-- Add basic locks cho qr_sessions / order_cache / spam_cache (giảm race condition trong 1 instance)
+- Add basic locks cho qr_store / order_cache / spam_cache (giảm race condition trong 1 instance)
 - Prune spam_cache theo phút (giảm phình RAM)
 """
 
@@ -16,19 +16,45 @@ import re
 import json
 import time
 import html
+import http.cookiejar
 import traceback
 import threading
 import base64
 import random
+import heapq
+import hashlib
+import hmac
+import sqlite3
+import asyncio
+import atexit
 from datetime import datetime, timedelta
 from typing import Any, Dict, List, Optional, Tuple
-from collections import deque
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from queue import Queue
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future, FIRST_COMPLETED, wait as futures_wait
+from queue import Queue, Empty
+from urllib.parse import urlsplit
+
+# ⏱️ Đo thời gian import theo từng phần (in 1 dòng [BOOT] cuối file, GET /stats → "startup")
+_BOOT_T0 = time.perf_counter()
+startup_report: Dict[str, Any] = {"import_ms": None, "phases": {}, "background": {}}
+_boot_last = [_BOOT_T0]
+
+def _boot_mark(phase: str) -> None:
+    t = time.perf_counter()
+    startup_report["phases"][phase] = round((t - _boot_last[0]) * 1000, 1)
+    _boot_last[0] = t
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from flask import Flask, request, jsonify
 
+try:
+    import aiohttp  # Tùy chọn: chỉ cần khi USE_ASYNC_FETCH=true
+except ImportError:
+    aiohttp = None
+_boot_mark("import libs")
+
 # =========================================================
 # LOAD ENV
 # =========================================================
@@ -44,13 +70,16 @@ CREDS_JSON = (os.getenv("GOOGLE_SHEETS_CREDS_JSON") or "").strip()
 
 if not BOT_TOKEN:
     raise Exception("TELEGRAM_TOKEN missing")
-if not SHEET_ID:
-    raise Exception("GOOGLE_SHEET_ID missing")
-if not CREDS_JSON:
-    raise Exception("GOOGLE_SHEETS_CREDS_JSON missing")
 
 BASE_URL = f"https://api.telegram.org/bot{BOT_TOKEN}"
 
+# Serverless (Vercel / Lambda): function bị đóng băng ngay sau khi webhook trả lời
+# → thread nền không chạy tiếp được, việc còn trong queue bị trễ / mất
+SERVERLESS = bool(os.getenv("VERCEL") or os.getenv("AWS_LAMBDA_FUNCTION_NAME"))
+
+# GET /stats chỉ trả khi có header X-Stats-Token (hoặc ?token=) đúng giá trị này — không set = tắt /stats
+STATS_TOKEN = (os.getenv("STATS_TOKEN") or "").strip()
+
 # =========================================================
 # 🔥 STEP 1 OPTIMIZATION CONFIG
 # =========================================================
@@ -59,8 +88,22 @@ print(" BOT OPTIMIZED - STEP 1: CACHE + BATCH + TIMEOUT + QR LOGIN")
 print("="*60)
 
 USE_PARALLEL = os.getenv("USE_PARALLEL", "true").lower() == "true"
+USE_ASYNC_FETCH = os.getenv("USE_ASYNC_FETCH", "false").lower() == "true"  # 1 event loop aiohttp thay cho thread
 CHECK_LIMIT = 3
 MAX_WORKERS = int(os.getenv("MAX_WORKERS", "5"))
+BATCH_CHECK_WORKERS = int(os.getenv("BATCH_CHECK_WORKERS", "16"))            # Pool chung check lô nhiều dòng
+BATCH_CHECK_PER_USER = int(os.getenv("BATCH_CHECK_PER_USER", "8"))           # Số dòng / user check song song
+# Lô chạy BATCH_CHECK_PER_USER cookie cùng lúc, mỗi cookie CHECK_LIMIT detail → per-user không được nhỏ hơn
+SHOPEE_FETCH_PER_USER = max(
+    int(os.getenv("SHOPEE_FETCH_PER_USER", str(MAX_WORKERS))), BATCH_CHECK_PER_USER * CHECK_LIMIT
+)                                                                                     # Tối đa request song song / 1 user (Tele ID)
+SHOPEE_FETCH_WORKERS = int(os.getenv("SHOPEE_FETCH_WORKERS", str(max(MAX_WORKERS * 4, SHOPEE_FETCH_PER_USER))))  # Pool chung fetch chi tiết đơn
+SHOPEE_MAX_INFLIGHT = int(os.getenv("SHOPEE_MAX_INFLIGHT", "24"))                    # Trần request đồng thời tới shopee.vn (mọi luồng)
+SHOPEE_QUEUE_TIMEOUT = float(os.getenv("SHOPEE_QUEUE_TIMEOUT", "30"))                # Detail chờ pool quá N giây → bỏ (timeout)
+BATCH_MESSAGE_CHARS = int(os.getenv("BATCH_MESSAGE_CHARS", "3800"))          # Gộp kết quả tới ~giới hạn 4096 ký tự / tin
+BATCH_MAX_LINES = int(os.getenv("BATCH_MAX_LINES", "50"))                     # Số dòng tối đa / 1 lần dán (tính spam 1 lượt / lô)
+STREAM_ORDERS = os.getenv("STREAM_ORDERS", "true").lower() == "true"  # Gửi từng đơn ngay khi có (editMessageText)
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "0.8"))  # Giãn cách tối thiểu giữa 2 lần sửa tin
 
 # ✅ FIX 1: GIẢM TIMEOUT (từ 8s/6s → 5s/4s)
 TIMEOUT_LIST = 5    # Giảm từ 8s
@@ -69,18 +112,72 @@ TIMEOUT_RETRY = 1   # Số lần retry khi timeout
 
 # ✅ FIX 2: CACHE COOKIE (mới)
 CACHE_COOKIE_TTL = int(os.getenv("CACHE_COOKIE_TTL", "45"))  # 45 giây
-order_cache = {}  # {cookie: {"data": [...], "time": timestamp}}
-cache_lock = threading.Lock()
+ORDER_CACHE_MAX_ENTRIES = int(os.getenv("ORDER_CACHE_MAX_ENTRIES", "500"))             # Tối đa số cookie giữ cache
+ORDER_CACHE_MAX_BYTES = int(os.getenv("ORDER_CACHE_MAX_BYTES", str(8 * 1024 * 1024)))  # ~8MB (HTML + summary)
 
 # ✅ FIX 3: BATCH LOG (mới)
 LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "10"))     # Gom 10 dòng
 LOG_BATCH_INTERVAL = int(os.getenv("LOG_BATCH_INTERVAL", "3"))  # Hoặc 3 giây
+LOG_BATCH_MAX = int(os.getenv("LOG_BATCH_MAX", "500"))                  # Trần dòng / 1 lần append_rows
+LOG_LATENCY_TARGET_MS = int(os.getenv("LOG_LATENCY_TARGET_MS", "800"))  # Sheets chậm hơn mức này → giãn batch
+LOG_RETRY_MAX = int(os.getenv("LOG_RETRY_MAX", "5"))                    # Lỗi liên tiếp → spill ra file
+LOG_RETRY_MAX_DELAY = float(os.getenv("LOG_RETRY_MAX_DELAY", "60"))
+LOG_BUFFER_MAX = int(os.getenv("LOG_BUFFER_MAX", "5000"))               # Dòng tối đa giữ RAM / tab
+# "" = tắt spill. Serverless: thư mục code chỉ đọc → mặc định /tmp (chỉ sống theo instance)
+LOG_SPILL_FILE = os.getenv("LOG_SPILL_FILE", "/tmp/log_spill.jsonl" if SERVERLESS else "log_spill.jsonl")
 log_queue = Queue()
 
-print(f"[PERF] Mode: {'✅ PARALLEL' if USE_PARALLEL else '⚠️ SEQUENTIAL'}")
+print(f"[PERF] Mode: {'✅ ASYNC' if USE_ASYNC_FETCH and aiohttp else '✅ PARALLEL' if USE_PARALLEL else '⚠️ SEQUENTIAL'}")
+if USE_ASYNC_FETCH and aiohttp is None:
+    print("[PERF] ⚠️ USE_ASYNC_FETCH=true nhưng chưa cài aiohttp → dùng engine thread")
+print(f"[PERF] ✅ Shopee fetch pool: {SHOPEE_FETCH_WORKERS} workers, {SHOPEE_FETCH_PER_USER}/user, cap {SHOPEE_MAX_INFLIGHT} in-flight")
+print(f"[PERF] ✅ Batch check: ≤{BATCH_MAX_LINES} dòng/lô, {BATCH_CHECK_PER_USER} dòng/user song song, pool {BATCH_CHECK_WORKERS}")
+print(f"[PERF] {'✅' if STREAM_ORDERS else '⚠️'} Stream orders: {STREAM_ORDERS} (edit ≥ {STREAM_EDIT_INTERVAL}s)")
 print(f"[PERF] Timeout: list={TIMEOUT_LIST}s, detail={TIMEOUT_DETAIL}s, retry={TIMEOUT_RETRY}")
-print(f"[PERF] ✅ Cache cookie: {CACHE_COOKIE_TTL}s")
-print(f"[PERF] ✅ Batch log: {LOG_BATCH_SIZE} rows or {LOG_BATCH_INTERVAL}s")
+print(f"[PERF] ✅ Cache cookie: {CACHE_COOKIE_TTL}s, max {ORDER_CACHE_MAX_ENTRIES} entries / {ORDER_CACHE_MAX_BYTES // 1024}KB (LRU)")
+print(f"[PERF] ✅ Batch log: {LOG_BATCH_SIZE}-{LOG_BATCH_MAX} rows or {LOG_BATCH_INTERVAL}s, retry {LOG_RETRY_MAX}x, "
+      f"spill {os.path.abspath(LOG_SPILL_FILE) if LOG_SPILL_FILE else 'off'}{' (serverless)' if SERVERLESS else ''}")
+
+# ✅ FIX 4: HTTP KEEP-ALIVE (pool session theo host)
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "20"))        # Số connection giữ sẵn / host
+HTTP_CONNECT_RETRY = int(os.getenv("HTTP_CONNECT_RETRY", "1"))  # Chỉ retry lỗi kết nối (request chưa gửi đi)
+HTTP_DEFAULT_TIMEOUT = 10
+HTTP_HOST_TIMEOUTS = {
+    "api.telegram.org": 15,
+    "shopee.vn": 5,
+    "tramavandon.com": (5, 10),
+    "fe-online-gateway.ghn.vn": 10,
+}
+# Trần số request đồng thời theo host (giữ tải lên Shopee có giới hạn dù nhiều user cùng check)
+HTTP_HOST_LIMITS = {
+    "shopee.vn": SHOPEE_MAX_INFLIGHT,
+}
+print(f"[PERF] ✅ HTTP pool: {HTTP_POOL_SIZE} conn/host, connect retry={HTTP_CONNECT_RETRY}")
+
+# ✅ FIX 5: WEBHOOK ACK NGAY + HÀNG ĐỢI UPDATE (worker xử lý nền, giữ thứ tự theo chat)
+# Serverless mặc định xử lý inline (xong mới trả webhook); chỉ bật khi chạy process thường trực
+ASYNC_UPDATES = os.getenv("ASYNC_UPDATES", "false" if SERVERLESS else "true").lower() == "true"
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "8"))
+UPDATE_QUEUE_MAX = int(os.getenv("UPDATE_QUEUE_MAX", "500"))  # đầy → trả 503 để Telegram gửi lại sau
+print(f"[PERF] {'✅ Async updates' if ASYNC_UPDATES else '⚠️ Inline updates'}: {UPDATE_WORKERS} workers, queue {UPDATE_QUEUE_MAX}"
+      f"{' (serverless)' if SERVERLESS else ''}")
+if SERVERLESS and ASYNC_UPDATES:
+    print("[PERF] ⚠️ ASYNC_UPDATES=true trên serverless: update còn trong queue có thể bị trễ / mất khi function bị đóng băng")
+
+# ✅ FIX 7: HÀNG ĐỢI GỬI TELEGRAM (token bucket toàn cục + theo chat, tự retry 429)
+# Mặc định theo ASYNC_UPDATES; serverless luôn mặc định gửi inline (tin chưa gửi mất khi bị đóng băng)
+TG_ASYNC_SEND = os.getenv("TG_ASYNC_SEND", "true" if ASYNC_UPDATES and not SERVERLESS else "false").lower() == "true"
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "30"))   # msg/s toàn bot
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", "1"))        # msg/s mỗi chat
+TG_CHAT_BURST = int(os.getenv("TG_CHAT_BURST", "3"))        # cho phép dồn vài tin liền nhau
+TG_SENDERS = int(os.getenv("TG_SENDERS", "8"))
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", "3"))
+TG_OUTBOX_MAX = int(os.getenv("TG_OUTBOX_MAX", "5000"))
+print(f"[PERF] {'✅ Async send' if TG_ASYNC_SEND else '⚠️ Inline send'}: {TG_GLOBAL_RATE:g}/s global, {TG_CHAT_RATE:g}/s chat, {TG_SENDERS} senders")
+
+# ✅ FIX 6: CHỐNG XỬ LÝ TRÙNG (update_id / callback_query id / key thanh toán)
+DEDUP_TTL_SECONDS = int(os.getenv("DEDUP_TTL_SECONDS", "3600"))  # Telegram retry tối đa vài chục phút
+DEDUP_MAX_KEYS = int(os.getenv("DEDUP_MAX_KEYS", "50000"))
 
 # Payment Integration
 BOT1_API_URL = os.getenv("BOT1_API_URL", "").strip()
@@ -94,6 +191,11 @@ else:
     PRICE_CHECK_COOKIE = PRICE_CHECK_SPX = PRICE_CHECK_GHN = PRICE_GET_COOKIE = 0
     print("[PAYMENT] Disabled")
 
+# update_id / callback id: RAM là đủ (Telegram gửi lại trong vài phút). DEDUP_FILE giữ qua restart cùng máy;
+# file trong /tmp (serverless) chỉ sống theo instance → KHÔNG chống trùng giữa các instance.
+# Key trừ tiền (op_key) không dựa vào đây: ghi vào store dùng chung (tab PayKeys / bảng pay_keys)
+DEDUP_FILE = os.getenv("DEDUP_FILE", "").strip()  # rỗng = chỉ giữ trong RAM
+
 # QR API Configuration
 QR_API_BASE = os.getenv("QR_API_BASE", "https://qr-shopee-rho.vercel.app").strip()
 QR_POLL_INTERVAL = float(os.getenv("QR_POLL_INTERVAL", "3.0"))  # giây check 1 lần  # giây check 1 lần (tăng tốc)
@@ -105,41 +207,108 @@ COOKIE_VALIDITY_DAYS = 7  # ✅ Cookie hiệu lực 7 ngày
 AUTO_QR = os.getenv("AUTO_QR", "true").lower() == "true"
 AUTO_QR_MAX_SECONDS = int(os.getenv("AUTO_QR_MAX_SECONDS", str(QR_TIMEOUT)))
 
+# ✅ 1 scheduler chung cho mọi QR session (thay 1 thread ngủ / session)
+QR_WATCH_WORKERS = int(os.getenv("QR_WATCH_WORKERS", "4"))
+QR_STATUS_CONCURRENCY = int(os.getenv("QR_STATUS_CONCURRENCY", "8"))  # tối đa request status đồng thời tới QR_API_BASE
+QR_POLL_FAST = float(os.getenv("QR_POLL_FAST", "1.5"))   # 30s đầu: user thường quét ngay
+QR_POLL_SLOW = float(os.getenv("QR_POLL_SLOW", "6.0"))   # sau 2 phút: thưa dần
+QR_STATUS_BATCH = os.getenv("QR_STATUS_BATCH", "auto").lower()  # auto | true | false — dùng /api/qr/status/batch
+
 # AUTO detect status mapping (Shopee có thể trả nhiều biến thể)
 SCANNED_STATUSES = {"SCANNED", "CONFIRMED", "AUTHORIZED", "AUTHED", "SUCCESS", "APPROVED", "OK", "DONE"}
 PENDING_STATUSES = {"PENDING", "WAITING", "UNKNOWN", "INIT", "CREATED"}
 
-# QR Session Management
-qr_sessions = {}  # {session_id: {"user_id": user_id, "created": timestamp, "status": "waiting", "qr_image": base64}}
-qr_lock = threading.Lock()
+# Lưu trữ chính: sheets (mặc định) | sqlite (WAL, mirror nền lên Sheet cho admin đọc)
+STORE_BACKEND = os.getenv("STORE_BACKEND", "sheets").lower()
+STORE_PATH = os.getenv("STORE_PATH", "bot_store.db")
+STORE_SHEET_MIRROR = os.getenv("STORE_SHEET_MIRROR", "true").lower() == "true"
+STORE_MIRROR_INTERVAL = float(os.getenv("STORE_MIRROR_INTERVAL", "5"))   # đẩy outbox lên Sheet mỗi N giây
+STORE_PULL_INTERVAL = float(os.getenv("STORE_PULL_INTERVAL", "60"))     # kéo user / cookie admin sửa trên Sheet
 
-# User cache (giữ nguyên từ version trước)
+# Mọi backend đều cần Sheet: user / cookie admin thêm trên tab Thanh Toan + Cookie
+# (sqlite + STORE_SHEET_MIRROR=false: vẫn kéo user / cookie về, chỉ không đẩy log / note lên)
+if not SHEET_ID:
+    raise Exception("GOOGLE_SHEET_ID missing")
+if not CREDS_JSON:
+    raise Exception("GOOGLE_SHEETS_CREDS_JSON missing")
+
+# QR Session Management — store cắm được: memory (mặc định) | sqlite (giữ session qua restart)
+QR_STORE = os.getenv("QR_STORE", "memory").lower()
+# Serverless: thư mục code chỉ đọc → mặc định /tmp (chỉ sống theo instance)
+QR_STORE_PATH = os.getenv("QR_STORE_PATH", "/tmp/qr_sessions.db" if SERVERLESS else "qr_sessions.db")
+
+# User cache: index Tele ID -> (row, user) giữ trong RAM, refresh nền
 CACHE_USERS_SECONDS = int(os.getenv("CACHE_USERS_SECONDS", "60"))
+USER_MISS_REFRESH_SECONDS = int(os.getenv("USER_MISS_REFRESH_SECONDS", "10"))  # miss → đọc lại sheet tối đa 1 lần/10s
+DAILY_SEED_WAIT = float(os.getenv("DAILY_SEED_WAIT", "5"))  # check đầu tiên sau cold start chờ seed bộ đếm ngày tối đa N giây
 user_cache = {
-    "data": None,
+    "data": None,       # {tele_id: (row_idx, user_data)}
     "timestamp": 0
 }
+user_cache_lock = threading.Lock()
+user_cache_event = threading.Event()  # set khi bot tự ghi sheet → worker refresh sớm
 print(f"[PERF] ✅ Cache users: {CACHE_USERS_SECONDS}s")
+
+# Note/strike/band (cột E): đọc từ RAM, ghi gom lại rồi batch_update
+NOTE_FLUSH_INTERVAL = float(os.getenv("NOTE_FLUSH_INTERVAL", "3"))
+note_cache: Dict[int, str] = {}      # {row_idx: note}
+note_dirty: Dict[int, str] = {}      # {row_idx: note chưa ghi sheet}
+note_inflight: Dict[int, str] = {}   # đang batch_update
+note_touched: Dict[int, float] = {}  # lần cuối bot tự đổi / ghi note của dòng
+note_lock = threading.Lock()
+note_event = threading.Event()
+# Serverless / update inline: instance có thể đóng băng ngay sau response → strike/band ghi luôn, không chờ thread
+NOTE_FLUSH_INLINE = SERVERLESS or not ASYNC_UPDATES
+if NOTE_FLUSH_INLINE:
+    print("[PERF] ⚠️ Note ghi ngay trong request (serverless / inline updates)")
+else:
+    print(f"[PERF] ✅ Note write-behind: flush mỗi {NOTE_FLUSH_INTERVAL}s (batch_update)")
 print(f"[QR API] ✅ Base URL: {QR_API_BASE}")
 
 print("="*60)
 
+_boot_mark("config")
+
 # =========================================================
-# GOOGLE SHEET CONNECT
+# GOOGLE SHEET CONNECT (lazy — lần dùng đầu tiên / thread khởi động)
 # =========================================================
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+gspread = None  # import lúc connect (gspread + oauth2client tốn thời gian import)
 
 GS_SCOPE = [
     "https://spreadsheets.google.com/feeds",
     "https://www.googleapis.com/auth/drive",
 ]
 
-creds = ServiceAccountCredentials.from_json_keyfile_dict(
-    json.loads(CREDS_JSON), GS_SCOPE
-)
-gc = gspread.authorize(creds)
-sh = gc.open_by_key(SHEET_ID)
+_sheet_state: Dict[str, Any] = {"sh": None, "titles": None}
+_sheet_connect_lock = threading.Lock()
+
+def _boot_bg(phase: str, t0: float) -> None:
+    """Ghi thời gian 1 bước khởi tạo chạy nền (không nằm trong thời gian import)"""
+    startup_report["background"][phase] = round((time.perf_counter() - t0) * 1000, 1)
+
+def get_spreadsheet():
+    """authorize + open_by_key 1 lần / process (thread khác gọi cùng lúc → chờ kết quả lần đầu)"""
+    global gspread
+    sh = _sheet_state["sh"]
+    if sh is not None:
+        return sh
+    with _sheet_connect_lock:
+        if _sheet_state["sh"] is None:
+            if not SHEET_ID or not CREDS_JSON:
+                raise RuntimeError("GOOGLE_SHEET_ID / GOOGLE_SHEETS_CREDS_JSON missing")
+            t0 = time.perf_counter()
+            import gspread as _gspread
+            from oauth2client.service_account import ServiceAccountCredentials
+            gspread = _gspread
+            _boot_bg("import gspread", t0)
+
+            t0 = time.perf_counter()
+            creds = ServiceAccountCredentials.from_json_keyfile_dict(json.loads(CREDS_JSON), GS_SCOPE)
+            gc = gspread.authorize(creds)
+            _sheet_state["sh"] = gc.open_by_key(SHEET_ID)
+            _boot_bg("sheets connect", t0)
+            print(f"[SHEETS] ✅ Connected ({startup_report['background']['sheets connect']:.0f}ms)")
+    return _sheet_state["sh"]
 
 # =========================================================
 # SHEET CONFIG
@@ -156,6 +325,13 @@ COL_NOTE_INDEX  = 5
 # =========================================================
 FREE_LIMIT_PER_DAY = 10
 SPAM_LIMIT_PER_MIN = 20
+# Giới hạn theo hành động: "action=số_lượt/giây" — "any" là tổng mọi lượt check (cookie/spx/ghn/phone)
+RATE_LIMITS = os.getenv(
+    "RATE_LIMITS",
+    f"any={SPAM_LIMIT_PER_MIN}/60,cookie={SPAM_LIMIT_PER_MIN}/60,spx={SPAM_LIMIT_PER_MIN}/60,"
+    f"ghn={SPAM_LIMIT_PER_MIN}/60,phone={SPAM_LIMIT_PER_MIN}/60,qr=5/300,batch=3/60"
+)
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
 QR_COOLDOWN_SECONDS = 60  # 60 giây giữa các lần tạo QR
 
 BAND_1_HOURS = 1
@@ -168,10 +344,77 @@ BAND_3_DAYS  = 7
 app = Flask(__name__)
 
 # =========================================================
-# RUNTIME CACHE
+# RATE LIMITER (GCRA theo Tele ID + hành động)
 # =========================================================
-spam_cache: Dict[str, Dict[str, int]] = {}
-spam_lock = threading.Lock()
+def parse_rate_limits(spec: str) -> Dict[str, Tuple[int, float]]:
+    """ "cookie=20/60,qr=5/300" → {"cookie": (20, 60.0), "qr": (5, 300.0)} """
+    out: Dict[str, Tuple[int, float]] = {}
+    for part in (spec or "").split(","):
+        try:
+            action, rule = part.split("=", 1)
+            count, period = rule.split("/", 1)
+            if int(count) > 0 and float(period) > 0:
+                out[action.strip().lower()] = (int(count), float(period))
+        except ValueError:
+            continue
+    return out
+
+class RateLimiter:
+    """
+    GCRA (token bucket dạng "thời điểm đến lý thuyết"): mỗi key chỉ giữ 1 số float
+    - count lượt trong period, cho dồn tối đa count lượt → giống cửa sổ trượt, không cắt theo phút
+    - hit O(1); key hết hạn (TAT đã qua = như chưa dùng) bị dọn dần từ đầu OrderedDict
+    """
+
+    def __init__(self, limits: Dict[str, Tuple[int, float]], max_keys: int):
+        self.limits = limits
+        self.max_keys = max_keys
+        self._tat: Dict[str, "OrderedDict[str, float]"] = {a: OrderedDict() for a in limits}
+        self._lock = threading.Lock()
+
+    def _evict_locked(self, table: "OrderedDict[str, float]", current: float) -> None:
+        while table:
+            key, tat = next(iter(table.items()))
+            if tat > current and len(table) <= self.max_keys:
+                break
+            table.popitem(last=False)
+
+    def hit(self, key: str, actions: List[Tuple[str, int]]) -> Tuple[bool, float, int]:
+        """
+        Tính cost cho nhiều action cùng lúc (all-or-nothing)
+        Returns: (cho phép?, retry_after giây, số lượt ước tính trong cửa sổ của action chặt nhất)
+        """
+        current = time.time()
+        with self._lock:
+            plan = []
+            allowed, retry_after, count_est = True, 0.0, 0
+            for action, cost in actions:
+                rule = self.limits.get(action)
+                if not rule:
+                    continue
+                limit, period = rule
+                interval = period / limit
+                table = self._tat[action]
+                new_tat = max(table.get(key, current), current) + cost * interval
+                count_est = max(count_est, int(-(-(new_tat - current) // interval)))
+                if new_tat - current > period:
+                    allowed = False
+                    retry_after = max(retry_after, new_tat - current - period)
+                plan.append((table, new_tat))
+
+            if allowed:
+                for table, new_tat in plan:
+                    table[key] = new_tat
+                    table.move_to_end(key)
+                    self._evict_locked(table, current)
+            return allowed, retry_after, count_est
+
+    def __len__(self) -> int:
+        with self._lock:
+            return sum(len(t) for t in self._tat.values())
+
+rate_limiter = RateLimiter(parse_rate_limits(RATE_LIMITS), RATE_LIMIT_MAX_KEYS)
+print(f"[PERF] ✅ Rate limit (GCRA): {RATE_LIMITS}")
 
 # =========================================================
 # COMMON UTILS
@@ -204,6 +447,191 @@ def normalize_tele_id(val: Any) -> str:
     digits = re.sub(r"\D", "", s)
     return digits or s
 
+# =========================================================
+# 🔥 FIX 4: HTTP SESSION POOL (keep-alive theo host)
+# =========================================================
+_http_sessions: Dict[str, requests.Session] = {}
+_http_lock = threading.Lock()
+
+def http_session(url: str) -> requests.Session:
+    """
+    Lấy Session dùng chung cho host của url (tạo lần đầu)
+    - Giữ kết nối TCP+TLS sống giữa các request (không handshake lại)
+    - Pool HTTP_POOL_SIZE connection → ThreadPoolExecutor dùng lại được
+    - Retry chỉ khi lỗi kết nối (không retry read → không trừ tiền 2 lần)
+    - ✅ Jar không nhận cookie từ response → SPC_ST của user này không dính sang request của user khác
+    """
+    host = urlsplit(url).netloc.lower()
+    with _http_lock:
+        sess = _http_sessions.get(host)
+        if sess is None:
+            sess = requests.Session()
+            sess.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+            retry = Retry(
+                total=HTTP_CONNECT_RETRY,
+                connect=HTTP_CONNECT_RETRY,
+                read=0,
+                status=0,
+                backoff_factor=0.2,
+            )
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+            sess.mount("https://", adapter)
+            sess.mount("http://", adapter)
+            _http_sessions[host] = sess
+    return sess
+
+def http_timeout(url: str):
+    host = urlsplit(url).netloc.lower()
+    return HTTP_HOST_TIMEOUTS.get(host, HTTP_DEFAULT_TIMEOUT)
+
+_http_host_sems: Dict[str, threading.BoundedSemaphore] = {
+    host: threading.BoundedSemaphore(limit) for host, limit in HTTP_HOST_LIMITS.items() if limit > 0
+}
+
+def http_request(method: str, url: str, **kwargs) -> requests.Response:
+    kwargs.setdefault("timeout", http_timeout(url))
+    sem = _http_host_sems.get(urlsplit(url).netloc.lower())
+    if sem is None:
+        return http_session(url).request(method, url, **kwargs)
+    with sem:
+        return http_session(url).request(method, url, **kwargs)
+
+def http_get(url: str, **kwargs) -> requests.Response:
+    return http_request("GET", url, **kwargs)
+
+def http_post(url: str, **kwargs) -> requests.Response:
+    return http_request("POST", url, **kwargs)
+
+# =========================================================
+# 🔥 FIX 6: DEDUP STORE (idempotent update / payment)
+# =========================================================
+class DedupStore:
+    """
+    Tập key đã xử lý trong cửa sổ DEDUP_TTL_SECONDS, tối đa DEDUP_MAX_KEYS key
+    OrderedDict theo thời gian thêm → check/thêm/dọn đều O(1)
+    """
+
+    def __init__(self, ttl: float, max_keys: int):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self._items: "OrderedDict[str, float]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _evict_locked(self, current: float) -> None:
+        while self._items:
+            key, ts = next(iter(self._items.items()))
+            if current - ts <= self.ttl and len(self._items) <= self.max_keys:
+                break
+            self._items.popitem(last=False)
+
+    def seen(self, key: str) -> bool:
+        with self._lock:
+            self._evict_locked(time.time())
+            return key in self._items
+
+    def add_if_new(self, key: str) -> bool:
+        """True nếu key mới (đã ghi nhận), False nếu đã xử lý trong cửa sổ TTL"""
+        current = time.time()
+        with self._lock:
+            self._evict_locked(current)
+            if key in self._items:
+                return False
+            self._items[key] = current
+            self._evict_locked(current)
+        self._persist_add(key, current)
+        return True
+
+    def discard(self, key: str) -> None:
+        """Bỏ key (vd: thao tác thất bại → cho phép thử lại)"""
+        with self._lock:
+            existed = self._items.pop(key, None) is not None
+        if existed:
+            self._persist_discard(key)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._items)
+
+    def _persist_add(self, key: str, ts: float) -> None:
+        pass
+
+    def _persist_discard(self, key: str) -> None:
+        pass
+
+class FileDedupStore(DedupStore):
+    """
+    DedupStore + file append-only (JSONL) → giữ được key qua restart
+    File được viết lại gọn khi số dòng vượt 2 lần số key còn hiệu lực
+    """
+
+    def __init__(self, path: str, ttl: float, max_keys: int):
+        super().__init__(ttl, max_keys)
+        self.path = path
+        self._file_lock = threading.Lock()
+        self._lines = 0
+        self._load()
+
+    def _load(self) -> None:
+        current = time.time()
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    self._lines += 1
+                    try:
+                        rec = json.loads(line)
+                    except Exception:
+                        continue
+                    key = rec.get("k")
+                    if not key:
+                        continue
+                    if rec.get("d"):
+                        self._items.pop(key, None)
+                    elif current - float(rec.get("t", 0)) <= self.ttl:
+                        self._items.pop(key, None)
+                        self._items[key] = float(rec["t"])
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            print(f"[DEDUP] Không đọc được {self.path}: {e}")
+            return
+
+        with self._lock:
+            self._evict_locked(current)
+        print(f"[DEDUP] Loaded {len(self._items)} keys từ {self.path}")
+
+    def _append(self, rec: Dict[str, Any]) -> None:
+        try:
+            with self._file_lock:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+                self._lines += 1
+                if self._lines > 2 * max(len(self), 1000):
+                    self._compact_locked()
+        except Exception as e:
+            print(f"[DEDUP] Ghi file lỗi: {e}")
+
+    def _compact_locked(self) -> None:
+        with self._lock:
+            items = list(self._items.items())
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for key, ts in items:
+                f.write(json.dumps({"k": key, "t": ts}, ensure_ascii=False) + "\n")
+        os.replace(tmp, self.path)
+        self._lines = len(items)
+
+    def _persist_add(self, key: str, ts: float) -> None:
+        self._append({"k": key, "t": ts})
+
+    def _persist_discard(self, key: str) -> None:
+        self._append({"k": key, "d": 1})
+
+if DEDUP_FILE:
+    dedup_store: DedupStore = FileDedupStore(DEDUP_FILE, DEDUP_TTL_SECONDS, DEDUP_MAX_KEYS)
+else:
+    dedup_store = DedupStore(DEDUP_TTL_SECONDS, DEDUP_MAX_KEYS)
+print(f"[DEDUP] ✅ {'File ' + DEDUP_FILE if DEDUP_FILE else 'RAM'}: TTL {DEDUP_TTL_SECONDS}s, max {DEDUP_MAX_KEYS} keys")
+
 # =========================================================
 # 🔥 CHECK SỐ ĐIỆN THOẠI SHOPEE ZIN
 # =========================================================
@@ -213,14 +641,29 @@ ERROR_USED = 12301116   # ❌ Số đã đăng ký Shopee
 
 PRIMARY_POOL_SIZE = 6  # Số cookie tối đa lấy từ sheet
 
+# ✅ Check song song: pool worker + giãn cách theo từng cookie (thay sleep 0.3s toàn cục)
+PHONE_CHECK_WORKERS = int(os.getenv("PHONE_CHECK_WORKERS", "5"))
+PHONE_COOKIE_INTERVAL = float(os.getenv("PHONE_COOKIE_INTERVAL", "0.3"))  # giây giữa 2 lần dùng cùng 1 cookie
+COOKIE_POOL_TTL = int(os.getenv("COOKIE_POOL_TTL", "120"))  # cache tab Cookie
+
+cookie_pool_cache = {"data": None, "timestamp": 0}
+cookie_pool_lock = threading.Lock()
+cookie_next_slot: Dict[str, float] = {}  # {cookie: thời điểm sớm nhất được dùng lại}
+
+# ✅ Sức khỏe cookie: loại tạm cookie lỗi liên tiếp (backoff mũ), chọn cookie theo điểm
+COOKIE_FAIL_THRESHOLD = int(os.getenv("COOKIE_FAIL_THRESHOLD", "3"))     # lỗi liên tiếp → cho nghỉ
+COOKIE_BACKOFF_BASE = float(os.getenv("COOKIE_BACKOFF_BASE", "30"))      # giây nghỉ lần đầu
+COOKIE_BACKOFF_MAX = float(os.getenv("COOKIE_BACKOFF_MAX", "1800"))      # tối đa 30 phút
+cookie_health: Dict[str, Dict[str, Any]] = {}
+phone_executor = ThreadPoolExecutor(max_workers=PHONE_CHECK_WORKERS, thread_name_prefix="phone")
+
 def _gs_read_live_cookies() -> List[str]:
     """
     Đọc cookies từ tab "Cookie" trong Google Sheet chính
     """
     try:
-        # Đọc từ tab "Cookie" trong sheet chính
-        ws = sh.worksheet("Cookie")
-        col = ws.col_values(1) or []
+        # Đọc từ tab "Cookie" trong sheet chính (hoặc bản SQLite kéo về từ tab đó)
+        col = store.cookie_values()
     except Exception as e:
         print(f"[ERROR] Không đọc được tab Cookie: {e}")
         print(f"[ERROR] Vui lòng tạo tab 'Cookie' trong Google Sheet")
@@ -248,8 +691,143 @@ def _gs_read_live_cookies() -> List[str]:
         return []
     
     print(f"[INFO] Đọc được {len(out)} cookies từ Google Sheet")
-    random.shuffle(out)
-    return out[:PRIMARY_POOL_SIZE]
+    return out
+
+def get_live_cookies_cached() -> List[str]:
+    """
+    Cookie pool từ tab Cookie, cache COOKIE_POOL_TTL giây (không đọc sheet mỗi lần check)
+    - Pool = PRIMARY_POOL_SIZE cookie điểm health cao nhất (đang nghỉ xếp cuối)
+    - ✅ Health giữ cho mọi cookie còn trên sheet → cookie hỏng không được "làm mới" khi đổi pool
+    """
+    with cookie_pool_lock:
+        data = cookie_pool_cache["data"]
+        if data and time.time() - cookie_pool_cache["timestamp"] < COOKIE_POOL_TTL:
+            return list(data)
+
+    on_sheet = _gs_read_live_cookies()
+    if not on_sheet:
+        return []
+
+    with cookie_pool_lock:
+        current = time.time()
+        # Chỉ bỏ slot / health của cookie đã bị xoá khỏi tab Cookie
+        keep = set(on_sheet)
+        for c in list(cookie_next_slot.keys()):
+            if c not in keep:
+                cookie_next_slot.pop(c, None)
+        for c in list(cookie_health.keys()):
+            if c not in keep:
+                cookie_health.pop(c, None)
+
+        ranked = sorted(
+            on_sheet,
+            key=lambda c: (
+                _cookie_health_locked(c)["sidelined_until"] > current,
+                -cookie_score(cookie_health[c]),
+            ),
+        )
+        cookies = ranked[:PRIMARY_POOL_SIZE]
+        cookie_pool_cache["data"] = list(cookies)
+        cookie_pool_cache["timestamp"] = current
+
+    return list(cookies)
+
+def _cookie_health_locked(cookie: str) -> Dict[str, Any]:
+    """Lấy/tạo bản ghi health của cookie. Gọi khi đang giữ cookie_pool_lock"""
+    h = cookie_health.get(cookie)
+    if h is None:
+        h = {
+            "ok": 0,
+            "fail": 0,
+            "auth_fail": 0,
+            "timeout": 0,
+            "latency": 0.0,        # EWMA (giây)
+            "consec_fail": 0,
+            "sidelined_until": 0.0,
+            "last_note": "",
+        }
+        cookie_health[cookie] = h
+    return h
+
+def cookie_score(h: Dict[str, Any]) -> float:
+    """Điểm cookie = tỉ lệ thành công (làm mượt) / độ trễ. Càng cao càng tốt"""
+    success_rate = (h["ok"] + 1) / (h["ok"] + h["fail"] + 2)
+    return success_rate / (0.2 + h["latency"])
+
+def record_cookie_result(cookie: str, req_ok: bool, error_code: Any, note: str, latency: float) -> None:
+    """Ghi nhận kết quả 1 lần gọi check_unbind_phone cho cookie"""
+    with cookie_pool_lock:
+        h = _cookie_health_locked(cookie)
+        h["latency"] = latency if not (h["ok"] or h["fail"]) else 0.7 * h["latency"] + 0.3 * latency
+        h["last_note"] = note
+
+        if req_ok:
+            h["ok"] += 1
+            h["consec_fail"] = 0
+            h["sidelined_until"] = 0.0
+            return
+
+        h["fail"] += 1
+        h["consec_fail"] += 1
+        if error_code in (401, 403):
+            h["auth_fail"] += 1
+            # Cookie hết hạn gần như chắc chắn → cho nghỉ ngay
+            h["consec_fail"] = max(h["consec_fail"], COOKIE_FAIL_THRESHOLD)
+        elif note == "Timeout":
+            h["timeout"] += 1
+
+        if h["consec_fail"] >= COOKIE_FAIL_THRESHOLD:
+            backoff = COOKIE_BACKOFF_BASE * (2 ** (h["consec_fail"] - COOKIE_FAIL_THRESHOLD))
+            h["sidelined_until"] = time.time() + min(backoff, COOKIE_BACKOFF_MAX)
+
+def _reserve_phone_cookie(cookies: List[str], tried: set) -> Tuple[Optional[str], float]:
+    """
+    Chọn cookie tốt nhất (chưa thử cho số này, không bị cho nghỉ) và giữ slot của nó
+    Ưu tiên thời gian chờ slot + độ trễ kỳ vọng nhỏ nhất (cookie hay lỗi bị phạt)
+    Returns: (cookie, số giây phải chờ trước khi gọi)
+    """
+    with cookie_pool_lock:
+        current = time.time()
+        candidates = [
+            c for c in cookies
+            if c not in tried and _cookie_health_locked(c)["sidelined_until"] <= current
+        ]
+        if not candidates:
+            return None, 0.0
+
+        def expected_cost(c: str) -> float:
+            wait = max(0.0, cookie_next_slot.get(c, 0.0) - current)
+            return wait + 1.0 / cookie_score(cookie_health[c])
+
+        best = min(candidates, key=expected_cost)
+        start = max(current, cookie_next_slot.get(best, 0.0))
+        cookie_next_slot[best] = start + PHONE_COOKIE_INTERVAL
+
+    return best, start - current
+
+def format_cookie_health() -> str:
+    """Bảng sức khỏe cookie pool (lệnh admin /cookiehealth)"""
+    cookies = get_live_cookies_cached()
+    if not cookies:
+        return "❌ <b>Không có cookie trong tab Cookie</b>"
+
+    current = time.time()
+    lines = [f"🍪 <b>COOKIE POOL</b> ({len(cookies)} cookie)\n"]
+    with cookie_pool_lock:
+        ranked = sorted(cookies, key=lambda c: -cookie_score(_cookie_health_locked(c)))
+        for i, c in enumerate(ranked, start=1):
+            h = cookie_health[c]
+            total = h["ok"] + h["fail"]
+            rate = f"{h['ok'] * 100 // total}%" if total else "-"
+            state = "✅"
+            if h["sidelined_until"] > current:
+                state = f"⏸ nghỉ {int(h['sidelined_until'] - current)}s"
+            lines.append(
+                f"{i}. <code>{esc(mask_value(c))}</code> {state}\n"
+                f"   ok {h['ok']}/{total} ({rate}) · 401/403: {h['auth_fail']} · timeout: {h['timeout']}"
+                f" · {h['latency'] * 1000:.0f}ms · score {cookie_score(h):.2f}"
+            )
+    return "\n".join(lines)
 
 def normalize_phone_to_84(raw: str) -> str:
     """Chuẩn hóa số điện thoại về dạng 84xxxxxxxxx"""
@@ -345,7 +923,7 @@ def check_shopee_phone_api(cookie: str, phone84: str) -> tuple:
     }
 
     try:
-        response = requests.post(url, headers=headers, json=payload, timeout=4)
+        response = http_post(url, headers=headers, json=payload, timeout=4)
 
         if response.status_code in (401, 403):
             return False, False, response.status_code, "Cookie hết hạn"
@@ -396,9 +974,20 @@ def check_shopee_phone_with_sheet_cookies(phone: str, cookies: List[str]) -> tup
     if not cookies:
         return False, False, "Không có cookie"
     
-    # Thử tối đa 2 cookie
-    for cookie in cookies[:2]:
+    # Thử tối đa 2 cookie (mỗi cookie tôn trọng giãn cách PHONE_COOKIE_INTERVAL)
+    tried = set()
+    for _ in range(2):
+        cookie, wait = _reserve_phone_cookie(cookies, tried)
+        if not cookie:
+            break
+        tried.add(cookie)
+
+        if wait > 0:
+            time.sleep(wait)
+
+        started = time.time()
         req_ok, is_zin, error_code, note = check_shopee_phone_api(cookie, phone84)
+        record_cookie_result(cookie, req_ok, error_code, note, time.time() - started)
         
         if not req_ok:
             continue  # Thử cookie tiếp
@@ -415,8 +1004,8 @@ def check_multiple_phones(phones: List[str]) -> List[dict]:
     # Giới hạn 10 số
     phones = phones[:10]
     
-    # Đọc cookies từ Google Sheet
-    cookies = _gs_read_live_cookies()
+    # Cookie pool (cache)
+    cookies = get_live_cookies_cached()
     
     if not cookies:
         return [{
@@ -426,10 +1015,19 @@ def check_multiple_phones(phones: List[str]) -> List[dict]:
             "note": "Không có cookie trong sheet"
         } for p in phones]
     
+    # Check song song, trả kết quả đúng thứ tự input
+    futures = [
+        phone_executor.submit(check_shopee_phone_with_sheet_cookies, phone, cookies)
+        for phone in phones
+    ]
+    
     results = []
     
-    for phone in phones:
-        success, is_zin, note = check_shopee_phone_with_sheet_cookies(phone, cookies)
+    for phone, future in zip(phones, futures):
+        try:
+            success, is_zin, note = future.result()
+        except Exception as e:
+            success, is_zin, note = False, False, f"Error: {e}"
         
         results.append({
             "phone": phone,
@@ -437,19 +1035,288 @@ def check_multiple_phones(phones: List[str]) -> List[dict]:
             "is_zin": is_zin,
             "note": note
         })
-        
-        # Delay nhẹ giữa các request
-        time.sleep(0.3)
     
     return results
 
+# =========================================================
+# 🔥 QR SESSION STORE
+# =========================================================
+# Trạng thái session: waiting → scanned → paying → paid → done (+ expired / cancelled)
+# Chỉ cho phép chuyển theo bảng này → 2 thread không thể cùng "trả tiền" 1 session
+# paying: đã giữ session để trừ tiền (không hủy / hết hạn được), trừ lỗi → unpaid (như scanned, thu lại được)
+QR_TRANSITIONS = {
+    "waiting": {"scanned", "expired", "cancelled"},
+    "scanned": {"paying", "paid", "done", "expired", "cancelled"},
+    "paying": {"paid", "unpaid"},
+    "unpaid": {"paying", "paid", "done", "expired", "cancelled"},
+    "paid": {"done"},
+    "done": set(),
+    "expired": set(),
+    "cancelled": set(),
+}
+
+# Vào các status này phải là chuyển thật (không áp dụng "cùng status = no-op") → chỉ 1 thread giữ được
+QR_CLAIM_STATUSES = {"paying"}
+QR_PAY_STALE_SECONDS = 60  # paying lâu hơn mức này = lần trừ tiền trước bị ngắt (restart)
+# Đang trừ tiền / đã trừ chưa giao cookie → dọn session hết hạn không được xoá (mất tiền / mất cookie)
+QR_INFLIGHT_STATUSES = ("paying", "paid")
+QR_INFLIGHT_MAX_AGE = 86400  # kẹt quá lâu (1 ngày) thì mới dọn
+
+def _qr_can_transition(cur: str, to_status: str) -> bool:
+    if cur == to_status:
+        return to_status not in QR_CLAIM_STATUSES
+    return to_status in QR_TRANSITIONS.get(cur, set())
+
+def _qr_user_key(user_id: Any) -> str:
+    return normalize_tele_id(user_id)
+
+class MemoryQRSessionStore:
+    """
+    QR session trong RAM
+    - index user_id → {session_id: created} → tra cứu / cooldown không phải quét hết
+    - heap (created, session_id) → dọn hết hạn chỉ pop phần đầu heap, O(log n) / session
+    """
+
+    def __init__(self):
+        self._sessions: Dict[str, Dict[str, Any]] = {}
+        self._by_user: Dict[str, Dict[str, float]] = {}
+        self._expiry: List[Tuple[float, str]] = []
+        self._lock = threading.Lock()
+
+    def create(self, session_id: str, sess: Dict[str, Any]) -> None:
+        sess = dict(sess)
+        created = float(sess.setdefault("created", time.time()))
+        with self._lock:
+            if session_id in self._sessions:
+                self._delete_locked(session_id)
+            self._sessions[session_id] = sess
+            self._by_user.setdefault(_qr_user_key(sess.get("user_id")), {})[session_id] = created
+            heapq.heappush(self._expiry, (created, session_id))
+
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            sess = self._sessions.get(session_id)
+            return dict(sess) if sess else None
+
+    def update(self, session_id: str, **fields) -> bool:
+        """Cập nhật field thường (không đổi status — dùng transition)"""
+        fields.pop("status", None)
+        with self._lock:
+            sess = self._sessions.get(session_id)
+            if not sess:
+                return False
+            sess.update(fields)
+            return True
+
+    def transition(self, session_id: str, to_status: str, **fields) -> bool:
+        """Đổi status nguyên tử theo QR_TRANSITIONS (cùng status = no-op thành công, trừ QR_CLAIM_STATUSES)"""
+        with self._lock:
+            sess = self._sessions.get(session_id)
+            if not sess:
+                return False
+            cur = sess.get("status", "waiting")
+            if not _qr_can_transition(cur, to_status):
+                return False
+            sess.update(fields)
+            sess["status"] = to_status
+            return True
+
+    def _delete_locked(self, session_id: str) -> Optional[Dict[str, Any]]:
+        # Entry trong heap để lại (xóa lười) → bỏ qua khi pop
+        sess = self._sessions.pop(session_id, None)
+        if sess:
+            key = _qr_user_key(sess.get("user_id"))
+            ids = self._by_user.get(key)
+            if ids:
+                ids.pop(session_id, None)
+                if not ids:
+                    self._by_user.pop(key, None)
+        return sess
+
+    def delete(self, session_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._delete_locked(session_id)
+
+    def for_user(self, user_id: Any) -> List[Tuple[str, Dict[str, Any]]]:
+        """Session của 1 user, mới nhất trước"""
+        with self._lock:
+            ids = self._by_user.get(_qr_user_key(user_id), {})
+            order = sorted(ids, key=ids.get, reverse=True)
+            return [(sid, dict(self._sessions[sid])) for sid in order]
+
+    def latest_for_user(self, user_id: Any) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """Session mới nhất của user (cooldown) — không copy các session khác"""
+        with self._lock:
+            ids = self._by_user.get(_qr_user_key(user_id))
+            if not ids:
+                return None
+            sid = max(ids, key=ids.get)
+            return sid, dict(self._sessions[sid])
+
+    def live(self) -> List[Tuple[str, Dict[str, Any]]]:
+        with self._lock:
+            return [(sid, dict(sess)) for sid, sess in self._sessions.items()]
+
+    def purge_expired(self, ttl: float) -> int:
+        current = time.time()
+        cutoff = current - ttl
+        purged = 0
+        kept: List[Tuple[float, str]] = []
+        with self._lock:
+            while self._expiry and self._expiry[0][0] < cutoff:
+                created, sid = heapq.heappop(self._expiry)
+                sess = self._sessions.get(sid)
+                # Entry cũ (session đã xóa / tạo lại) → bỏ qua
+                if not sess or float(sess.get("created", 0)) != created:
+                    continue
+                if sess.get("status") in QR_INFLIGHT_STATUSES and created >= current - QR_INFLIGHT_MAX_AGE:
+                    kept.append((created, sid))  # đang trừ tiền / chờ giao cookie → giữ, lần dọn sau xét lại
+                    continue
+                self._delete_locked(sid)
+                purged += 1
+            for entry in kept:
+                heapq.heappush(self._expiry, entry)
+            # Heap toàn entry đã xóa → nén lại cho khỏi phình
+            if len(self._expiry) > 2 * len(self._sessions) + 64:
+                self._expiry = [(float(sess.get("created", 0)), sid) for sid, sess in self._sessions.items()]
+                heapq.heapify(self._expiry)
+        return purged
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._sessions)
+
+class SQLiteQRSessionStore:
+    """
+    QR session trong SQLite (WAL) → còn nguyên sau restart / cold start
+    Cột user_id, created, status có index; các field còn lại nằm trong data (JSON)
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS qr_sessions ("
+            " session_id TEXT PRIMARY KEY,"
+            " user_id TEXT NOT NULL,"
+            " created REAL NOT NULL,"
+            " status TEXT NOT NULL,"
+            " data TEXT NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_qr_user ON qr_sessions(user_id, created)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_qr_created ON qr_sessions(created)")
+
+    @staticmethod
+    def _row_to_sess(row) -> Dict[str, Any]:
+        sess = json.loads(row[4])
+        sess["status"] = row[3]
+        return sess
+
+    def create(self, session_id: str, sess: Dict[str, Any]) -> None:
+        sess = dict(sess)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO qr_sessions VALUES (?, ?, ?, ?, ?)",
+                (session_id, _qr_user_key(sess.get("user_id")), float(sess.get("created", time.time())),
+                 sess.get("status", "waiting"), json.dumps(sess, ensure_ascii=False))
+            )
+
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._db.execute("SELECT * FROM qr_sessions WHERE session_id = ?", (session_id,)).fetchone()
+        return self._row_to_sess(row) if row else None
+
+    def _modify(self, session_id: str, to_status: Optional[str], fields: Dict[str, Any]) -> bool:
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._db.execute("SELECT * FROM qr_sessions WHERE session_id = ?", (session_id,)).fetchone()
+                if not row:
+                    self._db.execute("ROLLBACK")
+                    return False
+                sess = self._row_to_sess(row)
+                cur = sess.get("status", "waiting")
+                if to_status and not _qr_can_transition(cur, to_status):
+                    self._db.execute("ROLLBACK")
+                    return False
+                sess.update(fields)
+                sess["status"] = to_status or cur
+                self._db.execute(
+                    "UPDATE qr_sessions SET status = ?, data = ? WHERE session_id = ?",
+                    (sess["status"], json.dumps(sess, ensure_ascii=False), session_id)
+                )
+                self._db.execute("COMMIT")
+                return True
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def update(self, session_id: str, **fields) -> bool:
+        fields.pop("status", None)
+        return self._modify(session_id, None, fields)
+
+    def transition(self, session_id: str, to_status: str, **fields) -> bool:
+        return self._modify(session_id, to_status, fields)
+
+    def delete(self, session_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._db.execute("SELECT * FROM qr_sessions WHERE session_id = ?", (session_id,)).fetchone()
+            if not row:
+                return None
+            self._db.execute("DELETE FROM qr_sessions WHERE session_id = ?", (session_id,))
+        return self._row_to_sess(row)
+
+    def for_user(self, user_id: Any) -> List[Tuple[str, Dict[str, Any]]]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT * FROM qr_sessions WHERE user_id = ? ORDER BY created DESC",
+                (_qr_user_key(user_id),)
+            ).fetchall()
+        return [(r[0], self._row_to_sess(r)) for r in rows]
+
+    def latest_for_user(self, user_id: Any) -> Optional[Tuple[str, Dict[str, Any]]]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT * FROM qr_sessions WHERE user_id = ? ORDER BY created DESC LIMIT 1",
+                (_qr_user_key(user_id),)
+            ).fetchone()
+        return (row[0], self._row_to_sess(row)) if row else None
+
+    def live(self) -> List[Tuple[str, Dict[str, Any]]]:
+        with self._lock:
+            rows = self._db.execute("SELECT * FROM qr_sessions ORDER BY created").fetchall()
+        return [(r[0], self._row_to_sess(r)) for r in rows]
+
+    def purge_expired(self, ttl: float) -> int:
+        current = time.time()
+        with self._lock:
+            cur = self._db.execute(
+                "DELETE FROM qr_sessions WHERE created < ?"
+                f" AND (status NOT IN ({', '.join('?' * len(QR_INFLIGHT_STATUSES))}) OR created < ?)",
+                (current - ttl, *QR_INFLIGHT_STATUSES, current - QR_INFLIGHT_MAX_AGE)
+            )
+            return cur.rowcount
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM qr_sessions").fetchone()[0]
+
+if QR_STORE == "sqlite":
+    qr_store = SQLiteQRSessionStore(QR_STORE_PATH)
+else:
+    qr_store = MemoryQRSessionStore()
+print(f"[QR] ✅ Session store: {QR_STORE}{' (' + QR_STORE_PATH + ')' if QR_STORE == 'sqlite' else ''}, {len(qr_store)} sessions")
+
 # =========================================================
 # 🔥 QR LOGIN FUNCTIONS
 # =========================================================
 def create_qr_session(user_id: int) -> Tuple[bool, str, str]:
     """Tạo QR session mới"""
     try:
-        response = requests.post(
+        response = http_post(
             f"{QR_API_BASE}/api/qr/create",
             json={"user_id": user_id},
             timeout=10
@@ -467,88 +1334,142 @@ def create_qr_session(user_id: int) -> Tuple[bool, str, str]:
         session_id = data.get("session_id")
         qr_image = data.get("qr_image", "").replace("data:image/png;base64,", "")
 
-        # Lưu session (lock)
-        with qr_lock:
-            qr_sessions[session_id] = {
-                "user_id": user_id,
-                "created": time.time(),
-                "status": "waiting",  # waiting, scanned, done, expired
-                "qr_image": qr_image,
-                "cookie": ""
-            }
+        # Lưu session
+        qr_store.create(session_id, {
+            "user_id": user_id,
+            "created": time.time(),
+            "status": "waiting",  # waiting → scanned → paid → done / expired / cancelled
+            "cookie": ""
+        })
 
         return True, session_id, qr_image
 
     except Exception as e:
         return False, f"Error: {str(e)}", ""
 
-def check_qr_status(session_id: str) -> Tuple[bool, str, bool, Optional[str], Optional[str]]:
+qr_status_sem = threading.BoundedSemaphore(QR_STATUS_CONCURRENCY)
+qr_status_executor = ThreadPoolExecutor(max_workers=QR_STATUS_CONCURRENCY, thread_name_prefix="qr-status")
+qr_batch_supported = QR_STATUS_BATCH != "false"  # auto: tắt khi API không có endpoint batch
+
+def _fetch_qr_status_raw(session_id: str) -> Tuple[int, Optional[dict]]:
+    """GET status 1 session. Returns: (http_status, json) — (-1, None) khi lỗi mạng/JSON"""
+    try:
+        with qr_status_sem:
+            response = http_get(
+                f"{QR_API_BASE}/api/qr/status/{session_id}",
+                timeout=5
+            )
+        if response.status_code != 200:
+            return response.status_code, None
+        return 200, response.json()
+    except Exception:
+        return -1, None
+
+def _fetch_qr_status_batch_api(session_ids: List[str]) -> Optional[Dict[str, Tuple[int, Optional[dict]]]]:
+    """
+    POST /api/qr/status/batch {"session_ids": [...]} → {"success": true, "results": {sid: {...}}}
+    None nếu API không hỗ trợ / lỗi (caller fallback sang request song song)
+    """
+    global qr_batch_supported
+    try:
+        with qr_status_sem:
+            response = http_post(
+                f"{QR_API_BASE}/api/qr/status/batch",
+                json={"session_ids": session_ids},
+                timeout=5
+            )
+        if response.status_code in (404, 405) and QR_STATUS_BATCH == "auto":
+            qr_batch_supported = False
+            print("[QR] API không có /api/qr/status/batch → dùng request song song")
+            return None
+        if response.status_code != 200:
+            return None
+        results = (response.json() or {}).get("results") or {}
+    except Exception:
+        return None
+
+    return {
+        sid: (200, results[sid]) if isinstance(results.get(sid), dict) else (-1, None)
+        for sid in session_ids
+    }
+
+def fetch_qr_statuses(session_ids: List[str]) -> Dict[str, Tuple[int, Optional[dict]]]:
+    """
+    Lấy status nhiều session trong 1 vòng:
+    - Endpoint batch (1 request) nếu QR API hỗ trợ
+    - Ngược lại: request song song qua pool keep-alive (giới hạn QR_STATUS_CONCURRENCY)
+    """
+    if not session_ids:
+        return {}
+
+    if qr_batch_supported and len(session_ids) > 1:
+        out = _fetch_qr_status_batch_api(session_ids)
+        if out is not None:
+            return out
+
+    futures = {sid: qr_status_executor.submit(_fetch_qr_status_raw, sid) for sid in session_ids}
+    out = {}
+    for sid, fut in futures.items():
+        try:
+            out[sid] = fut.result()
+        except Exception:
+            out[sid] = (-1, None)
+    return out
+
+def check_qr_status(session_id: str, prefetched: Optional[Tuple[int, Optional[dict]]] = None) -> Tuple[bool, str, bool, Optional[str], Optional[str]]:
     """
     Kiểm tra trạng thái QR
+    prefetched: (http_status, json) đã lấy sẵn theo lô (fetch_qr_statuses) → không gọi API lại
     Returns: (ok, status, has_token, cookie_st, cookie_f)
     """
-    with qr_lock:
-        if session_id not in qr_sessions:
-            return False, "NOT_FOUND", False, None, None
-        session = qr_sessions[session_id]
+    session = qr_store.get(session_id)
+    if not session:
+        return False, "NOT_FOUND", False, None, None
 
     # Check timeout
     if time.time() - session["created"] > QR_TIMEOUT:
-        with qr_lock:
-            if session_id in qr_sessions:
-                qr_sessions[session_id]["status"] = "expired"
+        qr_store.transition(session_id, "expired")
         return False, "EXPIRED", False, None, None
 
-    try:
-        response = requests.get(
-            f"{QR_API_BASE}/api/qr/status/{session_id}",
-            timeout=5
-        )
+    http_status, data = prefetched if prefetched is not None else _fetch_qr_status_raw(session_id)
 
-        if response.status_code != 200:
-            return False, f"API_ERROR_{response.status_code}", False, None, None
+    if http_status == -1 or (http_status == 200 and not isinstance(data, dict)):
+        return False, "CHECK_ERROR", False, None, None
 
-        data = response.json()
+    if http_status != 200:
+        return False, f"API_ERROR_{http_status}", False, None, None
 
-        if not data.get("success"):
-            return False, data.get("status", "UNKNOWN"), False, None, None
-
-        status = data.get("status", "")
-        has_token = data.get("has_token", False)
-        cookie_st = data.get("cookie_st")
-        cookie_f = data.get("cookie_f")
-
-        if status == "SCANNED" or has_token:
-            with qr_lock:
-                if session_id in qr_sessions:
-                    qr_sessions[session_id]["status"] = "scanned"
-            return True, "SCANNED", has_token, cookie_st, cookie_f
-        elif status == "NOT_FOUND":
-            with qr_lock:
-                if session_id in qr_sessions:
-                    qr_sessions[session_id]["status"] = "expired"
-            return False, "EXPIRED", False, None, None
-        else:
-            return True, status, has_token, None, None
+    if not data.get("success"):
+        return False, data.get("status", "UNKNOWN"), False, None, None
 
-    except Exception:
-        return False, "CHECK_ERROR", False, None, None
+    status = data.get("status", "")
+    has_token = data.get("has_token", False)
+    cookie_st = data.get("cookie_st")
+    cookie_f = data.get("cookie_f")
+
+    if status == "SCANNED" or has_token:
+        qr_store.transition(session_id, "scanned")
+        return True, "SCANNED", has_token, cookie_st, cookie_f
+    elif status == "NOT_FOUND":
+        qr_store.transition(session_id, "expired")
+        return False, "EXPIRED", False, None, None
+    else:
+        return True, status, has_token, None, None
 
 def get_qr_cookie(session_id: str) -> Tuple[bool, str, Optional[str], Optional[dict]]:
     """
     Lấy cookie sau khi quét QR thành công
     Returns: (success, cookie_st/error_msg, cookie_f, user_info)
     """
-    with qr_lock:
-        if session_id not in qr_sessions:
-            return False, "Session not found", None, None
-        session = qr_sessions[session_id]
-        # ✅ FIX: Nếu đã có cookie thì trả luôn (không gọi API lại)
-        if session.get("cookie"):
-            return True, session["cookie"], session.get("cookie_f"), session.get("user_info")
+    session = qr_store.get(session_id)
+    if not session:
+        return False, "Session not found", None, None
+    # ✅ FIX: Nếu đã có cookie thì trả luôn (không gọi API lại)
+    if session.get("cookie"):
+        return True, session["cookie"], session.get("cookie_f"), session.get("user_info")
 
     try:
-        response = requests.post(
+        response = http_post(
             f"{QR_API_BASE}/api/qr/login/{session_id}",
             timeout=10
         )
@@ -579,7 +1500,7 @@ def get_qr_cookie(session_id: str) -> Tuple[bool, str, Optional[str], Optional[d
                 "Cookie": cookie_st,
                 "User-Agent": "Mozilla/5.0"
             }
-            response = requests.get(
+            response = http_get(
                 "https://shopee.vn/api/v4/account/basic/get_account_info",
                 headers=headers,
                 timeout=5
@@ -594,13 +1515,8 @@ def get_qr_cookie(session_id: str) -> Tuple[bool, str, Optional[str], Optional[d
         except Exception:
             pass
 
-        # Lưu cookie vào session (lock)
-        with qr_lock:
-            if session_id in qr_sessions:
-                qr_sessions[session_id]["cookie"] = cookie_st
-                qr_sessions[session_id]["cookie_f"] = cookie_f
-                qr_sessions[session_id]["user_info"] = user_info
-                qr_sessions[session_id]["status"] = "done"
+        # Lưu cookie vào session (đã quét → chờ thu phí / gửi)
+        qr_store.transition(session_id, "scanned", cookie=cookie_st, cookie_f=cookie_f, user_info=user_info)
 
         return True, cookie_st, cookie_f, user_info
 
@@ -609,139 +1525,408 @@ def get_qr_cookie(session_id: str) -> Tuple[bool, str, Optional[str], Optional[d
 
 def cleanup_qr_sessions():
     """Dọn session QR cũ"""
-    current_time = time.time()
-    expired_sessions = []
-
-    with qr_lock:
-        for session_id, session in list(qr_sessions.items()):
-            if current_time - session["created"] > QR_TIMEOUT:
-                expired_sessions.append(session_id)
-
-        for session_id in expired_sessions:
-            qr_sessions.pop(session_id, None)
-
-    return len(expired_sessions)
+    return qr_store.purge_expired(QR_TIMEOUT)
 
 # =========================================================
 # 🔥 FIX 2: CACHE COOKIE FUNCTIONS
 # =========================================================
-def get_cached_orders(cookie: str):
-    """Lấy kết quả đã cache theo cookie"""
-    with cache_lock:
-        item = order_cache.get(cookie)
+class LRUTTLCache:
+    """
+    Cache LRU có TTL, giới hạn theo số entry + dung lượng ước tính (bytes)
+    - Hết hạn kiểu lười: entry quá TTL bị bỏ khi đọc tới / khi cần chỗ
+    - Single-flight: nhiều request cùng key lúc miss → chỉ 1 request gọi loader, còn lại chờ kết quả
+    """
+
+    def __init__(self, ttl: float, max_entries: int, max_bytes: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._items: "OrderedDict[str, Tuple[Any, float, int]]" = OrderedDict()  # key → (data, ts, size)
+        self._bytes = 0
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0, "evictions": 0, "expired": 0}
+
+    @staticmethod
+    def _sizeof(data: Any) -> int:
+        try:
+            return len(json.dumps(data, ensure_ascii=False, default=str))
+        except Exception:
+            return 1024
+
+    def _pop_locked(self, key: str) -> None:
+        item = self._items.pop(key, None)
+        if item:
+            self._bytes -= item[2]
+
+    def _get_locked(self, key: str, current: float) -> Any:
+        item = self._items.get(key)
         if not item:
             return None
-
-        # Kiểm tra TTL
-        if time.time() - item["time"] > CACHE_COOKIE_TTL:
-            # Cache hết hạn
-            order_cache.pop(cookie, None)
+        if current - item[1] > self.ttl:
+            self._pop_locked(key)
+            self.stats["expired"] += 1
             return None
+        self._items.move_to_end(key)
+        return item[0]
+
+    def get(self, key: str) -> Any:
+        with self._lock:
+            data = self._get_locked(key, time.time())
+            self.stats["hits" if data is not None else "misses"] += 1
+            return data
+
+    def set(self, key: str, data: Any) -> None:
+        size = self._sizeof(data)
+        if size > self.max_bytes:
+            return
+        current = time.time()
+        with self._lock:
+            self._pop_locked(key)
+            self._items[key] = (data, current, size)
+            self._bytes += size
+            # Dọn từ đầu (cũ nhất / ít dùng nhất) tới khi đủ chỗ
+            while self._items and (len(self._items) > self.max_entries or self._bytes > self.max_bytes):
+                old_key, (_, ts, _) = next(iter(self._items.items()))
+                self._pop_locked(old_key)
+                self.stats["expired" if current - ts > self.ttl else "evictions"] += 1
+
+    def get_or_load(self, key: str, loader, should_cache=lambda v: v is not None) -> Any:
+        """
+        Trả data từ cache; miss → loader() (single-flight theo key)
+        Kết quả loader được chia cho mọi request đang chờ, chỉ cache khi should_cache(kết quả)
+        """
+        with self._lock:
+            data = self._get_locked(key, time.time())
+            if data is not None:
+                self.stats["hits"] += 1
+                return data
+            fut = self._inflight.get(key)
+            leader = fut is None
+            if leader:
+                fut = Future()
+                self._inflight[key] = fut
+                self.stats["misses"] += 1
+            else:
+                self.stats["coalesced"] += 1
 
-        return item["data"]
+        if not leader:
+            return fut.result()
 
-def set_cached_orders(cookie: str, data):
-    """Lưu kết quả vào cache"""
-    with cache_lock:
-        order_cache[cookie] = {
-            "data": data,
-            "time": time.time()
-        }
+        # ✅ finally: lỗi ở bất kỳ bước nào vẫn gỡ in-flight + trả kết quả cho request đang chờ (không treo mãi)
+        try:
+            value = loader()
+            try:
+                if should_cache(value):
+                    self.set(key, value)
+            except Exception as e:
+                print(f"[CACHE] Không cache được {key[:8]}…: {e}")  # kết quả vẫn dùng được, chỉ bỏ cache
+        except BaseException as e:
+            fut.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            if not fut.done():
+                fut.set_result(value)
+        return value
+
+    def purge_expired(self) -> int:
+        current = time.time()
+        with self._lock:
+            expired = [k for k, (_, ts, _) in self._items.items() if current - ts > self.ttl]
+            for k in expired:
+                self._pop_locked(k)
+            self.stats["expired"] += len(expired)
+        return len(expired)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            out = dict(self.stats)
+            out["entries"] = len(self._items)
+            out["bytes"] = self._bytes
+            out["inflight"] = len(self._inflight)
+        return out
+
+# {hash SPC_ST: ({"html", "orders"}, error)} — chỉ cache lần fetch thành công có đơn
+order_cache = LRUTTLCache(CACHE_COOKIE_TTL, ORDER_CACHE_MAX_ENTRIES, ORDER_CACHE_MAX_BYTES)
 
 def clear_expired_cache():
-    """Dọn cache cũ (chạy định kỳ)"""
-    current_time = time.time()
-    with cache_lock:
-        expired = [
-            k for k, v in list(order_cache.items())
-            if current_time - v["time"] > CACHE_COOKIE_TTL
-        ]
-        for k in expired:
-            order_cache.pop(k, None)
+    """Dọn cache cũ (chạy định kỳ — cache vẫn tự bỏ entry hết hạn khi đọc tới)"""
+    return order_cache.purge_expired()
 
 # =========================================================
 # 🔥 FIX 3: BATCH LOG WORKER
 # =========================================================
-def log_worker():
+class LogWriter:
     """
-    Worker thread xử lý batch ghi log
-    Gom log → Ghi 1 lần khi:
-    - Đủ LOG_BATCH_SIZE dòng
-    - Hoặc sau LOG_BATCH_INTERVAL giây
+    Gom log theo tab → append_rows 1 lần / batch
+    - Lỗi → giữ batch, thử lại với backoff mũ (1s, 2s, 4s... tối đa LOG_RETRY_MAX_DELAY)
+    - Lỗi quá LOG_RETRY_MAX lần liên tiếp / buffer quá LOG_BUFFER_MAX → ghi ra file spill (JSONL)
+    - File spill được nạp lại khi khởi động và sau lần ghi thành công kế tiếp
+    - Kích thước batch / chu kỳ flush tự giãn theo độ trễ Sheets đo được (EWMA)
     """
-    buffer_check = []
-    buffer_spam = []
-    buffer_qr = []
-    last_flush = time.time()
 
-    print("[LOG] Batch log worker started")
+    def __init__(self, write_rows, spill_path: str, tabs=("check", "spam", "qr")):
+        self.write_rows = write_rows  # write_rows(tab, rows) → raise khi lỗi
+        self.spill_path = spill_path
+        self.tabs = tuple(tabs)
+        self._buffers: Dict[str, List[list]] = {t: [] for t in self.tabs}
+        self._first_ts: Dict[str, float] = {}     # thời điểm dòng cũ nhất trong buffer
+        self._attempts: Dict[str, int] = {t: 0 for t in self.tabs}
+        self._retry_at: Dict[str, float] = {t: 0.0 for t in self.tabs}
+        self._spill_lock = threading.Lock()
+        self._has_spill = False
+        self._replayed_sig: Optional[Tuple[int, float]] = None  # file .replay đã nạp nhưng chưa xoá được
+        self._lock = threading.Lock()
+        self.latency_ewma = 0.0
+        self.stats = {
+            "written": 0, "batches": 0, "failed": 0, "spilled": 0, "replayed": 0, "dropped": 0,
+            "flush_ms_last": 0.0, "flush_ms_max": 0.0,
+        }
 
-    while True:
+    # ---------- sizing ----------
+    def batch_target(self) -> int:
+        """Sheets chậm → batch lớn hơn (ít lần gọi hơn), tối đa LOG_BATCH_MAX"""
+        scale = max(1.0, self.latency_ewma * 1000 / max(1, LOG_LATENCY_TARGET_MS))
+        return max(1, min(LOG_BATCH_MAX, int(LOG_BATCH_SIZE * scale)))
+
+    def flush_interval(self) -> float:
+        """Không để 1 tab tốn quá ~1/2 thời gian cho append_rows"""
+        return max(LOG_BATCH_INTERVAL, self.latency_ewma * 2)
+
+    # ---------- buffer ----------
+    def add(self, tab: str, rows: List[list], ts: Optional[float] = None) -> None:
+        buf = self._buffers.get(tab)
+        if buf is None:
+            print(f"[LOG] Bỏ {len(rows)} dòng tab lạ: {tab}")
+            with self._lock:
+                self.stats["dropped"] += len(rows)
+            return
+        if not buf:
+            self._first_ts[tab] = ts or time.time()
+        buf.extend(rows)
+        if len(buf) > LOG_BUFFER_MAX:
+            # Sheets hỏng lâu → không giữ vô hạn trong RAM
+            overflow = buf[:len(buf) - LOG_BUFFER_MAX]
+            del buf[:len(overflow)]
+            self._spill(tab, overflow)
+
+    def pending(self) -> int:
+        return sum(len(b) for b in self._buffers.values())
+
+    def due_in(self, current: float) -> float:
+        """Số giây tới lần flush gần nhất (LOG_BATCH_INTERVAL nếu không có gì chờ)"""
+        wait = float(LOG_BATCH_INTERVAL)
+        interval, target = self.flush_interval(), self.batch_target()
+        for tab, buf in self._buffers.items():
+            if not buf:
+                continue
+            at = self._first_ts.get(tab, current) + interval
+            if len(buf) >= target:
+                at = current
+            wait = min(wait, max(at, self._retry_at[tab]) - current)
+        return max(0.05, wait)
+
+    # ---------- flush ----------
+    def flush_due(self, force: bool = False) -> int:
+        current = time.time()
+        interval, target = self.flush_interval(), self.batch_target()
+        written = 0
+        for tab, buf in self._buffers.items():
+            if not buf or current < self._retry_at[tab]:
+                continue
+            if force or len(buf) >= target or current - self._first_ts.get(tab, current) >= interval:
+                written += self._flush_tab(tab)
+        return written
+
+    def _flush_tab(self, tab: str) -> int:
+        buf = self._buffers[tab]
+        chunk = buf[:LOG_BATCH_MAX]
+        t0 = time.perf_counter()
         try:
-            # Lấy item từ queue (timeout 0.5s)
-            item = log_queue.get(timeout=0.5)
-
-            log_type = item.get("type")
-            data = item.get("data")
-
-            if log_type == "check":
-                buffer_check.append(data)
-            elif log_type == "spam":
-                buffer_spam.append(data)
-            elif log_type == "qr":
-                buffer_qr.append(data)
+            self.write_rows(tab, chunk)
+        except Exception as e:
+            elapsed = time.perf_counter() - t0
+            self._attempts[tab] += 1
+            attempt = self._attempts[tab]
+            with self._lock:
+                self.stats["failed"] += 1
+            if attempt >= LOG_RETRY_MAX:
+                print(f"[LOG] {tab}: lỗi {attempt} lần liên tiếp → spill {len(chunk)} dòng: {e}")
+                del buf[:len(chunk)]
+                self._spill(tab, chunk)
+                self._attempts[tab] = 0
+                delay = LOG_RETRY_MAX_DELAY
+            else:
+                delay = min(LOG_RETRY_MAX_DELAY, 2 ** (attempt - 1)) * random.uniform(0.8, 1.2)
+                print(f"[LOG] {tab}: lỗi ghi {len(chunk)} dòng (lần {attempt}), thử lại sau {delay:.1f}s: {e}")
+            self._retry_at[tab] = time.time() + delay
+            self._observe(max(elapsed, LOG_LATENCY_TARGET_MS / 500))  # lỗi (quota) → giãn batch
+            return 0
+
+        elapsed = time.perf_counter() - t0
+        del buf[:len(chunk)]
+        if buf:
+            self._first_ts[tab] = time.time() - self.flush_interval()  # phần còn lại đến hạn ngay
+        self._attempts[tab] = 0
+        self._retry_at[tab] = 0.0
+        self._observe(elapsed)
+        with self._lock:
+            self.stats["written"] += len(chunk)
+            self.stats["batches"] += 1
+            self.stats["flush_ms_max"] = max(self.stats["flush_ms_max"], round(elapsed * 1000, 1))
+        print(f"[LOG] Flushed {len(chunk)} {tab} logs ({elapsed * 1000:.0f}ms)")
+
+        if self._has_spill:
+            # Sheets đã ghi được lại → tab đang backoff thử ngay + nạp phần đã spill
+            for t in self.tabs:
+                self._retry_at[t] = 0.0
+            self.replay_spill()
+        return len(chunk)
+
+    def _observe(self, seconds: float) -> None:
+        self.latency_ewma = seconds if not self.latency_ewma else 0.7 * self.latency_ewma + 0.3 * seconds
+        with self._lock:
+            self.stats["flush_ms_last"] = round(seconds * 1000, 1)
+
+    # ---------- spill ----------
+    def _spill(self, tab: str, rows: List[list]) -> None:
+        if not self.spill_path:
+            print(f"[LOG] ⚠️ Không có LOG_SPILL_FILE → mất {len(rows)} dòng {tab}")
+            with self._lock:
+                self.stats["dropped"] += len(rows)
+            return
+        try:
+            with self._spill_lock, open(self.spill_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"tab": tab, "ts": time.time(), "rows": rows}, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self._has_spill = True
+            with self._lock:
+                self.stats["spilled"] += len(rows)
+        except Exception as e:
+            print(f"[LOG] ⚠️ Spill lỗi → mất {len(rows)} dòng {tab}: {e}")
+            with self._lock:
+                self.stats["dropped"] += len(rows)
+
+    def replay_spill(self, on_rows=None) -> int:
+        """Nạp lại file spill vào buffer (đổi tên trước khi đọc → batch spill mới không bị mất)"""
+        if not self.spill_path:
+            return 0
+        replay_path = self.spill_path + ".replay"
+        with self._spill_lock:
+            self._has_spill = False
+            try:
+                if os.path.exists(self.spill_path) and not os.path.exists(replay_path):
+                    os.replace(self.spill_path, replay_path)
+            except Exception as e:
+                print(f"[LOG] Không đổi tên được file spill: {e}")
+                return 0
 
-        except Exception:
-            # Timeout → Không có item mới
-            pass
+        if not os.path.exists(replay_path):
+            return 0
 
-        # Kiểm tra điều kiện flush
-        current_time = time.time()
-        should_flush = (
-            len(buffer_check) >= LOG_BATCH_SIZE or
-            len(buffer_spam) >= LOG_BATCH_SIZE or
-            len(buffer_qr) >= LOG_BATCH_SIZE or
-            (current_time - last_flush) >= LOG_BATCH_INTERVAL
-        )
+        # ✅ Đọc hết file trước khi nạp → lỗi đọc giữa chừng không để lại nửa file trong buffer
+        records: List[Dict[str, Any]] = []
+        try:
+            st = os.stat(replay_path)
+            sig = (st.st_size, st.st_mtime)
+            if sig != self._replayed_sig:
+                with open(replay_path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            records.append(json.loads(line))
+                        except ValueError:
+                            continue  # dòng ghi dở khi process bị kill
+        except Exception as e:
+            print(f"[LOG] Replay spill lỗi (giữ file, thử lại sau): {e}")
+            return 0
 
-        if should_flush:
-            # Flush buffer_check
-            if buffer_check:
+        total = 0
+        for rec in records:
+            tab, rows = rec.get("tab"), rec.get("rows") or []
+            if on_rows:
                 try:
-                    ws_log_check.append_rows(
-                        buffer_check,
-                        value_input_option="USER_ENTERED"
-                    )
-                    print(f"[LOG] Flushed {len(buffer_check)} check logs")
+                    on_rows(tab, rows)
                 except Exception as e:
-                    print(f"[LOG] Error flushing check: {e}")
-                buffer_check.clear()
+                    print(f"[LOG] Replay on_rows lỗi: {e}")
+            self.add(tab, rows, rec.get("ts"))
+            total += len(rows)
 
-            # Flush buffer_spam
-            if buffer_spam:
-                try:
-                    ws_log_spam.append_rows(
-                        buffer_spam,
-                        value_input_option="USER_ENTERED"
-                    )
-                    print(f"[LOG] Flushed {len(buffer_spam)} spam logs")
-                except Exception as e:
-                    print(f"[LOG] Error flushing spam: {e}")
-                buffer_spam.clear()
+        # Xoá sau khi đã nạp đủ; xoá lỗi → nhớ chữ ký file để lần sau không nạp lặp
+        try:
+            os.remove(replay_path)
+            if self._replayed_sig is not None:
+                self._replayed_sig = None
+                self._has_spill = os.path.exists(self.spill_path)  # spill mới bị chặn vì file cũ → nạp lượt sau
+        except Exception as e:
+            self._replayed_sig = sig
+            print(f"[LOG] Không xoá được {replay_path} (đã nạp, lần sau bỏ qua): {e}")
+
+        if total:
+            with self._lock:
+                self.stats["replayed"] += total
+            print(f"[LOG] Replay {total} dòng từ {self.spill_path}")
+        return total
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            out = dict(self.stats)
+        out["queue"] = log_queue.qsize()
+        out["buffered"] = {t: len(b) for t, b in self._buffers.items()}
+        out["depth"] = out["queue"] + sum(out["buffered"].values())
+        out["flush_ms_avg"] = round(self.latency_ewma * 1000, 1)
+        out["batch_target"] = self.batch_target()
+        out["interval"] = round(self.flush_interval(), 2)
+        out["spill_pending"] = self._has_spill
+        return out
+
+def _append_log_rows(tab: str, rows: List[list]) -> None:
+    store.append_logs(tab, rows)
+
+log_writer = LogWriter(_append_log_rows, LOG_SPILL_FILE)
+
+def _count_replayed_checks(tab: str, rows: List[list]) -> None:
+    """Dòng check spill từ lần chạy trước chưa có trên LogsCheck → cộng vào bộ đếm hôm nay"""
+    if tab != "check":
+        return
+    today = now().strftime("%Y-%m-%d")
+    for row in rows:
+        if row and safe_text(row[0]).startswith(today) and len(row) > 1:
+            _inc_today_request(row[1])
 
-            # Flush buffer_qr
-            if buffer_qr:
-                try:
-                    ws_log_qr.append_rows(
-                        buffer_qr,
-                        value_input_option="USER_ENTERED"
-                    )
-                    print(f"[LOG] Flushed {len(buffer_qr)} QR logs")
-                except Exception as e:
-                    print(f"[LOG] Error flushing QR: {e}")
-                buffer_qr.clear()
+def log_worker():
+    """
+    Worker thread xử lý batch ghi log
+    Gom log → Ghi 1 lần / tab khi:
+    - Đủ batch_target dòng (tự tăng khi Sheets chậm)
+    - Hoặc dòng cũ nhất đã chờ quá flush_interval
+    """
+    print("[LOG] Batch log worker started")
+    # Chưa ghi dòng nào trước khi seed đọc LogsCheck → không đếm trùng
+    # Seed treo (Sheets không trả lời) → chờ có hạn rồi vẫn ghi, tránh log dồn mãi trong queue
+    if not daily_seeded.wait(timeout=DAILY_SEED_WAIT * 6):
+        print(f"[LOG] ⚠️ Seed bộ đếm ngày quá {DAILY_SEED_WAIT * 6:.0f}s → bắt đầu ghi log (bộ đếm hôm nay có thể lệch)")
+    log_writer.replay_spill(on_rows=_count_replayed_checks)
 
-            last_flush = current_time
+    while True:
+        try:
+            item = log_queue.get(timeout=log_writer.due_in(time.time()))
+            log_writer.add(item.get("type"), [item.get("data")])
+            # Gom hết phần đang chờ trong queue trước khi quyết định flush
+            while True:
+                item = log_queue.get_nowait()
+                log_writer.add(item.get("type"), [item.get("data")])
+        except Empty:
+            pass
+        except Exception as e:
+            print(f"[LOG] Worker lỗi: {e}")
+
+        try:
+            log_writer.flush_due()
+        except Exception as e:
+            print(f"[LOG] Flush lỗi: {e}")
 
 # =========================================================
 # BOT 1 API INTEGRATION
@@ -752,7 +1937,7 @@ def check_balance_bot1(user_id: int) -> tuple:
         return True, 999999, ""
 
     try:
-        response = requests.post(
+        response = http_post(
             f"{BOT1_API_URL}/api/check_balance",
             json={"user_id": user_id},
             timeout=10
@@ -766,13 +1951,21 @@ def check_balance_bot1(user_id: int) -> tuple:
     except Exception as e:
         return False, 0, str(e)
 
-def deduct_balance_bot1(user_id: int, amount: int, reason: str, username: str = "") -> tuple:
-    """Deduct money from Bot 1"""
+def deduct_balance_bot1(user_id: int, amount: int, reason: str, username: str = "", op_key: str = "") -> tuple:
+    """
+    Deduct money from Bot 1
+    op_key: khóa idempotent — cùng 1 op_key chỉ trừ tiền 1 lần (lần sau trả số dư hiện tại)
+    """
     if not BOT1_API_URL:
         return True, 999999, ""
 
+    pay_key = f"pay:{op_key}" if op_key else ""
+    if pay_key and not _claim_pay_key(pay_key, user_id):
+        print(f"[DEDUP] Bỏ qua trừ tiền trùng: {op_key}")
+        return check_balance_bot1(user_id)
+
     try:
-        response = requests.post(
+        response = http_post(
             f"{BOT1_API_URL}/api/deduct",
             json={
                 "user_id": user_id,
@@ -787,10 +1980,36 @@ def deduct_balance_bot1(user_id: int, amount: int, reason: str, username: str =
         if response.status_code == 200 and data.get("success"):
             return True, data.get("new_balance", 0), ""
         else:
+            if pay_key:
+                _release_pay_key(pay_key)
             return False, data.get("balance", 0), data.get("error", "Unknown error")
     except Exception as e:
+        # Không chắc Bot1 đã trừ hay chưa khi timeout đọc → giữ key nếu request đã gửi đi
+        if pay_key and not isinstance(e, requests.exceptions.ReadTimeout):
+            _release_pay_key(pay_key)
         return False, 0, str(e)
 
+def _claim_pay_key(pay_key: str, user_id: Any) -> bool:
+    """
+    Giữ key trừ tiền: RAM trước (nhanh, cùng instance) rồi store dùng chung (Sheet / SQLite)
+    → Telegram gửi lại sang instance khác / sau restart vẫn không trừ 2 lần
+    """
+    if not dedup_store.add_if_new(pay_key):
+        return False
+    try:
+        return store.claim_pay_key(pay_key, safe_text(user_id))  # False: key đã có → giữ luôn trong RAM
+    except Exception as e:
+        print(f"[DEDUP] ⚠️ Không ghi được key trừ tiền vào store ({e}) → chỉ chống trùng trong RAM")
+        return True
+
+def _release_pay_key(pay_key: str) -> None:
+    """Trừ tiền chắc chắn không xảy ra → nhả key để lần sau trừ lại được"""
+    dedup_store.discard(pay_key)
+    try:
+        store.release_pay_key(pay_key)
+    except Exception as e:
+        print(f"[DEDUP] ⚠️ Không xoá được key trừ tiền {pay_key}: {e}")
+
 def format_insufficient_balance_msg(balance: int, required: int) -> str:
     """Format insufficient balance message"""
     return (
@@ -817,7 +2036,7 @@ def check_shopee_orders_with_payment(cookie: str, user_id: int, username: str =
         balance = 0
 
     # ✅ FIX: tách rõ result và error
-    result_html, err = check_shopee_orders(cookie)
+    result_html, err = check_shopee_orders(cookie, owner=user_id)
 
     if err:
         if err == "cookie_expired":
@@ -927,38 +2146,88 @@ def esc(s: str) -> str:
 # =========================================================
 # WORKSHEET HELPER
 # =========================================================
-def get_or_create_worksheet(title: str, headers: List[str]):
+# {key: (tên tab, header cần có — None = tab phải có sẵn, (rows, cols) khi tạo mới)}
+SHEET_TABS = {
+    "users": (TAB_USERS, None, None),
+    "cookie": ("Cookie", None, None),
+    "check": (TAB_LOGS_CHECK, ["time", "Tele ID", "username", "value", "balance_sau", "note"], ("5000", "20")),
+    "spam": (TAB_LOGS_SPAM, ["time", "Tele ID", "username", "count_minute", "strike", "band"], ("5000", "20")),
+    "qr": (TAB_LOGS_QR, ["time", "Tele ID", "username", "session_id", "status", "balance_sau", "note"], ("5000", "20")),
+    "broadcast": ("BroadcastState", ["Timestamp", "AdminID", "Status", "MessageID", "Progress", "Content"], (100, 6)),
+}
+if BOT1_API_URL:
+    SHEET_TABS["paykeys"] = ("PayKeys", ["key", "time", "Tele ID"], ("5000", "3"))
+_ws_handles: Dict[str, Any] = {}
+_ws_locks = {key: threading.Lock() for key in SHEET_TABS}
+
+def _sheet_worksheets() -> Dict[str, Any]:
+    """Danh sách tab đọc 1 lần (thay vì sh.worksheets() cho từng tab)"""
+    with _sheet_connect_lock:
+        titles = _sheet_state["titles"]
+    if titles is not None:
+        return titles
+    sh = get_spreadsheet()
+    t0 = time.perf_counter()
+    listed = {ws.title.strip(): ws for ws in sh.worksheets()}
+    with _sheet_connect_lock:
+        if _sheet_state["titles"] is None:
+            _sheet_state["titles"] = listed
+            _boot_bg("list worksheets", t0)
+        return _sheet_state["titles"]
+
+def get_or_create_worksheet(title: str, headers: List[str], size=("5000", "20")):
     title = (title or "").strip()
-    for ws in sh.worksheets():
-        if ws.title.strip() == title:
-            try:
-                first = ws.row_values(1)
-                if not first or all((c.strip() == "" for c in first)):
-                    ws.update("A1", [headers])
-            except Exception:
-                pass
-            return ws
+    ws = _sheet_worksheets().get(title)
+    if ws is not None:
+        try:
+            first = ws.row_values(1)
+            if not first or all((c.strip() == "" for c in first)):
+                ws.update("A1", [headers])
+        except Exception:
+            pass
+        return ws
 
-    ws = sh.add_worksheet(title=title, rows="5000", cols="20")
+    ws = get_spreadsheet().add_worksheet(title=title, rows=size[0], cols=size[1])
     ws.update("A1", [headers])
+    with _sheet_connect_lock:
+        _sheet_state["titles"][title] = ws
     return ws
 
-ws_user = sh.worksheet(TAB_USERS)
+def sheet_ws(key: str):
+    """Handle worksheet theo key trong SHEET_TABS — tạo lần đầu dùng rồi giữ lại (lỗi → lần sau thử lại)"""
+    ws = _ws_handles.get(key)
+    if ws is not None:
+        return ws
+    with _ws_locks[key]:
+        if key not in _ws_handles:
+            title, headers, size = SHEET_TABS[key]
+            if headers is None:
+                ws = _sheet_worksheets().get(title.strip())
+                if ws is None:
+                    ws = get_spreadsheet().worksheet(title)  # raise WorksheetNotFound như trước
+            else:
+                ws = get_or_create_worksheet(title, headers, size)
+            _ws_handles[key] = ws
+    return _ws_handles[key]
 
-ws_log_check = get_or_create_worksheet(
-    TAB_LOGS_CHECK,
-    ["time", "Tele ID", "username", "value", "balance_sau", "note"]
-)
+def warm_sheets() -> int:
+    """Mở sẵn mọi tab song song (connect + list 1 lần, đọc header từng tab cùng lúc)"""
+    t0 = time.perf_counter()
+    get_spreadsheet()
+    _sheet_worksheets()
 
-ws_log_spam = get_or_create_worksheet(
-    TAB_LOGS_SPAM,
-    ["time", "Tele ID", "username", "count_minute", "strike", "band"]
-)
+    def one(key: str) -> bool:
+        try:
+            sheet_ws(key)
+            return True
+        except Exception as e:
+            print(f"[SHEETS] ⚠️ Tab {SHEET_TABS[key][0]}: {e}")
+            return False
 
-ws_log_qr = get_or_create_worksheet(
-    TAB_LOGS_QR,
-    ["time", "Tele ID", "username", "session_id", "status", "balance_sau", "note"]
-)
+    with ThreadPoolExecutor(max_workers=len(SHEET_TABS), thread_name_prefix="sheets-init") as ex:
+        ok = sum(ex.map(one, SHEET_TABS))
+    _boot_bg("warm worksheets", t0)
+    return ok
 
 # =========================================================
 # SHEET SAFE READ
@@ -997,18 +2266,409 @@ def ws_has_headers(ws, required: List[str]) -> bool:
     return all((_normalize_header(x) in norm) for x in required)
 
 # =========================================================
-# USER CACHE (giữ nguyên)
+# STORAGE BACKEND (sheets | sqlite)
 # =========================================================
-def get_all_users_cached():
+class SheetStore:
+    """Đọc / ghi thẳng Google Sheets (mỗi lệnh 1 lượt HTTPS) — lỗi thì raise, caller tự xử lý"""
+
+    name = "sheets"
+
+    def user_rows(self) -> List[Tuple[int, List[str]]]:
+        values = sheet_ws("users").get_all_values() or []
+        return list(enumerate(values[1:], start=2))
+
+    def read_note(self, row_idx: int) -> str:
+        # Cột E = index 5 (1-based) trong gspread
+        return sheet_ws("users").cell(row_idx, COL_NOTE_INDEX).value or ""
+
+    def write_notes(self, batch: Dict[int, str]) -> None:
+        sheet_ws("users").batch_update([
+            {"range": gspread.utils.rowcol_to_a1(row_idx, COL_NOTE_INDEX), "values": [[value]]}
+            for row_idx, value in sorted(batch.items())
+        ])
+
+    def append_logs(self, tab: str, rows: List[list]) -> None:
+        sheet_ws(tab).append_rows(rows, value_input_option="USER_ENTERED")
+
+    def count_checks(self, day: str) -> Dict[str, int]:
+        ws_log_check = sheet_ws("check")
+        rows = []
+        try:
+            if ws_has_headers(ws_log_check, ["time", "Tele ID"]):
+                rows = [
+                    (safe_text(r.get("time")), safe_text(r.get("Tele ID")))
+                    for r in ws_log_check.get_all_records()
+                ]
+        except Exception:
+            rows = []
+
+        if not rows:
+            rows = [
+                (safe_text(r.get("time")), safe_text(r.get("tele id")))
+                for r in ws_get_all_records_safe(ws_log_check)
+            ]
+
+        counts: Dict[str, int] = {}
+        for t, tid in rows:
+            tid = normalize_tele_id(tid)
+            if tid and t.startswith(day):
+                counts[tid] = counts.get(tid, 0) + 1
+        return counts
+
+    def check_rows(self, day: str) -> List[list]:
+        """Dòng LogsCheck của ngày day (cột A = time) — dùng khi import sang SQLite"""
+        values = sheet_ws("check").get_all_values() or []
+        return [r for r in values[1:] if r and safe_text(r[0]).startswith(day)]
+
+    def cookie_values(self) -> List[str]:
+        return sheet_ws("cookie").col_values(1) or []
+
+    def broadcast_rows(self) -> List[List[str]]:
+        ws = get_broadcast_sheet()
+        if not ws:
+            raise RuntimeError("BroadcastState sheet unavailable")
+        return (ws.get_all_values() or [])[1:]
+
+    def append_broadcast(self, row: List[str]) -> None:
+        ws = get_broadcast_sheet()
+        if not ws:
+            raise RuntimeError("BroadcastState sheet unavailable")
+        ws.append_row(row)
+
+    def broadcast_has_message(self, message_id: str) -> bool:
+        ws = get_broadcast_sheet()
+        if not ws:
+            raise RuntimeError("BroadcastState sheet unavailable")
+        return str(message_id) in ws.col_values(4)
+
+    def claim_pay_key(self, key: str, tele_id: str) -> bool:
+        """Ghi key trừ tiền lên tab PayKeys (dùng chung mọi instance) → False nếu key đã có"""
+        ws = sheet_ws("paykeys")
+        if key in ws.col_values(1):
+            return False
+        ws.append_row([key, now().strftime("%Y-%m-%d %H:%M:%S"), tele_id])
+        return True
+
+    def release_pay_key(self, key: str) -> None:
+        ws = sheet_ws("paykeys")
+        col = ws.col_values(1)
+        if key in col:
+            ws.delete_rows(col.index(key) + 1)
+
+class SQLiteStore:
     """
-    ⚠️ DEPRECATED: Không dùng nữa vì get_user_row đọc trực tiếp
-    Giữ lại để không break code khác
+    Cùng thao tác với SheetStore nhưng trên SQLite (WAL) cục bộ → mili-giây thay vì vài trăm ms / lệnh
+    mirror (SheetStore) != None:
+    - Ghi của bot (note, log, broadcast) vào bảng outbox → mirror_push() đẩy gom lên Sheet cho admin đọc
+    - mirror_pull() kéo user + cookie admin sửa trên Sheet về
     """
-    return []
 
-def get_user_row(tele_id: Any) -> Tuple[Optional[int], Optional[Dict[str, Any]]]:
+    name = "sqlite"
+    LOG_TABS = ("check", "spam", "qr")
+
+    def __init__(self, path: str, mirror: Optional[SheetStore] = None):
+        self.path = path
+        self.mirror = mirror
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        for ddl in (
+            # Giữ đúng số dòng trên Sheet (row_idx) → note / mirror map 1-1 với tab Thanh Toan
+            "CREATE TABLE IF NOT EXISTS users ("
+            " row_idx INTEGER PRIMARY KEY, tele_id TEXT NOT NULL, username TEXT NOT NULL DEFAULT '',"
+            " balance TEXT NOT NULL DEFAULT '0', status TEXT NOT NULL DEFAULT '', note TEXT NOT NULL DEFAULT '')",
+            "CREATE INDEX IF NOT EXISTS idx_users_tele ON users(tele_id)",
+            "CREATE TABLE IF NOT EXISTS logs ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, tab TEXT NOT NULL, time TEXT NOT NULL,"
+            " tele_id TEXT NOT NULL, row TEXT NOT NULL)",
+            "CREATE INDEX IF NOT EXISTS idx_logs_tab_time ON logs(tab, time)",
+            "CREATE INDEX IF NOT EXISTS idx_logs_tele_time ON logs(tele_id, time)",
+            "CREATE TABLE IF NOT EXISTS broadcast_state ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, ts TEXT NOT NULL, admin_id TEXT NOT NULL,"
+            " status TEXT NOT NULL, message_id TEXT NOT NULL, progress TEXT NOT NULL, content TEXT NOT NULL)",
+            "CREATE INDEX IF NOT EXISTS idx_broadcast_mid ON broadcast_state(message_id)",
+            "CREATE TABLE IF NOT EXISTS cookies (pos INTEGER PRIMARY KEY, cookie TEXT NOT NULL)",
+            "CREATE TABLE IF NOT EXISTS mirror_outbox ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, payload TEXT NOT NULL)",
+            "CREATE TABLE IF NOT EXISTS pay_keys (key TEXT PRIMARY KEY, ts TEXT NOT NULL, tele_id TEXT NOT NULL)",
+        ):
+            self._db.execute(ddl)
+
+    def _outbox_locked(self, kind: str, payload: Any) -> None:
+        if self.mirror is not None:
+            self._db.execute(
+                "INSERT INTO mirror_outbox (kind, payload) VALUES (?, ?)",
+                (kind, json.dumps(payload, ensure_ascii=False))
+            )
+
+    def _write(self, fn) -> Any:
+        """1 transaction cho dữ liệu + outbox (mirror không bao giờ lệch dữ liệu)"""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                out = fn()
+                self._db.execute("COMMIT")
+                return out
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    # ---------- users / notes ----------
+    def user_rows(self) -> List[Tuple[int, List[str]]]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT row_idx, tele_id, username, balance, status, note FROM users ORDER BY row_idx"
+            ).fetchall()
+        return [(r[0], list(r[1:])) for r in rows]
+
+    def read_note(self, row_idx: int) -> str:
+        with self._lock:
+            row = self._db.execute("SELECT note FROM users WHERE row_idx = ?", (row_idx,)).fetchone()
+        return row[0] if row else ""
+
+    def write_notes(self, batch: Dict[int, str]) -> None:
+        def fn():
+            self._db.executemany(
+                "UPDATE users SET note = ? WHERE row_idx = ?",
+                [(value, row_idx) for row_idx, value in batch.items()]
+            )
+            self._outbox_locked("note", {str(k): v for k, v in batch.items()})
+        self._write(fn)
+
+    # ---------- logs ----------
+    def append_logs(self, tab: str, rows: List[list]) -> None:
+        if tab not in self.LOG_TABS:
+            raise KeyError(tab)
+
+        def fn():
+            self._db.executemany(
+                "INSERT INTO logs (tab, time, tele_id, row) VALUES (?, ?, ?, ?)",
+                [(tab, safe_text(r[0]) if r else "", normalize_tele_id(r[1]) if len(r) > 1 else "",
+                  json.dumps(r, ensure_ascii=False)) for r in rows]
+            )
+            self._outbox_locked("log", {"tab": tab, "rows": rows})
+        self._write(fn)
+
+    def count_checks(self, day: str) -> Dict[str, int]:
+        # time dạng "YYYY-mm-dd HH:MM:SS" → range trên index (tab, time)
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT tele_id, COUNT(*) FROM logs WHERE tab = 'check' AND time >= ? AND time < ?"
+                " AND tele_id != '' GROUP BY tele_id",
+                (day, day + "~")
+            ).fetchall()
+        return {tid: cnt for tid, cnt in rows}
+
+    # ---------- cookie pool ----------
+    def cookie_values(self) -> List[str]:
+        with self._lock:
+            return [r[0] for r in self._db.execute("SELECT cookie FROM cookies ORDER BY pos")]
+
+    # ---------- broadcast ----------
+    def broadcast_rows(self) -> List[List[str]]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT ts, admin_id, status, message_id, progress, content FROM broadcast_state ORDER BY id"
+            ).fetchall()
+        return [list(r) for r in rows]
+
+    def append_broadcast(self, row: List[str]) -> None:
+        row = [safe_text(c) for c in (list(row) + [""] * 6)[:6]]
+
+        def fn():
+            self._db.execute(
+                "INSERT INTO broadcast_state (ts, admin_id, status, message_id, progress, content)"
+                " VALUES (?, ?, ?, ?, ?, ?)", row
+            )
+            self._outbox_locked("broadcast", row)
+        self._write(fn)
+
+    def broadcast_has_message(self, message_id: str) -> bool:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT 1 FROM broadcast_state WHERE message_id = ? LIMIT 1", (str(message_id),)
+            ).fetchone()
+        return row is not None
+
+    # ---------- key trừ tiền ----------
+    def claim_pay_key(self, key: str, tele_id: str) -> bool:
+        with self._lock:
+            cur = self._db.execute(
+                "INSERT OR IGNORE INTO pay_keys (key, ts, tele_id) VALUES (?, ?, ?)",
+                (key, now().strftime("%Y-%m-%d %H:%M:%S"), tele_id)
+            )
+            return cur.rowcount == 1
+
+    def release_pay_key(self, key: str) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM pay_keys WHERE key = ?", (key,))
+
+    # ---------- mirror ----------
+    def is_empty(self) -> bool:
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM users LIMIT 1").fetchone() is None
+
+    def outbox_size(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM mirror_outbox").fetchone()[0]
+
+    def import_history(self, sheet: SheetStore, day: str) -> Tuple[int, int]:
+        """
+        Lần đầu chuyển sang SQLite: chép log check hôm nay + BroadcastState từ Sheet
+        (không có → bộ đếm FREE_LIMIT_PER_DAY về 0, mất cooldown / resume / chống gửi trùng broadcast)
+        Dữ liệu đã có trên Sheet → không vào outbox; xoá bản import dở trước đó → chạy lại không nhân đôi
+        """
+        checks = sheet.check_rows(day)
+        try:
+            broadcasts = sheet.broadcast_rows()
+        except Exception as e:
+            print(f"[STORE] Không đọc được BroadcastState: {e}")
+            broadcasts = None
+
+        def fn():
+            self._db.execute(
+                "DELETE FROM logs WHERE tab = 'check' AND time >= ? AND time < ?", (day, day + "~")
+            )
+            self._db.executemany(
+                "INSERT INTO logs (tab, time, tele_id, row) VALUES ('check', ?, ?, ?)",
+                [(safe_text(r[0]), normalize_tele_id(r[1]) if len(r) > 1 else "",
+                  json.dumps(r, ensure_ascii=False)) for r in checks]
+            )
+            if broadcasts is not None:
+                self._db.execute("DELETE FROM broadcast_state")
+                self._db.executemany(
+                    "INSERT INTO broadcast_state (ts, admin_id, status, message_id, progress, content)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    [[safe_text(c) for c in (list(r) + [""] * 6)[:6]] for r in broadcasts]
+                )
+            return len(checks), len(broadcasts or [])
+        return self._write(fn)
+
+    def mirror_pull(self, sheet: SheetStore) -> Tuple[int, int]:
+        """
+        Kéo tab Thanh Toan + Cookie từ Sheet (admin thêm user / sửa tay)
+        Note của dòng còn chờ đẩy lên Sheet giữ bản SQLite (mới hơn bản trên Sheet)
+        Không mirror: note bot ghi không bao giờ lên Sheet → luôn giữ note SQLite của dòng đã có
+        """
+        users = sheet.user_rows()
+        try:
+            cookies = [c for c in sheet.cookie_values() if (c or "").strip()]
+        except Exception as e:
+            print(f"[STORE] Không đọc được tab Cookie: {e}")
+            cookies = None
+
+        def fn():
+            pending = set()
+            for (payload,) in self._db.execute("SELECT payload FROM mirror_outbox WHERE kind = 'note'"):
+                pending.update(int(k) for k in json.loads(payload))
+            rows = []
+            for row_idx, row in users:
+                if len(row) < 4:  # giống _parse_user_row: thiếu cột → không phải user
+                    continue
+                row = [safe_text(c) for c in (list(row) + [""] * 5)[:5]]
+                rows.append((row_idx, row))
+            keep = [r[0] for r in rows]
+            self._db.execute("CREATE TEMP TABLE IF NOT EXISTS _keep (row_idx INTEGER PRIMARY KEY)")
+            self._db.execute("DELETE FROM _keep")
+            self._db.executemany("INSERT INTO _keep VALUES (?)", [(i,) for i in keep])
+            self._db.execute("DELETE FROM users WHERE row_idx NOT IN (SELECT row_idx FROM _keep)")
+            self._db.executemany(
+                "INSERT INTO users (row_idx, tele_id, username, balance, status, note) VALUES (?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT(row_idx) DO UPDATE SET tele_id = excluded.tele_id, username = excluded.username,"
+                " balance = excluded.balance, status = excluded.status,"
+                " note = CASE WHEN ? OR users.row_idx IN (SELECT value FROM json_each(?))"
+                " THEN users.note ELSE excluded.note END",
+                [(i, r[0], r[1], r[2], r[3], r[4], self.mirror is None, json.dumps(sorted(pending))) for i, r in rows]
+            )
+            if cookies is not None:
+                self._db.execute("DELETE FROM cookies")
+                self._db.executemany("INSERT INTO cookies (pos, cookie) VALUES (?, ?)", list(enumerate(cookies)))
+            return len(rows), len(cookies or [])
+        return self._write(fn)
+
+    def mirror_push(self, sheet: SheetStore, limit: int = 2000) -> int:
+        """Đẩy outbox lên Sheet: gom log theo tab (1 append_rows / tab), note gộp 1 batch_update"""
+        with self._lock:
+            items = self._db.execute(
+                "SELECT id, kind, payload FROM mirror_outbox ORDER BY id LIMIT ?", (limit,)
+            ).fetchall()
+        if not items:
+            return 0
+
+        groups: Dict[str, Dict[str, Any]] = {}
+        for item_id, kind, payload in items:
+            data = json.loads(payload)
+            key = f"log:{data['tab']}" if kind == "log" else kind
+            g = groups.setdefault(key, {"ids": [], "rows": [], "notes": {}})
+            g["ids"].append(item_id)
+            if kind == "log":
+                g["rows"].extend(data["rows"])
+            elif kind == "note":
+                g["notes"].update({int(k): v for k, v in data.items()})  # id tăng dần → bản mới nhất thắng
+            else:
+                g["rows"].append(data)
+
+        done: List[int] = []
+        for key, g in groups.items():
+            try:
+                if key == "broadcast":
+                    # ✅ 1 mục = 1 dòng, đánh dấu từng mục ngay khi ghi xong → lỗi giữa chừng không ghi lặp các dòng trước
+                    for item_id, row in zip(g["ids"], g["rows"]):
+                        sheet.append_broadcast(row)
+                        done.append(item_id)
+                    continue
+                if key.startswith("log:"):
+                    sheet.append_logs(key[4:], g["rows"])
+                elif key == "note":
+                    sheet.write_notes(g["notes"])
+                done.extend(g["ids"])
+            except Exception as e:
+                print(f"[STORE] Mirror {key} ({len(g['ids'])} mục) lỗi, thử lại sau: {e}")
+
+        if done:
+            with self._lock:
+                self._db.executemany("DELETE FROM mirror_outbox WHERE id = ?", [(i,) for i in done])
+        return len(done)
+
+def store_mirror_worker():
+    """
+    Thread đồng bộ SQLite ↔ Sheet: đẩy outbox mỗi STORE_MIRROR_INTERVAL (khi có mirror),
+    kéo user/cookie mỗi STORE_PULL_INTERVAL (luôn chạy → user admin thêm trên Sheet vào được bot)
     """
-    ✅ FIXED: Đọc theo INDEX cột thay vì tên (tránh lỗi header trùng)
+    last_pull = time.time()
+    while True:
+        time.sleep(STORE_MIRROR_INTERVAL if store.mirror is not None else STORE_PULL_INTERVAL)
+        if store.mirror is not None:
+            try:
+                store.mirror_push(store.mirror)
+            except Exception as e:
+                print(f"[STORE] Mirror push lỗi: {e}")
+
+        if time.time() - last_pull < STORE_PULL_INTERVAL:
+            continue
+        last_pull = time.time()
+        try:
+            store.mirror_pull(sheet_store)
+            invalidate_user_index()
+        except Exception as e:
+            print(f"[STORE] Mirror pull lỗi: {e}")
+
+sheet_store = SheetStore()
+if STORE_BACKEND == "sqlite":
+    store = SQLiteStore(STORE_PATH, sheet_store if STORE_SHEET_MIRROR else None)
+else:
+    store = sheet_store
+print(f"[STORE] ✅ Backend: {store.name}{' (' + STORE_PATH + ')' if store.name == 'sqlite' else ''}"
+      f"{', mirror → Sheet' if getattr(store, 'mirror', None) else ', kéo user / cookie từ Sheet' if store.name == 'sqlite' else ''}")
+_boot_mark("helpers + store")
+
+# =========================================================
+# USER CACHE (index theo Tele ID)
+# =========================================================
+def _parse_user_row(row: List[str]) -> Optional[Dict[str, Any]]:
+    """
+    ✅ Đọc theo INDEX cột thay vì tên (tránh lỗi header trùng)
 
     Sheet structure (by INDEX):
     - Cột 0 (A): Tele ID
@@ -1018,42 +2678,105 @@ def get_user_row(tele_id: Any) -> Tuple[Optional[int], Optional[Dict[str, Any]]]
     - Cột 4 (E): ghi Chú
     - Cột 5 (F): ghi Chú (trùng tên)
     """
+    if not row or len(row) < 4:  # Cần ít nhất 4 cột
+        return None
+
+    row_tele_id = normalize_tele_id(row[0])
+    if not row_tele_id:
+        return None
+
+    return {
+        "Tele ID": row_tele_id,
+        "username": safe_text(row[1]) if len(row) > 1 else "",
+        "balance": safe_text(row[2]) if len(row) > 2 else "0",
+        "trang thai": safe_text(row[3]).lower().strip() if len(row) > 3 else "",
+        "ghi chu": safe_text(row[4]) if len(row) > 4 else ""
+    }
+
+def refresh_user_index() -> bool:
+    """
+    Đọc toàn bộ tab Thanh Toan 1 lần → build index {tele_id: (row_idx, user_data)}
+    Trùng Tele ID: giữ dòng đầu tiên (giống cách scan tuần tự cũ)
+    """
+    fetch_started = time.time()
+    try:
+        rows = store.user_rows()
+    except Exception as e:
+        print(f"[USERS] Refresh index lỗi: {e}")
+        return False
+
+    index: Dict[str, Tuple[int, Dict[str, Any]]] = {}
+    for idx, row in rows:
+        user_data = _parse_user_row(row)
+        if user_data and user_data["Tele ID"] not in index:
+            index[user_data["Tele ID"]] = (idx, user_data)
+
+    # Note lấy luôn từ lần đọc này (admin sửa tay cột E cũng được nhận)
+    _seed_notes(index, fetch_started)
+
+    with user_cache_lock:
+        user_cache["data"] = index
+        user_cache["timestamp"] = time.time()
+
+    return True
+
+def invalidate_user_index() -> None:
+    """Đánh dấu index cũ → worker nền refresh ngay (gọi sau khi bot tự ghi sheet)"""
+    with user_cache_lock:
+        user_cache["timestamp"] = 0
+    user_cache_event.set()
+
+def _update_cached_user(row_idx: int, field: str, value: Any) -> None:
+    """Ghi xuyên (write-through) 1 field vào index để đọc ngay không phải chờ refresh"""
+    with user_cache_lock:
+        for _, (idx, user_data) in (user_cache["data"] or {}).items():
+            if idx == row_idx:
+                user_data[field] = value
+                break
+
+def user_index_worker():
+    """Thread refresh index user mỗi CACHE_USERS_SECONDS (hoặc sớm hơn khi bị invalidate)"""
+    while True:
+        refresh_user_index()
+        user_cache_event.wait(timeout=CACHE_USERS_SECONDS)
+        user_cache_event.clear()
+
+def get_all_users_cached() -> List[Tuple[int, Dict[str, Any]]]:
+    """Danh sách (row_idx, user_data) theo thứ tự dòng trong sheet"""
+    with user_cache_lock:
+        loaded = user_cache["data"] is not None
+    if not loaded:
+        refresh_user_index()
+
+    with user_cache_lock:
+        items = list((user_cache["data"] or {}).values())
+    return sorted(items, key=lambda x: x[0])
+
+def get_user_row(tele_id: Any) -> Tuple[Optional[int], Optional[Dict[str, Any]]]:
+    """
+    ✅ O(1): tra index trong RAM thay vì get_all_values() mỗi lần
+    - Lần đầu (chưa có index) → đọc sheet đồng bộ
+    - Miss → đọc lại sheet (tối đa 1 lần / USER_MISS_REFRESH_SECONDS) để nhận user mới thêm
+    """
     tele_id = normalize_tele_id(tele_id)
+    if not tele_id:
+        return None, None
 
     try:
-        # Lấy RAW data từ cache (không dùng get_all_records vì có header trùng)
-        try:
-            values = ws_user.get_all_values()
-        except Exception:
-            return None, None
+        with user_cache_lock:
+            index = user_cache["data"]
+            age = time.time() - user_cache["timestamp"]
 
-        if not values or len(values) < 2:
-            return None, None
+        if index is None:
+            refresh_user_index()
+        elif tele_id not in index and age > USER_MISS_REFRESH_SECONDS:
+            refresh_user_index()
 
-        # Duyệt từng row (bỏ qua header)
-        for idx, row in enumerate(values[1:], start=2):
-            if not row or len(row) < 4:  # Cần ít nhất 4 cột
-                continue
+        with user_cache_lock:
+            hit = (user_cache["data"] or {}).get(tele_id)
 
-            # Đọc theo INDEX
-            row_tele_id = normalize_tele_id(row[0]) if len(row) > 0 else ""  # Cột A
-            row_username = safe_text(row[1]) if len(row) > 1 else ""  # Cột B
-            row_balance = safe_text(row[2]) if len(row) > 2 else "0"  # Cột C
-            row_status = safe_text(row[3]) if len(row) > 3 else ""    # Cột D
-            row_note = safe_text(row[4]) if len(row) > 4 else ""      # Cột E
-
-            # So sánh Tele ID
-            if row_tele_id and tele_id and row_tele_id == tele_id:
-                # Return normalized data
-                user_data = {
-                    "Tele ID": row_tele_id,
-                    "username": row_username,
-                    "balance": row_balance,
-                    "trang thai": row_status.lower().strip(),  # Normalize status
-                    "ghi chu": row_note
-                }
-
-                return idx, user_data
+        if hit:
+            return hit[0], dict(hit[1])
 
     except Exception as e:
         print(f"[ERROR] get_user_row exception: {e}")
@@ -1064,21 +2787,85 @@ def get_user_row(tele_id: Any) -> Tuple[Optional[int], Optional[Dict[str, Any]]]
 def get_balance(user: Dict[str, Any]) -> int:
     return safe_int(user.get("balance", 0))
 
+def _seed_notes(index: Dict[str, Tuple[int, Dict[str, Any]]], fetch_started: float) -> None:
+    """
+    Nạp note từ ảnh chụp sheet vào note_cache
+    Bỏ qua dòng bot vừa tự đổi (chưa ghi / đang ghi / ghi xong sau lúc đọc) → không bị ghi đè bằng giá trị cũ
+    """
+    with note_lock:
+        for idx, user_data in index.values():
+            if idx in note_dirty or idx in note_inflight or note_touched.get(idx, 0) >= fetch_started:
+                continue
+            note_cache[idx] = user_data.get("ghi chu", "")
+        # Mốc cũ hơn lần đọc này không còn tác dụng
+        for idx in [i for i, ts in note_touched.items() if ts < fetch_started and i not in note_dirty]:
+            note_touched.pop(idx, None)
+
 def get_note(row_idx: int) -> str:
-    """Đọc cột E (index 4) - ghi Chú/note/strike/band"""
+    """Đọc cột E (index 4) - ghi Chú/note/strike/band — từ RAM, không gọi Sheets"""
+    with note_lock:
+        if row_idx in note_cache:
+            return note_cache[row_idx]
+
+    # Chưa có (index chưa nạp) → đọc 1 lần rồi giữ trong RAM
     try:
-        # Cột E = index 5 (1-based) trong gspread
-        return ws_user.cell(row_idx, 5).value or ""
+        value = store.read_note(row_idx)
     except Exception:
         return ""
+    with note_lock:
+        return note_cache.setdefault(row_idx, value)
 
 def set_note(row_idx: int, value: str) -> None:
-    """Ghi cột E (index 4) - ghi Chú/note/strike/band"""
+    """Ghi cột E (index 4) - ghi Chú/note/strike/band — đổi RAM ngay, sheet ghi gom sau (NOTE_FLUSH_INLINE: ghi ngay)"""
+    value = value or ""
+    with note_lock:
+        if note_cache.get(row_idx) == value and row_idx not in note_dirty:
+            return
+        note_cache[row_idx] = value
+        note_dirty[row_idx] = value
+        note_touched[row_idx] = time.time()
+    _update_cached_user(row_idx, "ghi chu", value)
+    if NOTE_FLUSH_INLINE:
+        flush_notes()  # Lỗi → vẫn nằm trong note_dirty, thread nền thử lại
+    note_event.set()
+
+def flush_notes() -> int:
+    """Ghi mọi note đang chờ bằng 1 lần batch_update (cột E). Lỗi → giữ lại, lần sau ghi tiếp"""
+    with note_lock:
+        if not note_dirty:
+            return 0
+        batch = dict(note_dirty)
+        note_dirty.clear()
+        note_inflight.update(batch)
+
     try:
-        # Cột E = index 5 (1-based) trong gspread
-        ws_user.update_cell(row_idx, 5, value)
-    except Exception:
-        pass
+        store.write_notes(batch)
+        ok = True
+    except Exception as e:
+        print(f"[NOTE] batch_update {len(batch)} dòng lỗi: {e}")
+        ok = False
+
+    with note_lock:
+        current = time.time()
+        for row_idx, value in batch.items():
+            note_inflight.pop(row_idx, None)
+            if ok:
+                note_touched[row_idx] = current
+            else:
+                note_dirty.setdefault(row_idx, value)  # Có giá trị mới hơn thì giữ giá trị mới
+    return len(batch) if ok else 0
+
+def note_flush_worker():
+    """Thread gom ghi note: chờ có thay đổi → đợi thêm NOTE_FLUSH_INTERVAL để gom → batch_update"""
+    while True:
+        note_event.wait()
+        time.sleep(NOTE_FLUSH_INTERVAL)
+        note_event.clear()
+        flush_notes()
+        with note_lock:
+            pending = bool(note_dirty)
+        if pending:
+            note_event.set()  # Lỗi lần trước → thử lại ở vòng sau
 
 # =========================================================
 # STRIKE / BAND
@@ -1147,6 +2934,7 @@ def inc_strike_and_band(row_idx: int, tele_id: Any, username: str, count_minute:
 # =========================================================
 def log_check(tele_id: Any, username: str, value: str, balance_after: int, note: str) -> None:
     """✅ BATCH LOG: Đẩy vào queue"""
+    _inc_today_request(tele_id)
     log_queue.put({
         "type": "check",
         "data": [
@@ -1174,35 +2962,260 @@ def log_qr(tele_id: Any, username: str, session_id: str, status: str, balance_af
         ]
     })
 
+# Đếm lượt check trong ngày theo Tele ID (RAM) — tăng ngay trong log_check,
+# seed 1 lần từ LogsCheck lúc khởi động, tự reset khi qua ngày mới
+daily_counter: Dict[str, Any] = {"day": "", "counts": {}}
+daily_lock = threading.Lock()
+daily_seeded = threading.Event()  # set khi thread khởi động seed xong (thành công hay lỗi)
+
+def _daily_counts_locked(today: str) -> Dict[str, int]:
+    """Trả dict đếm của hôm nay (reset nếu đã qua nửa đêm). Gọi khi đang giữ daily_lock"""
+    if daily_counter["day"] != today:
+        daily_counter["day"] = today
+        daily_counter["counts"] = {}
+    return daily_counter["counts"]
+
+def _inc_today_request(tele_id: Any) -> None:
+    tid = normalize_tele_id(tele_id)
+    if not tid:
+        return
+    today = now().strftime("%Y-%m-%d")
+    with daily_lock:
+        counts = _daily_counts_locked(today)
+        counts[tid] = counts.get(tid, 0) + 1
+
+def seed_daily_counter() -> int:
+    """Đọc LogsCheck 1 lần → đếm số dòng hôm nay theo Tele ID"""
+    today = now().strftime("%Y-%m-%d")
+    seeded = store.count_checks(today)
+
+    with daily_lock:
+        counts = _daily_counts_locked(today)
+        for tid, cnt in seeded.items():
+            counts[tid] = counts.get(tid, 0) + cnt
+
+    print(f"[LOG] Seeded daily counter: {sum(seeded.values())} checks / {len(seeded)} users hôm nay")
+    return len(seeded)
+
 def count_today_request(tele_id: Any) -> int:
-    tele_id = normalize_tele_id(tele_id)
+    """✅ O(1): đọc bộ đếm RAM (đã gồm cả log còn nằm trong log_queue)"""
+    # Cold start: chờ seed từ LogsCheck một chút để không lọt quá giới hạn ngày
+    daily_seeded.wait(timeout=DAILY_SEED_WAIT)
+    tid = normalize_tele_id(tele_id)
     today = now().strftime("%Y-%m-%d")
+    with daily_lock:
+        return _daily_counts_locked(today).get(tid, 0)
 
+# =========================================================
+# TELEGRAM UTIL
+# =========================================================
+class TokenBucket:
+    """Token bucket đơn giản (không tự khóa — caller giữ lock)"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.ts = time.time()
+
+    def _refill(self, current: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (current - self.ts) * self.rate)
+        self.ts = current
+
+    def wait_time(self, current: float) -> float:
+        """Số giây phải chờ tới khi có 1 token"""
+        self._refill(current)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self) -> None:
+        self.tokens -= 1
+
+# error_code nội bộ khi không có phản hồi từ Telegram
+TG_ERR_NOT_SENT = -1   # lỗi lúc kết nối → Telegram chắc chắn chưa nhận → gửi lại an toàn
+TG_ERR_UNKNOWN = -2    # lỗi sau khi đã gửi (read timeout...) → có thể Telegram đã nhận
+# Gửi lại không sinh tin thứ 2 (sửa / trả lời callback) → retry được cả khi TG_ERR_UNKNOWN
+TG_IDEMPOTENT_METHODS = {"editMessageText", "editMessageReplyMarkup", "answerCallbackQuery", "deleteMessage"}
+
+def tg_call(method: str, payload: Dict[str, Any], files: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Gọi 1 method Bot API (đồng bộ, 1 lần)
+    Returns: {"ok", "error_code", "description", "retry_after", "result"}
+    """
     try:
-        if ws_has_headers(ws_log_check, ["time", "Tele ID"]):
-            rows = ws_log_check.get_all_records()
-            cnt = 0
-            for r in rows:
-                t = safe_text(r.get("time"))
-                if t.startswith(today) and safe_text(r.get("Tele ID")) == tele_id:
-                    cnt += 1
-            return cnt
-    except Exception:
-        pass
+        if files:
+            r = http_post(f"{BASE_URL}/{method}", data=payload, files=files)
+        else:
+            r = http_post(f"{BASE_URL}/{method}", json=payload)
+        try:
+            data = r.json()
+        except Exception:
+            data = {}
+    except (requests.exceptions.ConnectTimeout, requests.exceptions.ConnectionError) as e:
+        return {"ok": False, "error_code": TG_ERR_NOT_SENT, "description": str(e), "retry_after": 0, "result": None}
+    except Exception as e:
+        return {"ok": False, "error_code": TG_ERR_UNKNOWN, "description": str(e), "retry_after": 0, "result": None}
 
-    rows = ws_get_all_records_safe(ws_log_check)
-    cnt = 0
-    for r in rows:
-        t = safe_text(r.get("time"))
-        tid = safe_text(r.get("tele id"))
-        if t.startswith(today) and tid == tele_id:
-            cnt += 1
-    return cnt
+    return {
+        "ok": bool(data.get("ok")),
+        "error_code": data.get("error_code", 0 if data.get("ok") else r.status_code),
+        "description": data.get("description", ""),
+        "retry_after": safe_int((data.get("parameters") or {}).get("retry_after"), 0),
+        "result": data.get("result"),
+    }
 
 # =========================================================
-# TELEGRAM UTIL
+# 🔥 FIX 7: TELEGRAM OUTBOX (sender pool + rate limit)
 # =========================================================
-def tg_send(chat_id: Any, text: str, keyboard: Optional[Dict[str, Any]] = None) -> None:
+# Giống hàng đợi update: mỗi chat 1 deque, chỉ 1 sender xử lý 1 chat tại 1 thời điểm
+# → tin nhắn tới cùng chat luôn đúng thứ tự. Chat bị giới hạn được hẹn giờ lại
+# trong heap (không sender nào phải ngủ chờ)
+tg_outbox: Dict[str, deque] = {}
+tg_chat_buckets: Dict[str, TokenBucket] = {}
+tg_global_bucket = TokenBucket(TG_GLOBAL_RATE, TG_GLOBAL_RATE)
+tg_due: List[Tuple[float, int, str]] = []  # heap (due_ts, seq, chat_key)
+tg_cond = threading.Condition()
+tg_seq = 0
+tg_stats = {"queued": 0, "sent": 0, "failed": 0, "throttled": 0, "retried": 0, "dropped": 0}
+_tg_senders_pid = None
+
+def _tg_schedule_locked(key: str, due: float) -> None:
+    global tg_seq
+    tg_seq += 1
+    heapq.heappush(tg_due, (due, tg_seq, key))
+    tg_cond.notify()
+
+def tg_enqueue(method: str, chat_id: Any, payload: Dict[str, Any], files: Optional[Dict[str, Any]] = None,
+               key: Optional[str] = None) -> Future:
+    """
+    Đưa 1 lệnh gửi vào outbox. Future trả về dict kết quả của tg_call
+    key: hàng đợi riêng thay cho chat_id — key bắt đầu "_" không bị giới hạn theo chat (chỉ bucket toàn cục)
+    """
+    fut: Future = Future()
+
+    if not TG_ASYNC_SEND:
+        fut.set_result(_tg_call_with_retry(method, payload, files))
+        return fut
+
+    _ensure_tg_senders()
+    if key is None:
+        key = safe_text(chat_id) if chat_id is not None else "_"
+    with tg_cond:
+        if tg_stats["queued"] >= TG_OUTBOX_MAX:
+            tg_stats["dropped"] += 1
+            fut.set_result({"ok": False, "error_code": -1, "description": "outbox_full", "retry_after": 0, "result": None})
+            return fut
+
+        q = tg_outbox.get(key)
+        if q is None:
+            q = tg_outbox[key] = deque()
+            _tg_schedule_locked(key, time.time())
+        q.append({"method": method, "payload": payload, "files": files, "future": fut, "attempt": 0})
+        tg_stats["queued"] += 1
+    return fut
+
+def _tg_should_retry(method: str, res: Dict[str, Any]) -> bool:
+    """
+    Chỉ gửi lại khi chắc Telegram chưa xử lý: 429 / lỗi kết nối
+    Read timeout với sendMessage / sendPhoto → không gửi lại (tránh user nhận 2 tin)
+    """
+    if res["ok"]:
+        return False
+    code = res["error_code"]
+    return code in (429, TG_ERR_NOT_SENT) or (code == TG_ERR_UNKNOWN and method in TG_IDEMPOTENT_METHODS)
+
+def _tg_call_with_retry(method: str, payload: Dict[str, Any], files: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Gửi đồng bộ (chế độ inline): tôn trọng retry_after khi bị 429"""
+    res = tg_call(method, payload, files)
+    for _ in range(TG_MAX_RETRIES):
+        if not _tg_should_retry(method, res):
+            break
+        time.sleep(res["retry_after"] or 1)
+        res = tg_call(method, payload, files)
+    return res
+
+def _tg_prune_buckets_locked(current: float) -> None:
+    """Bỏ bucket của chat không còn tin chờ và đã hồi đầy token (tránh phình RAM theo số chat)"""
+    for k, b in list(tg_chat_buckets.items()):
+        if k not in tg_outbox:
+            b._refill(current)
+            if b.tokens >= b.capacity:
+                tg_chat_buckets.pop(k, None)
+
+def tg_sender_worker():
+    while True:
+        with tg_cond:
+            while True:
+                current = time.time()
+                if tg_due and tg_due[0][0] <= current:
+                    _, _, key = heapq.heappop(tg_due)
+                    break
+                tg_cond.wait(timeout=(tg_due[0][0] - current) if tg_due else None)
+
+            q = tg_outbox.get(key)
+            if not q:
+                tg_outbox.pop(key, None)
+                continue
+
+            bucket = None
+            if not key.startswith("_"):
+                bucket = tg_chat_buckets.get(key)
+                if bucket is None:
+                    bucket = tg_chat_buckets[key] = TokenBucket(TG_CHAT_RATE, TG_CHAT_BURST)
+
+            wait = max(
+                bucket.wait_time(current) if bucket else 0.0,
+                tg_global_bucket.wait_time(current)
+            )
+            if wait > 0:
+                tg_stats["throttled"] += 1
+                _tg_schedule_locked(key, current + wait)
+                continue
+
+            if bucket:
+                bucket.consume()
+            tg_global_bucket.consume()
+            job = q.popleft()
+
+        res = tg_call(job["method"], job["payload"], job["files"])
+        retry_in = 0.0
+        if _tg_should_retry(job["method"], res) and job["attempt"] < TG_MAX_RETRIES:
+            job["attempt"] += 1
+            retry_in = float(res["retry_after"] or (2 ** job["attempt"]) * 0.5)
+
+        with tg_cond:
+            if retry_in:
+                tg_stats["retried"] += 1
+                q.appendleft(job)
+                _tg_schedule_locked(key, time.time() + retry_in)
+            else:
+                tg_stats["queued"] -= 1
+                tg_stats["sent" if res["ok"] else "failed"] += 1
+                if q:
+                    _tg_schedule_locked(key, time.time())
+                else:
+                    tg_outbox.pop(key, None)
+                    if len(tg_chat_buckets) > 10000:
+                        _tg_prune_buckets_locked(time.time())
+
+        if not retry_in:
+            if not res["ok"]:
+                print(f"[TG] {job['method']} → {key} lỗi {res['error_code']}: {res['description']}")
+            job["future"].set_result(res)
+
+def _ensure_tg_senders() -> None:
+    global _tg_senders_pid
+    if _tg_senders_pid == os.getpid():
+        return
+    with tg_cond:
+        if _tg_senders_pid == os.getpid():
+            return
+        for i in range(TG_SENDERS):
+            threading.Thread(target=tg_sender_worker, name=f"tg-send-{i}", daemon=True).start()
+        _tg_senders_pid = os.getpid()
+
+def tg_send(chat_id: Any, text: str, keyboard: Optional[Dict[str, Any]] = None) -> Future:
     payload = {
         "chat_id": chat_id,
         "text": text,
@@ -1212,45 +3225,116 @@ def tg_send(chat_id: Any, text: str, keyboard: Optional[Dict[str, Any]] = None)
     if keyboard:
         payload["reply_markup"] = keyboard
 
-    try:
-        requests.post(f"{BASE_URL}/sendMessage", json=payload, timeout=15)
-    except Exception:
-        pass
+    return tg_enqueue("sendMessage", chat_id, payload)
+
+def tg_edit(chat_id: Any, message_id: Any, text: str, keyboard: Optional[Dict[str, Any]] = None) -> Future:
+    payload = {
+        "chat_id": chat_id,
+        "message_id": message_id,
+        "text": text,
+        "parse_mode": "HTML",
+        "disable_web_page_preview": True
+    }
+    if keyboard:
+        payload["reply_markup"] = keyboard
+
+    return tg_enqueue("editMessageText", chat_id, payload)
+
+class OrderMessageStream:
+    """
+    Hiện đơn hàng dần dần trong 1 tin nhắn:
+    đơn đầu tiên → sendMessage ngay, đơn sau → editMessageText (giãn cách STREAM_EDIT_INTERVAL),
+    finish() → sửa thành kết quả đầy đủ (giống hệt khi không stream)
+    """
+
+    PENDING_FOOTER = "\n\n⏳ <i>Đang tải thêm đơn...</i>"
+
+    def __init__(self, chat_id: Any):
+        self.chat_id = chat_id
+        self.blocks: List[str] = []
+        self._sent: Optional[Future] = None
+        self._last_text = ""
+        self._last_edit = 0.0
+
+    def _message_id(self) -> Optional[Any]:
+        if not self._sent:
+            return None
+        try:
+            res = self._sent.result(timeout=15)
+        except Exception:
+            return None
+        return (res.get("result") or {}).get("message_id") if res.get("ok") else None
+
+    def _show(self, text: str) -> bool:
+        if text == self._last_text:
+            return True
+        if not self._sent:
+            self._sent = tg_send(self.chat_id, text)
+        else:
+            message_id = self._message_id()
+            if not message_id:
+                return False
+            tg_edit(self.chat_id, message_id, text)
+        self._last_text = text
+        self._last_edit = time.time()
+        return True
+
+    def add(self, block: str) -> None:
+        """Gọi trong vòng fetch → không bao giờ chờ Telegram (tin đầu chưa gửi xong thì gộp vào lần sau)"""
+        self.blocks.append(block)
+        if self._sent and not self._sent.done():
+            return  # Chưa có message_id → gộp vào lần sửa sau / finish
+        if self._sent and time.time() - self._last_edit < STREAM_EDIT_INTERVAL:
+            return  # Gộp vào lần sửa sau / finish
+        self._show("\n\n".join(self.blocks) + self.PENDING_FOOTER)
+
+    def finish(self, text: str) -> None:
+        """Chốt kết quả: sửa tin đang stream, hoặc gửi mới nếu chưa stream / sửa lỗi"""
+        if self._sent and self._show(text):
+            return
+        tg_send(self.chat_id, text)
 
 def tg_send_photo(chat_id: Any, photo_base64: str, caption: str = "", keyboard: Optional[Dict[str, Any]] = None) -> None:
     """Gửi ảnh từ base64 (hỗ trợ inline keyboard)"""
+    def _fallback(reason: Any) -> None:
+        print(f"[ERROR] Send photo failed: {reason}")
+        # Fallback gửi text
+        tg_send(chat_id, f"📷 {caption}\n\n❌ Không thể gửi ảnh QR, vui lòng thử lại.")
+
     try:
         # Decode base64
         photo_bytes = base64.b64decode(photo_base64)
+    except Exception as e:
+        _fallback(e)
+        return
 
-        # Tạo file object
-        files = {"photo": ("qr.png", photo_bytes, "image/png")}
-
-        payload = {
-            "chat_id": chat_id,
-            "caption": caption,
-            "parse_mode": "HTML"
-        }
-
-        # ⚠️ Với multipart/form-data, reply_markup nên là JSON string
-        if keyboard:
-            payload["reply_markup"] = json.dumps(keyboard, ensure_ascii=False)
+    # Tạo file object
+    files = {"photo": ("qr.png", photo_bytes, "image/png")}
 
-        requests.post(f"{BASE_URL}/sendPhoto", data=payload, files=files, timeout=15)
-    except Exception as e:
-        print(f"[ERROR] Send photo failed: {e}")
-        # Fallback gửi text
-        tg_send(chat_id, f"📷 {caption}\\n\\n❌ Không thể gửi ảnh QR, vui lòng thử lại.")
+    payload = {
+        "chat_id": chat_id,
+        "caption": caption,
+        "parse_mode": "HTML"
+    }
 
-def tg_answer_callback(callback_query_id: str, text: str = "") -> None:
-    try:
-        requests.post(
-            f"{BASE_URL}/answerCallbackQuery",
-            json={"callback_query_id": callback_query_id, "text": text},
-            timeout=10
-        )
-    except Exception:
-        pass
+    # ⚠️ Với multipart/form-data, reply_markup nên là JSON string
+    if keyboard:
+        payload["reply_markup"] = json.dumps(keyboard, ensure_ascii=False)
+
+    fut = tg_enqueue("sendPhoto", chat_id, payload, files)
+    fut.add_done_callback(
+        lambda f: None if f.result()["ok"] else _fallback(f.result()["description"])
+    )
+
+def tg_answer_callback(callback_query_id: str, text: str = "") -> None:
+    # Không thuộc giới hạn theo chat → chỉ tính vào bucket toàn cục
+    # Mỗi callback 1 hàng riêng → nút bấm của các chat không xếp hàng sau nhau
+    tg_enqueue(
+        "answerCallbackQuery",
+        None,
+        {"callback_query_id": callback_query_id, "text": text},
+        key=f"_cb:{callback_query_id}"
+    )
 
 def main_keyboard():
     return {
@@ -1293,6 +3377,9 @@ def handle_callback_query(data: Dict[str, Any]) -> None:
 
     callback_id = cq.get("id")
     if callback_id:
+        if not dedup_store.add_if_new(f"cq:{callback_id}"):
+            print(f"[DEDUP] Bỏ qua callback_query trùng: {callback_id}")
+            return
         tg_answer_callback(callback_id)
 
     from_user = cq.get("from", {})
@@ -1452,7 +3539,7 @@ def normalize_status_text(status: str) -> str:
 # SHOPEE CHECK
 # =========================================================
 UA = "Android app Shopee appver=28320 app_type=1"
-SHOPEE_BASE = "https://shopee.vn/api/v4"
+SHOPEE_BASE = os.getenv("SHOPEE_API_BASE", "https://shopee.vn/api/v4")  # Đổi sang mock server khi benchmark
 
 def build_headers(cookie: str) -> dict:
     return {
@@ -1474,6 +3561,26 @@ def find_first_key(data, key):
             dq.extend(x for x in cur if isinstance(x, (dict, list)))
     return None
 
+def find_first_keys(data, keys) -> Dict[str, Any]:
+    """
+    1 lần BFS → {key: giá trị đầu tiên gặp} cho mọi key cần tìm
+    Cùng thứ duyệt với find_first_key nên kết quả y hệt gọi find_first_key từng key
+    """
+    wanted = set(keys)
+    found: Dict[str, Any] = {}
+    dq = deque([data])
+    while dq and wanted:
+        cur = dq.popleft()
+        if isinstance(cur, dict):
+            hit = [k for k in wanted if k in cur]
+            for k in hit:
+                found[k] = cur[k]
+            wanted.difference_update(hit)
+            dq.extend(v for v in cur.values() if isinstance(v, (dict, list)))
+        elif isinstance(cur, list):
+            dq.extend(x for x in cur if isinstance(x, (dict, list)))
+    return found
+
 def bfs_values_by_key(data, target_keys=("order_id",)):
     out, dq, tset = [], deque([data]), set(target_keys)
     while dq:
@@ -1501,13 +3608,40 @@ def fmt_ts(ts):
 # =========================================================
 # ✅ FIX 1: TIMEOUT + RETRY
 # =========================================================
+def parse_order_list(data) -> Tuple[List[Any], Optional[str]]:
+    """JSON list đơn → (order_id không trùng, lỗi) — dùng chung cho mọi engine"""
+    # Cookie validation
+    if isinstance(data, dict):
+        if (
+            data.get("error") in (401, 403)
+            or data.get("error_msg")
+            or data.get("msg") in ("unauthorized", "forbidden")
+        ):
+            return [], "cookie_expired"
+
+    # Parse order IDs
+    order_ids = bfs_values_by_key(data, ("order_id",)) if isinstance(data, dict) else []
+
+    if not order_ids:
+        if not data or (isinstance(data, dict) and len(data.keys()) <= 2):
+            return [], "cookie_expired"
+        return [], "no_orders"
+
+    # Remove duplicates
+    seen, uniq = set(), []
+    for oid in order_ids:
+        if oid not in seen:
+            seen.add(oid)
+            uniq.append(oid)
+    return uniq, None
+
 def fetch_single_order_detail(order_id: str, headers: dict) -> Optional[dict]:
     """Fetch chi tiết 1 order với retry"""
     url = f"{SHOPEE_BASE}/order/get_order_detail"
 
     for attempt in range(TIMEOUT_RETRY + 1):
         try:
-            r = requests.get(
+            r = http_get(
                 url,
                 headers=headers,
                 params={"order_id": order_id},
@@ -1524,18 +3658,123 @@ def fetch_single_order_detail(order_id: str, headers: dict) -> Optional[dict]:
 
     return None
 
+# =========================================================
+# 🔥 SHOPEE FETCH POOL (dùng chung toàn process, chia đều theo user)
+# =========================================================
+class FairExecutor:
+    """
+    Pool thread cố định dùng chung, chia lượt round-robin theo owner
+    - Mỗi owner có deque job riêng, chạy tối đa per_owner job cùng lúc
+    - Owner nhiều job không chiếm hết pool: worker lấy lần lượt từng owner
+    """
+
+    def __init__(self, workers: int, per_owner: int, name: str):
+        self.workers = max(1, workers)
+        self.per_owner = max(1, per_owner)
+        self.name = name
+        self._queues: Dict[str, deque] = {}
+        self._active: Dict[str, int] = {}
+        self._ready: deque = deque()  # owner còn job và chưa chạm per_owner
+        self._in_ready: set = set()
+        self._cond = threading.Condition()
+        self._pid = None
+        self.stats = {"submitted": 0, "completed": 0, "queued": 0, "running": 0, "wait_avg_ms": 0.0, "wait_max_ms": 0.0}
+
+    def _ensure_workers(self) -> None:
+        if self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            for i in range(self.workers):
+                threading.Thread(target=self._worker, name=f"{self.name}-{i}", daemon=True).start()
+            self._pid = os.getpid()
+
+    def _mark_ready_locked(self, owner: str) -> None:
+        if (
+            owner not in self._in_ready
+            and self._queues.get(owner)
+            and self._active.get(owner, 0) < self.per_owner
+        ):
+            self._ready.append(owner)
+            self._in_ready.add(owner)
+            self._cond.notify()
+
+    def submit(self, owner: str, fn, *args, **kwargs) -> Future:
+        fut: Future = Future()
+        self._ensure_workers()
+        with self._cond:
+            self._queues.setdefault(owner, deque()).append((fn, args, kwargs, fut, time.time()))
+            self.stats["submitted"] += 1
+            self.stats["queued"] += 1
+            self._mark_ready_locked(owner)
+        return fut
+
+    def _worker(self) -> None:
+        while True:
+            with self._cond:
+                while not self._ready:
+                    self._cond.wait()
+                owner = self._ready.popleft()
+                self._in_ready.discard(owner)
+                q = self._queues.get(owner)
+                if not q:
+                    continue
+                fn, args, kwargs, fut, enq_ts = q.popleft()
+                self._active[owner] = self._active.get(owner, 0) + 1
+                self.stats["queued"] -= 1
+                self.stats["running"] += 1
+                wait_ms = (time.time() - enq_ts) * 1000
+                self.stats["wait_max_ms"] = max(self.stats["wait_max_ms"], round(wait_ms, 1))
+                self.stats["wait_avg_ms"] = round(self.stats["wait_avg_ms"] * 0.9 + wait_ms * 0.1, 1)
+                # Owner còn job → xếp cuối hàng (round-robin)
+                self._mark_ready_locked(owner)
+
+            if fut.set_running_or_notify_cancel():
+                fut.started_at = time.time()  # hạn chờ của người gọi tính từ lúc chạy, không tính lúc xếp hàng
+                try:
+                    fut.set_result(fn(*args, **kwargs))
+                except BaseException as e:
+                    fut.set_exception(e)
+
+            with self._cond:
+                self._active[owner] -= 1
+                self.stats["running"] -= 1
+                self.stats["completed"] += 1
+                if not self._active[owner]:
+                    self._active.pop(owner, None)
+                if not self._queues.get(owner):
+                    self._queues.pop(owner, None)
+                else:
+                    self._mark_ready_locked(owner)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._cond:
+            out = dict(self.stats)
+            out["owners"] = len(self._queues)
+            out["workers"] = self.workers
+        return out
+
+shopee_fetch_pool = FairExecutor(SHOPEE_FETCH_WORKERS, SHOPEE_FETCH_PER_USER, "shopee-fetch")
+# Lô nhiều dòng: mỗi dòng 1 job (owner = user), detail bên trong vẫn đi qua shopee_fetch_pool
+batch_check_pool = FairExecutor(BATCH_CHECK_WORKERS, BATCH_CHECK_PER_USER, "batch-check")
+
 # =========================================================
 # PARALLEL VERSION
 # =========================================================
-def fetch_orders_and_details_parallel(cookie: str, limit: int = 5):
-    """PARALLEL VERSION với timeout mới"""
+def fetch_orders_and_details_parallel(cookie: str, limit: int = 5, on_detail=None, owner: Optional[str] = None):
+    """
+    PARALLEL VERSION với timeout mới
+    on_detail(detail): gọi ngay khi từng đơn về (streaming), trước khi chờ các đơn còn lại
+    owner: Tele ID người check → chia lượt pool theo user (không có thì theo cookie)
+    """
     headers = build_headers(cookie)
     list_url = f"{SHOPEE_BASE}/order/get_all_order_and_checkout_list"
 
     # Step 1: Lấy list orders
     for attempt in range(TIMEOUT_RETRY + 1):
         try:
-            r = requests.get(
+            r = http_get(
                 list_url,
                 headers=headers,
                 params={
@@ -1559,66 +3798,270 @@ def fetch_orders_and_details_parallel(cookie: str, limit: int = 5):
     else:
         return None, "timeout"
 
-    # Cookie validation
-    if isinstance(data, dict):
-        if (
-            data.get("error") in (401, 403)
-            or data.get("error_msg")
-            or data.get("msg") in ("unauthorized", "forbidden")
-        ):
-            return None, "cookie_expired"
+    uniq, error = parse_order_list(data)
+    if error:
+        return None, error
 
-    # Parse order IDs
-    order_ids = bfs_values_by_key(data, ("order_id",)) if isinstance(data, dict) else []
+    # Step 2: Parallel fetch details (pool chung, owner = Tele ID → 1 user dán nhiều cookie vẫn chỉ 1 phần pool)
+    details = []
+    owner = owner or cookie_fingerprint(cookie)
+    future_to_oid = {
+        shopee_fetch_pool.submit(owner, fetch_single_order_detail, oid, headers): oid
+        for oid in uniq[:limit]
+    }
 
-    if not order_ids:
-        if not data or (isinstance(data, dict) and len(data.keys()) <= 2):
-            return None, "cookie_expired"
-        return None, "no_orders"
+    # Hạn mỗi detail: TIMEOUT_DETAIL + 2 tính từ lúc job bắt đầu chạy (xếp hàng trong pool không bị tính),
+    # job chưa chạy được sau SHOPEE_QUEUE_TIMEOUT thì huỷ
+    submitted_at = time.time()
+    pending = set(future_to_oid)
+    timed_out = False
+    while pending:
+        current = time.time()
+        next_at = current + TIMEOUT_DETAIL + 2
+        for future in list(pending):
+            if future.done():
+                continue
+            started = getattr(future, "started_at", None)
+            limit_at = started + TIMEOUT_DETAIL + 2 if started else submitted_at + SHOPEE_QUEUE_TIMEOUT
+            if current >= limit_at:
+                # Quá hạn → bỏ đơn chậm (job chưa chạy thì hủy), trả các đơn đã có
+                future.cancel()
+                pending.discard(future)
+                timed_out = True
+            else:
+                next_at = min(next_at, limit_at)
+        if not pending:
+            break
+        done, _ = futures_wait(pending, timeout=max(0.05, next_at - current), return_when=FIRST_COMPLETED)
+        for future in done:
+            pending.discard(future)
+            try:
+                result = future.result()
+            except Exception:
+                continue
+            if result:
+                details.append(result)
+                if on_detail:
+                    on_detail(result)
 
-    # Remove duplicates
-    seen, uniq = set(), []
-    for oid in order_ids:
-        if oid not in seen:
-            seen.add(oid)
-            uniq.append(oid)
+    if not details:
+        # Hết giờ / bị huỷ ≠ cookie hỏng → báo timeout để không kết luận sai cookie còn sống
+        return None, "timeout" if timed_out else "cookie_expired"
 
-    # Step 2: Parallel fetch details
-    details = []
+    return details, None
 
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        future_to_oid = {
-            executor.submit(fetch_single_order_detail, oid, headers): oid
-            for oid in uniq[:limit]
-        }
+# =========================================================
+# 🔥 ASYNC VERSION (aiohttp, 1 event loop cho mọi lượt check)
+# =========================================================
+# Cùng luồng xử lý / retry / timeout với bản thread → cùng kết quả parse
+_async_loop = None
+_async_loop_pid = None
+_async_loop_lock = threading.Lock()
+_async_http = None  # aiohttp.ClientSession — chỉ tạo / dùng trong thread của loop
+# Cùng giới hạn với bản thread (chỉ tạo / dùng trong thread của loop):
+_async_host_sems: Dict[str, asyncio.Semaphore] = {}  # host → trần in-flight theo HTTP_HOST_LIMITS
+_async_owner_sems: Dict[str, list] = {}              # owner → [Semaphore(SHOPEE_FETCH_PER_USER), số lượt check đang chạy]
+
+def _ensure_async_loop():
+    global _async_loop, _async_loop_pid, _async_http, _async_host_sems, _async_owner_sems
+    if _async_loop_pid == os.getpid():
+        return _async_loop
+    with _async_loop_lock:
+        if _async_loop_pid != os.getpid():
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="shopee-async", daemon=True).start()
+            _async_loop, _async_http = loop, None
+            _async_host_sems, _async_owner_sems = {}, {}
+            _async_loop_pid = os.getpid()
+            atexit.register(_close_async_http)
+    return _async_loop
+
+async def _async_http_session():
+    global _async_http
+    if _async_http is None or _async_http.closed:
+        connector = aiohttp.TCPConnector(limit=SHOPEE_MAX_INFLIGHT, ttl_dns_cache=300, keepalive_timeout=60)
+        # DummyCookieJar: session dùng chung mọi user → không được nhớ Set-Cookie (SPC_ST user này lọt sang user khác)
+        _async_http = aiohttp.ClientSession(connector=connector, cookie_jar=aiohttp.DummyCookieJar())
+    return _async_http
+
+def _close_async_http() -> None:
+    """Đóng session aiohttp lúc tắt process (tránh cảnh báo Unclosed client session)"""
+    loop, sess = _async_loop, _async_http
+    if loop is None or sess is None or sess.closed or not loop.is_running():
+        return
+    try:
+        asyncio.run_coroutine_threadsafe(sess.close(), loop).result(timeout=2)
+    except Exception:
+        pass
+
+def _async_host_sem(url: str) -> Optional[asyncio.Semaphore]:
+    """Semaphore trần in-flight của host (như _http_host_sems của http_request), None = không giới hạn"""
+    host = urlsplit(url).netloc.lower()
+    cap = HTTP_HOST_LIMITS.get(host)
+    if not cap:
+        return None
+    sem = _async_host_sems.get(host)
+    if sem is None:
+        sem = _async_host_sems[host] = asyncio.Semaphore(cap)
+    return sem
+
+async def _async_get(sess, url: str, **kwargs):
+    """GET giữ 1 chỗ trong trần host tới khi đọc xong body. Returns: (status, json | None)"""
+    sem = _async_host_sem(url)
+    if sem is not None:
+        await sem.acquire()
+    try:
+        async with sess.get(url, **kwargs) as r:
+            if r.status != 200:
+                return r.status, None
+            return 200, await r.json(content_type=None)
+    finally:
+        if sem is not None:
+            sem.release()
+
+async def _async_fetch_order_list(headers: dict, limit: int):
+    sess = await _async_http_session()
+    params = {"limit": limit, "offset": 0, "need_order_response": 1, "need_shipping_info": 0}
+    for attempt in range(TIMEOUT_RETRY + 1):
+        try:
+            status, data = await _async_get(
+                sess,
+                f"{SHOPEE_BASE}/order/get_all_order_and_checkout_list",
+                headers=headers,
+                params=params,
+                timeout=aiohttp.ClientTimeout(total=TIMEOUT_LIST)
+            )
+            if status == 200:
+                return data, None
+        except asyncio.TimeoutError:
+            if attempt < TIMEOUT_RETRY:
+                continue
+            return None, "timeout"
+        except Exception as e:
+            return None, f"error: {e}"
+    return None, "timeout"
+
+async def _async_fetch_order_detail_once(sess, order_id, headers: dict) -> Optional[dict]:
+    for attempt in range(TIMEOUT_RETRY + 1):
+        try:
+            status, data = await _async_get(
+                sess,
+                f"{SHOPEE_BASE}/order/get_order_detail",
+                headers=headers,
+                params={"order_id": order_id},
+                timeout=aiohttp.ClientTimeout(total=TIMEOUT_DETAIL)
+            )
+            if status == 200:
+                return data
+        except asyncio.TimeoutError:
+            if attempt < TIMEOUT_RETRY:
+                continue
+            return None
+        except Exception:
+            return None
+    return None
+
+async def _async_fetch_order_detail(order_id, headers: dict, owner_sem: asyncio.Semaphore) -> Optional[dict]:
+    """
+    1 detail trong lượt của owner (như job của shopee_fetch_pool)
+    Hạn: chờ lượt tối đa SHOPEE_QUEUE_TIMEOUT, chạy tối đa TIMEOUT_DETAIL + 2 → quá hạn raise asyncio.TimeoutError
+    """
+    sess = await _async_http_session()
+    await asyncio.wait_for(owner_sem.acquire(), SHOPEE_QUEUE_TIMEOUT)
+    try:
+        return await asyncio.wait_for(_async_fetch_order_detail_once(sess, order_id, headers), TIMEOUT_DETAIL + 2)
+    finally:
+        owner_sem.release()
+
+async def _async_fetch_orders(cookie: str, limit: int, out: Queue, owner: str):
+    """List + mọi detail trên event loop; mỗi detail về → out.put (thread gọi xử lý tiếp)"""
+    headers = build_headers(cookie)
+    data, error = await _async_fetch_order_list(headers, limit)
+    if error:
+        return None, error
+
+    uniq, error = parse_order_list(data)
+    if error:
+        return None, error
+
+    # owner = Tele ID → 1 user dán nhiều cookie vẫn chỉ SHOPEE_FETCH_PER_USER detail chạy cùng lúc
+    entry = _async_owner_sems.get(owner)
+    if entry is None:
+        entry = _async_owner_sems[owner] = [asyncio.Semaphore(SHOPEE_FETCH_PER_USER), 0]
+    entry[1] += 1
 
-        for future in as_completed(future_to_oid, timeout=TIMEOUT_DETAIL + 2):
+    tasks = [asyncio.ensure_future(_async_fetch_order_detail(oid, headers, entry[0])) for oid in uniq[:limit]]
+    details = []
+    timed_out = False
+    try:
+        for next_done in asyncio.as_completed(tasks):
             try:
-                result = future.result(timeout=1)
-                if result:
-                    details.append(result)
+                result = await next_done
+            except asyncio.TimeoutError:
+                timed_out = True
+                continue
             except Exception:
-                pass
+                continue
+            if result:
+                details.append(result)
+                out.put(result)
+    finally:
+        for t in tasks:
+            t.cancel()
+        entry[1] -= 1
+        if entry[1] <= 0:
+            _async_owner_sems.pop(owner, None)
 
     if not details:
-        return None, "cookie_expired"
-
+        # Hết giờ ≠ cookie hỏng (giống bản thread)
+        return None, "timeout" if timed_out else "cookie_expired"
     return details, None
 
-def fetch_orders_and_details(cookie: str, limit: int = None):
+def fetch_orders_and_details_async(cookie: str, limit: int = 5, on_detail=None, owner: Optional[str] = None):
+    """
+    ASYNC VERSION: chạy trên event loop nền, thread gọi chỉ chờ kết quả
+    on_detail chạy ở thread gọi (không chặn event loop)
+    owner: Tele ID người check → giới hạn SHOPEE_FETCH_PER_USER detail / user (không có thì theo cookie)
+    """
+    owner = owner or cookie_fingerprint(cookie)
+    q: Queue = Queue()
+    fut = asyncio.run_coroutine_threadsafe(_async_fetch_orders(cookie, limit, q, owner), _ensure_async_loop())
+    fut.add_done_callback(lambda _: q.put(None))
+
+    deadline = time.time() + TIMEOUT_LIST * (TIMEOUT_RETRY + 1) + SHOPEE_QUEUE_TIMEOUT + TIMEOUT_DETAIL + 10
+    while True:
+        try:
+            item = q.get(timeout=max(0.1, deadline - time.time()))
+        except Empty:
+            fut.cancel()
+            return None, "timeout"
+        if item is None:
+            break
+        if on_detail:
+            on_detail(item)
+
+    try:
+        return fut.result()
+    except Exception as e:
+        return None, f"error: {e}"
+
+def fetch_orders_and_details(cookie: str, limit: int = None, on_detail=None, owner: Optional[str] = None):
     """Smart dispatcher"""
     if limit is None:
         limit = CHECK_LIMIT
 
+    if USE_ASYNC_FETCH and aiohttp is not None:
+        return fetch_orders_and_details_async(cookie, limit, on_detail, owner)
+
     if USE_PARALLEL:
-        return fetch_orders_and_details_parallel(cookie, limit)
+        return fetch_orders_and_details_parallel(cookie, limit, on_detail, owner)
 
     # Sequential mode
     headers = build_headers(cookie)
     list_url = f"{SHOPEE_BASE}/order/get_all_order_and_checkout_list"
 
     try:
-        r = requests.get(
+        r = http_get(
             list_url,
             headers=headers,
             params={
@@ -1637,55 +4080,61 @@ def fetch_orders_and_details(cookie: str, limit: int = None):
     except Exception as e:
         return None, f"timeout: {e}"
 
-    if isinstance(data, dict):
-        if (
-            data.get("error") in (401, 403)
-            or data.get("error_msg")
-            or data.get("msg") in ("unauthorized", "forbidden")
-        ):
-            return None, "cookie_expired"
-
-    order_ids = bfs_values_by_key(data, ("order_id",)) if isinstance(data, dict) else []
-
-    if not order_ids:
-        if not data or (isinstance(data, dict) and len(data.keys()) <= 2):
-            return None, "cookie_expired"
-        return None, "no_orders"
-
-    seen, uniq = set(), []
-    for oid in order_ids:
-        if oid not in seen:
-            seen.add(oid)
-            uniq.append(oid)
+    uniq, error = parse_order_list(data)
+    if error:
+        return None, error
 
     details = []
     for oid in uniq[:limit]:
         detail = fetch_single_order_detail(oid, headers)
         if detail:
             details.append(detail)
+            if on_detail:
+                on_detail(detail)
 
     if not details:
         return None, "cookie_expired"
 
     return details, None
 
-def format_order_simple(detail: dict) -> str:
-    """Format đơn hàng Shopee"""
+# Các key extract_order_summary cần (gom 1 lần BFS)
+ORDER_SUMMARY_KEYS = (
+    "tracking_no",
+    "tracking_number",
+    "tracking_info",
+    "status",
+    "cod_amount",
+    "total_cod",
+    "buyer_total_amount",
+    "item_list",
+    "items",
+    "recipient_address",
+    "shipping_name",
+    "shipping_phone",
+    "shipping_address",
+    "driver_name",
+    "driver_phone",
+)
 
-    def short_text(s: str, max_len: int) -> str:
-        s = (s or "").strip()
-        if len(s) <= max_len:
-            return s
-        return s[:max_len - 3].rstrip() + "..."
+def _short_text(s: str, max_len: int) -> str:
+    s = (s or "").strip()
+    if len(s) <= max_len:
+        return s
+    return s[:max_len - 3].rstrip() + "..."
+
+def extract_order_summary(detail: dict) -> Dict[str, Any]:
+    """Rút gọn JSON chi tiết đơn → dict nhỏ chỉ gồm field cần hiển thị (để cache)"""
+    # ✅ 1 lần duyệt JSON cho mọi field (trước: ~15 lần find_first_key = 15 lần BFS)
+    f = find_first_keys(detail, ORDER_SUMMARY_KEYS)
 
     tracking = (
-        find_first_key(detail, "tracking_no")
-        or find_first_key(detail, "tracking_number")
+        f.get("tracking_no")
+        or f.get("tracking_number")
         or "-"
     )
 
     status_text = "-"
-    tracking_info = find_first_key(detail, "tracking_info")
+    tracking_info = f.get("tracking_info")
     if isinstance(tracking_info, dict):
         status_text = (
             tracking_info.get("description")
@@ -1698,7 +4147,7 @@ def format_order_simple(detail: dict) -> str:
     status_text = status_text.strip() if isinstance(status_text, str) else '-'
 
     if not status_text or status_text == "-":
-        status_obj = find_first_key(detail, "status")
+        status_obj = f.get("status")
         raw_status = "-"
         if isinstance(status_obj, dict):
             raw_status = (
@@ -1718,9 +4167,9 @@ def format_order_simple(detail: dict) -> str:
     cod_amount = 0
     try:
         cod_amount = (
-            find_first_key(detail, "cod_amount")
-            or find_first_key(detail, "total_cod")
-            or find_first_key(detail, "buyer_total_amount")
+            f.get("cod_amount")
+            or f.get("total_cod")
+            or f.get("buyer_total_amount")
             or 0
         )
         cod_amount = int(cod_amount)
@@ -1728,7 +4177,7 @@ def format_order_simple(detail: dict) -> str:
         cod_amount = 0
 
     product_names = []
-    items = find_first_key(detail, "item_list") or find_first_key(detail, "items")
+    items = f.get("item_list") or f.get("items")
     if isinstance(items, list):
         for it in items:
             if isinstance(it, dict):
@@ -1743,31 +4192,55 @@ def format_order_simple(detail: dict) -> str:
     else:
         product_text = "-"
 
-    product_text = short_text(product_text, 68)
+    product_text = _short_text(product_text, 68)
 
-    rec_addr = find_first_key(detail, "recipient_address") or {}
+    rec_addr = f.get("recipient_address") or {}
     if not isinstance(rec_addr, dict):
         rec_addr = {}
 
     recipient_name = (
-        find_first_key(detail, "shipping_name")
+        f.get("shipping_name")
         or rec_addr.get("name")
         or "-"
     )
     recipient_phone = (
-        find_first_key(detail, "shipping_phone")
+        f.get("shipping_phone")
         or rec_addr.get("phone")
         or "-"
     )
     address = (
-        find_first_key(detail, "shipping_address")
+        f.get("shipping_address")
         or rec_addr.get("full_address")
         or "-"
     )
-    address = short_text(address, 78)
+    address = _short_text(address, 78)
+
+    shipper_name = f.get("driver_name") or "-"
+    shipper_phone = f.get("driver_phone") or "-"
+
+    return {
+        "tracking": tracking,
+        "status_text": status_text,
+        "product_text": product_text,
+        "cod_amount": cod_amount,
+        "recipient_name": recipient_name,
+        "recipient_phone": recipient_phone,
+        "address": address,
+        "shipper_name": shipper_name,
+        "shipper_phone": shipper_phone,
+    }
 
-    shipper_name = find_first_key(detail, "driver_name") or "-"
-    shipper_phone = find_first_key(detail, "driver_phone") or "-"
+def render_order_summary(summary: Dict[str, Any]) -> str:
+    """Summary → HTML Telegram"""
+    tracking = summary["tracking"]
+    status_text = summary["status_text"]
+    product_text = summary["product_text"]
+    cod_amount = summary["cod_amount"]
+    recipient_name = summary["recipient_name"]
+    recipient_phone = summary["recipient_phone"]
+    address = summary["address"]
+    shipper_name = summary["shipper_name"]
+    shipper_phone = summary["shipper_phone"]
 
     output = (
         "🧾 <u><b>ĐƠN HÀNG</b></u>\n"
@@ -1791,6 +4264,10 @@ def format_order_simple(detail: dict) -> str:
 
     return output
 
+def format_order_simple(detail: dict) -> str:
+    """Format đơn hàng Shopee"""
+    return render_order_summary(extract_order_summary(detail))
+
 def map_code(code):
     # Shopee có thể trả dict lồng nhau -> bóc ra string
     code = unwrap_status_value(code)
@@ -1799,41 +4276,66 @@ def map_code(code):
     code = normalize_status_text(code)
     return CODE_MAP.get(code, (code, 'secondary'))
 
-def check_shopee_orders(cookie: str) -> Tuple[Optional[str], Optional[str]]:
-    """✅ CACHE COOKIE: Check với cache"""
-    cookie = cookie.strip()
-    if "SPC_ST=" not in cookie:
-        return None, "missing_spc_st"
+def cookie_fingerprint(cookie: str) -> str:
+    """Hash của giá trị SPC_ST → key cache (không giữ cookie thật trong RAM làm key)"""
+    m = re.search(r"SPC_ST=([^;\s]+)", cookie or "")
+    token = m.group(1) if m else (cookie or "").strip()
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()[:32]
+
+NO_ORDERS_HTML = "📭 <b>Không có đơn hàng</b>"
 
-    # ✅ Kiểm tra cache trước
-    cached = get_cached_orders(cookie)
-    if cached:
-        print(f"[CACHE] HIT cookie: {cookie[:20]}...")
-        blocks = []
-        for d in cached:
-            if isinstance(d, dict):
-                blocks.append(format_order_simple(d))
-        return "\n\n".join(blocks), None
+def _load_order_result(cookie: str, on_block=None, owner: Optional[str] = None) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """
+    Fetch + render 1 lần → {"html", "orders": [summary]} (đây là thứ được cache)
+    on_block(html_1_đơn): gọi ngay khi từng đơn render xong (streaming)
+    """
+    summaries: List[Dict[str, Any]] = []
+    blocks: List[str] = []
 
-    # Cache miss → Fetch mới
-    print(f"[CACHE] MISS cookie: {cookie[:20]}...")
-    details, error = fetch_orders_and_details(cookie)
+    def _on_detail(detail):
+        if not isinstance(detail, dict):
+            return
+        sm = extract_order_summary(detail)
+        block = render_order_summary(sm)
+        summaries.append(sm)
+        blocks.append(block)
+        if on_block:
+            try:
+                on_block(block)
+            except Exception as e:
+                print(f"[STREAM] on_block lỗi: {e}")
 
+    _, error = fetch_orders_and_details(cookie, on_detail=_on_detail, owner=owner)
     if error:
         return None, error
 
-    if not details:
-        return "📭 <b>Không có đơn hàng</b>", None
+    if not summaries:
+        return {"html": NO_ORDERS_HTML, "orders": []}, None
+
+    return {"html": "\n\n".join(blocks), "orders": summaries}, None
+
+def check_shopee_orders(cookie: str, on_block=None, owner: Any = None) -> Tuple[Optional[str], Optional[str]]:
+    """
+    ✅ CACHE COOKIE: Check với cache (lưu HTML đã render, key = hash SPC_ST)
+    on_block: nhận từng đơn ngay khi về (chỉ khi phải fetch; cache hit trả luôn kết quả đủ)
+    owner: Tele ID người check → lượt chia pool fetch detail theo user
+    """
+    owner = safe_text(owner) if owner is not None else None
+    cookie = cookie.strip()
+    if "SPC_ST=" not in cookie:
+        return None, "missing_spc_st"
 
-    # ✅ Lưu vào cache
-    set_cached_orders(cookie, details)
+    # ✅ Cache trước; miss → fetch (cùng cookie đang fetch thì chờ chung 1 lần gọi Shopee)
+    result, error = order_cache.get_or_load(
+        cookie_fingerprint(cookie),
+        lambda: _load_order_result(cookie, on_block, owner),
+        should_cache=lambda v: not v[1] and bool(v[0] and v[0]["orders"]),
+    )
 
-    blocks = []
-    for d in details:
-        if isinstance(d, dict):
-            blocks.append(format_order_simple(d))
+    if error:
+        return None, error
 
-    return "\n\n".join(blocks), None
+    return result["html"], None
 
 # =========================================================
 # SPX CHECK
@@ -1847,15 +4349,13 @@ def check_spx(code: str) -> str:
     headers = {
         "Content-Type": "application/json",
         "User-Agent": "Mozilla/5.0",
-        "Connection": "close"
     }
 
     try:
-        r = requests.post(
+        r = http_post(
             SPX_API,
             json=payload,
-            headers=headers,
-            timeout=(5, 10)
+            headers=headers
         )
         data = r.json()
 
@@ -1946,7 +4446,7 @@ def check_ghn(order_code: str, max_steps: int = 4) -> str:
     payload = {"order_code": order_code.strip()}
 
     try:
-        r = requests.post(url, json=payload, headers=headers, timeout=10)
+        r = http_post(url, json=payload, headers=headers)
         r.raise_for_status()
         res = r.json()
     except Exception as e:
@@ -2027,32 +4527,31 @@ ADMIN_IDS = [
 # =========================================================
 # BROADCAST STATE MANAGEMENT (Serverless-safe)
 # =========================================================
-IS_BROADCASTING = False  # Lock để chặn broadcast song song
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "25"))         # tin đang bay tối đa
+BROADCAST_CHECKPOINT_EVERY = int(os.getenv("BROADCAST_CHECKPOINT_EVERY", "200"))  # lưu tiến độ mỗi N user
+# Serverless: thread nền đóng băng sau response → gửi inline tối đa N giây / lượt, checkpoint rồi chờ /thongbao_tiep
+BROADCAST_SLICE_SECONDS = float(os.getenv("BROADCAST_SLICE_SECONDS", "45"))
+
+# Job broadcast đang chạy (rỗng = không có) — thay cờ IS_BROADCASTING
+broadcast_job: Dict[str, Any] = {}
+broadcast_lock = threading.Lock()
 
 def get_broadcast_sheet():
-    """Get or create BroadcastState sheet"""
+    """Get or create BroadcastState sheet (handle giữ lại sau lần đầu)"""
     try:
-        try:
-            return sh.worksheet("BroadcastState")
-        except Exception:
-            ws = sh.add_worksheet("BroadcastState", 100, 4)
-            ws.update('A1:D1', [['Timestamp', 'AdminID', 'Status', 'MessageID']])
-            return ws
+        return sheet_ws("broadcast")
     except Exception as e:
         print(f"[ERROR] get_broadcast_sheet: {e}")
         return None
 
 def get_last_broadcast_time_from_sheet():
     """Lấy thời gian broadcast gần nhất từ sheet"""
-    ws = get_broadcast_sheet()
-    if not ws:
-        return None
     try:
-        all_values = ws.get_all_values()
-        if len(all_values) <= 1:
+        rows = store.broadcast_rows()
+        if not rows:
             return None
 
-        for row in reversed(all_values[1:]):
+        for row in reversed(rows):
             if len(row) >= 3 and row[2] in ["STARTED", "COMPLETED"]:
                 timestamp_str = row[0]
                 dt = datetime.strptime(timestamp_str, "%Y-%m-%d %H:%M:%S")
@@ -2063,17 +4562,16 @@ def get_last_broadcast_time_from_sheet():
         print(f"[ERROR] get_last_broadcast_time_from_sheet: {e}")
         return None
 
-def set_broadcast_state_to_sheet(admin_id, status, message_id=""):
-    """Lưu broadcast state vào sheet"""
-    ws = get_broadcast_sheet()
-    if not ws:
-        return False
+def set_broadcast_state_to_sheet(admin_id, status, message_id="", progress=None, content=""):
+    """Lưu broadcast state vào sheet (progress: checkpoint dạng dict để resume)"""
     try:
-        ws.append_row([
+        store.append_broadcast([
             now().strftime("%Y-%m-%d %H:%M:%S"),
             str(admin_id),
             status,
-            str(message_id)
+            str(message_id),
+            json.dumps(progress, ensure_ascii=False) if progress else "",
+            content
         ])
         print(f"[BROADCAST] State saved: {status}")
         return True
@@ -2086,13 +4584,8 @@ def is_broadcast_message_processed(message_id):
     if not message_id:
         return False
 
-    ws = get_broadcast_sheet()
-    if not ws:
-        return False
-
     try:
-        col_message_ids = ws.col_values(4)
-        return str(message_id) in col_message_ids
+        return store.broadcast_has_message(str(message_id))
     except Exception as e:
         print(f"[ERROR] is_broadcast_message_processed: {e}")
         return False
@@ -2113,11 +4606,191 @@ def check_broadcast_cooldown_from_sheet():
         wait_time = int(BROADCAST_COOLDOWN - time_since_last)
         return False, wait_time
 
-    return True, 0
+    return True, 0
+
+def get_unfinished_broadcast() -> Optional[Dict[str, Any]]:
+    """Broadcast gần nhất đã STARTED nhưng chưa COMPLETED/FAILED (kèm checkpoint cuối)"""
+    try:
+        rows = store.broadcast_rows()
+    except Exception as e:
+        print(f"[ERROR] get_unfinished_broadcast: {e}")
+        return None
+
+    jobs: Dict[str, Dict[str, Any]] = {}
+    last_mid = None
+    for row in rows:
+        row = row + [""] * (6 - len(row))
+        admin_id, status, mid, progress, content = row[1], row[2], row[3], row[4], row[5]
+        if not mid:
+            continue
+        job = jobs.setdefault(mid, {"message_id": mid, "admin_id": admin_id, "content": "", "progress": {}})
+        job["status"] = status
+        if content:
+            job["content"] = content
+        if progress:
+            try:
+                job["progress"] = json.loads(progress)
+            except Exception:
+                pass
+        last_mid = mid
+
+    job = jobs.get(last_mid) if last_mid else None
+    if not job or job["status"] not in ("STARTED", "PROGRESS") or not job["content"]:
+        return None
+    return job
+
+def _broadcast_outcome(res: Dict[str, Any]) -> str:
+    """Phân loại kết quả gửi 1 user"""
+    if res.get("ok"):
+        return "sent"
+    code = res.get("error_code")
+    desc = safe_text(res.get("description")).lower()
+    if code == 403 and "blocked" in desc:
+        return "blocked"
+    if code == 403 and "deactivated" in desc:
+        return "deactivated"
+    if code == 429:
+        return "rate_limited"
+    if code == 400 and "chat not found" in desc:
+        return "not_found"
+    return "failed"
+
+def _format_broadcast_counts(counts: Dict[str, int]) -> str:
+    return (
+        f"• Thành công: {counts.get('sent', 0)} users\n"
+        f"• Chặn bot: {counts.get('blocked', 0)} users\n"
+        f"• Tài khoản đã xóa: {counts.get('deactivated', 0)} users\n"
+        f"• Không tìm thấy chat: {counts.get('not_found', 0)} users\n"
+        f"• Bị giới hạn (429): {counts.get('rate_limited', 0)} users\n"
+        f"• Lỗi khác: {counts.get('failed', 0)} users"
+    )
+
+def run_broadcast(chat_id: Any, admin_id: Any, message_id: Any, message_content: str,
+                  start_after_row: int = 0, counts: Optional[Dict[str, int]] = None,
+                  deadline: Optional[float] = None) -> None:
+    """
+    Job broadcast (thread riêng, không giữ webhook):
+    - Gửi qua outbox Telegram (tôn trọng rate limit), tối đa BROADCAST_CONCURRENCY tin đang bay
+    - Đếm kết quả thật từng user (blocked / deactivated / 429 ...)
+    - Checkpoint dòng sheet đã xong mỗi BROADCAST_CHECKPOINT_EVERY user → resume được
+    - deadline (serverless): hết giờ → checkpoint + báo admin gõ /thongbao_tiep
+    """
+    counts = dict(counts or {})
+    try:
+        recipients = []
+        seen = set()
+        for row_idx, user in get_all_users_cached():
+            uid = safe_text(user.get("Tele ID"))
+            if row_idx <= start_after_row or not uid.isdigit() or uid in seen:
+                continue
+            seen.add(uid)
+            recipients.append((row_idx, uid))
+
+        total = len(recipients)
+        done_before = sum(counts.values())
+        with broadcast_lock:
+            broadcast_job.update({"total": total + done_before, "done": done_before, "started": time.time()})
+
+        full_message = (
+            f"📢 <b>THÔNG BÁO TỪ ADMIN</b>\n"
+            f"━━━━━━━━━━━━━━━\n\n"
+            f"{message_content}\n\n"
+            f"━━━━━━━━━━━━━━━\n"
+            f"<i>Từ: NgânMiu.Store Bot System</i>"
+        )
+
+        started = time.time()
+        last_checkpoint = 0
+        for i in range(0, total, BROADCAST_CONCURRENCY):
+            chunk = recipients[i:i + BROADCAST_CONCURRENCY]
+            futures = [(uid, tg_send(uid, full_message)) for _, uid in chunk]
+            for uid, fut in futures:
+                try:
+                    outcome = _broadcast_outcome(fut.result(timeout=120))
+                except Exception:
+                    outcome = "failed"
+                counts[outcome] = counts.get(outcome, 0) + 1
+                if outcome != "sent":
+                    print(f"[BROADCAST] {uid}: {outcome}")
+
+            done = i + len(chunk)
+            elapsed = max(time.time() - started, 0.001)
+            rate = done / elapsed
+            with broadcast_lock:
+                broadcast_job.update({"done": done + done_before, "rate": rate, "eta": (total - done) / rate})
+
+            if deadline and time.time() >= deadline and done < total:
+                progress = dict(counts, row=chunk[-1][0])
+                set_broadcast_state_to_sheet(admin_id, "PROGRESS", message_id, progress)
+                tg_send(
+                    chat_id,
+                    f"⏸ <b>TẠM DỪNG BROADCAST</b> (serverless, {BROADCAST_SLICE_SECONDS:.0f}s / lượt)\n\n"
+                    f"📤 Đã gửi: {done + done_before}/{total + done_before}\n"
+                    f"👉 Gõ <code>/thongbao_tiep</code> để gửi tiếp"
+                )
+                return
+
+            if done - last_checkpoint >= BROADCAST_CHECKPOINT_EVERY and done < total:
+                last_checkpoint = done
+                progress = dict(counts, row=chunk[-1][0])
+                set_broadcast_state_to_sheet(admin_id, "PROGRESS", message_id, progress)
+                tg_send(
+                    chat_id,
+                    f"📤 <b>ĐANG GỬI:</b> {done + done_before}/{total + done_before}\n"
+                    f"⚡ {rate:.1f} msg/s · ⏱️ còn ~{(total - done) / rate:.0f}s"
+                )
+
+        set_broadcast_state_to_sheet(admin_id, "COMPLETED", message_id, counts)
+
+        elapsed = max(time.time() - started, 0.001)
+        tg_send(
+            chat_id,
+            f"✅ <b>GỬI THÔNG BÁO HOÀN TẤT</b>\n\n"
+            f"📊 <b>Kết quả:</b>\n"
+            f"{_format_broadcast_counts(counts)}\n"
+            f"• Tổng cộng: {total + done_before} users\n\n"
+            f"⚡ {total / elapsed:.1f} msg/s trong {elapsed:.0f}s"
+        )
+
+    except Exception as e:
+        set_broadcast_state_to_sheet(admin_id, "FAILED", message_id, counts)
+        tg_send(chat_id, f"❌ <b>LỖI GỬI THÔNG BÁO</b>\n\n{esc(str(e))}")
+        traceback.print_exc()
+
+    finally:
+        with broadcast_lock:
+            broadcast_job.clear()
+
+def _start_broadcast_job(chat_id: Any, admin_id: Any, message_id: Any, message_content: str,
+                         start_after_row: int = 0, counts: Optional[Dict[str, int]] = None,
+                         notice: str = "") -> bool:
+    """
+    Chiếm slot broadcast (chỉ 1 job / process), gửi notice cho admin rồi chạy job
+    - Process thường trực: thread nền
+    - Serverless: chạy inline 1 lượt BROADCAST_SLICE_SECONDS (thread nền sẽ bị đóng băng), phần còn lại /thongbao_tiep
+    """
+    with broadcast_lock:
+        if broadcast_job:
+            return False
+        broadcast_job.update({"message_id": message_id, "total": 0, "done": 0, "started": time.time()})
+
+    if notice:
+        tg_send(chat_id, notice)
+
+    if SERVERLESS:
+        run_broadcast(chat_id, admin_id, message_id, message_content, start_after_row, counts,
+                      deadline=time.time() + BROADCAST_SLICE_SECONDS)
+        return True
+
+    threading.Thread(
+        target=run_broadcast,
+        args=(chat_id, admin_id, message_id, message_content, start_after_row, counts),
+        daemon=True
+    ).start()
+    return True
 
 def handle_thongbao(chat_id: Any, tele_id: Any, username: str, text: str, message_id: int) -> None:
     """3 lớp bảo vệ broadcast"""
-    global IS_BROADCASTING
 
     if tele_id not in ADMIN_IDS:
         tg_send(chat_id, "❌ <b>KHÔNG CÓ QUYỀN</b>\n\nChỉ admin mới được sử dụng lệnh này.")
@@ -2134,7 +4807,8 @@ def handle_thongbao(chat_id: Any, tele_id: Any, username: str, text: str, messag
             "<code>/thongbao Hệ thống bảo trì từ 22h-23h tối nay</code>\n\n"
             "💡 <b>Lưu ý:</b>\n"
             "• Hỗ trợ HTML: &lt;b&gt;bold&lt;/b&gt;, &lt;i&gt;italic&lt;/i&gt;\n"
-            "• Chống spam: 3 lớp bảo vệ tự động"
+            "• Chống spam: 3 lớp bảo vệ tự động\n"
+            "• Broadcast bị ngắt (restart): <code>/thongbao_tiep</code> để gửi tiếp"
         )
         return
 
@@ -2161,94 +4835,59 @@ def handle_thongbao(chat_id: Any, tele_id: Any, username: str, text: str, messag
         print(f"[BROADCAST] ❌ BLOCKED - Cooldown: {wait_time}s")
         return
 
-    if IS_BROADCASTING:
+    total_users = len(get_all_users_cached())
+    if not total_users:
+        tg_send(chat_id, "❌ Không tìm thấy user nào trong Sheet")
+        return
+
+    with broadcast_lock:
+        running = bool(broadcast_job)
+    if running:
         tg_send(chat_id, "⛔ <b>ĐANG CÓ BROADCAST KHÁC CHẠY</b>\n\nVui lòng đợi broadcast trước hoàn tất.")
         print(f"[BROADCAST] ❌ BLOCKED - Already broadcasting")
         return
 
-    IS_BROADCASTING = True
-
-    try:
-        try:
-            values = ws_user.get_all_values()
-        except Exception:
-            IS_BROADCASTING = False
-            tg_send(chat_id, "❌ Không thể đọc danh sách users từ Sheet")
-            return
-
-        if not values or len(values) < 2:
-            IS_BROADCASTING = False
-            tg_send(chat_id, "❌ Không tìm thấy user nào trong Sheet")
-            return
-
-        total_users = len(values) - 1
-
-        if not set_broadcast_state_to_sheet(tele_id, "STARTED", message_id):
-            IS_BROADCASTING = False
-            tg_send(chat_id, "❌ Lỗi khi lưu trạng thái broadcast")
-            return
-
-        tg_send(
-            chat_id,
-            f"📢 <b>ĐANG GỬI THÔNG BÁO...</b>\n\n"
-            f"👥 Tổng số users: <b>{total_users}</b>\n"
-            f"⏱️ Thời gian ước tính: ~{total_users * 0.1:.0f}s\n\n"
-            f"━━━━━━━━━━━━━━━\n"
-            f"{message_content}\n"
-            f"━━━━━━━━━━━━━━━"
-        )
-
-        success_count = 0
-        fail_count = 0
-        sent_to = set()
-
-        for row in values[1:]:
-            if not row or len(row) < 1:
-                continue
-
-            user_tele_id = safe_text(row[0])
-            if not user_tele_id or not user_tele_id.isdigit():
-                continue
-
-            if user_tele_id in sent_to:
-                continue
-
-            try:
-                full_message = (
-                    f"📢 <b>THÔNG BÁO TỪ ADMIN</b>\n"
-                    f"━━━━━━━━━━━━━━━\n\n"
-                    f"{message_content}\n\n"
-                    f"━━━━━━━━━━━━━━━\n"
-                    f"<i>Từ: NgânMiu.Store Bot System</i>"
-                )
-
-                tg_send(user_tele_id, full_message)
-                sent_to.add(user_tele_id)
-                success_count += 1
-                time.sleep(0.05)
+    if not set_broadcast_state_to_sheet(tele_id, "STARTED", message_id, content=message_content):
+        tg_send(chat_id, "❌ Lỗi khi lưu trạng thái broadcast")
+        return
 
-            except Exception as e:
-                fail_count += 1
-                print(f"[BROADCAST] Failed to send to {user_tele_id}: {e}")
+    eta = total_users / max(min(TG_GLOBAL_RATE, BROADCAST_CONCURRENCY), 1)
+    notice = (
+        f"📢 <b>ĐANG GỬI THÔNG BÁO...</b>\n\n"
+        f"👥 Tổng số users: <b>{total_users}</b>\n"
+        f"⏱️ Thời gian ước tính: ~{eta:.0f}s\n"
+        + (f"⚠️ Serverless: mỗi lượt gửi tối đa {BROADCAST_SLICE_SECONDS:.0f}s, "
+           f"còn dở thì gõ <code>/thongbao_tiep</code>\n" if SERVERLESS else "")
+        + f"\n━━━━━━━━━━━━━━━\n"
+        f"{message_content}\n"
+        f"━━━━━━━━━━━━━━━"
+    )
+    if not _start_broadcast_job(chat_id, tele_id, message_id, message_content, notice=notice):
+        tg_send(chat_id, "⛔ <b>ĐANG CÓ BROADCAST KHÁC CHẠY</b>\n\nVui lòng đợi broadcast trước hoàn tất.")
 
-        set_broadcast_state_to_sheet(tele_id, "COMPLETED", message_id)
+def handle_thongbao_resume(chat_id: Any, tele_id: Any) -> None:
+    """Gửi tiếp broadcast bị ngắt giữa chừng (từ checkpoint cuối trong BroadcastState)"""
+    if tele_id not in ADMIN_IDS:
+        tg_send(chat_id, "❌ <b>KHÔNG CÓ QUYỀN</b>\n\nChỉ admin mới được sử dụng lệnh này.")
+        return
 
-        tg_send(
-            chat_id,
-            f"✅ <b>GỬI THÔNG BÁO HOÀN TẤT</b>\n\n"
-            f"📊 <b>Kết quả:</b>\n"
-            f"• Thành công: {success_count} users\n"
-            f"• Thất bại: {fail_count} users\n"
-            f"• Tổng cộng: {total_users} users"
-        )
+    job = get_unfinished_broadcast()
+    if not job:
+        tg_send(chat_id, "✅ <b>Không có broadcast nào bị dở dang</b>")
+        return
 
-    except Exception as e:
-        set_broadcast_state_to_sheet(tele_id, "FAILED", message_id)
-        tg_send(chat_id, f"❌ <b>LỖI GỬI THÔNG BÁO</b>\n\n{str(e)}")
-        traceback.print_exc()
+    progress = dict(job["progress"])
+    start_after_row = safe_int(progress.pop("row", 0))
+    counts = {k: safe_int(v) for k, v in progress.items()}
 
-    finally:
-        IS_BROADCASTING = False
+    notice = (
+        f"🔁 <b>GỬI TIẾP BROADCAST</b> #{esc(job['message_id'])}\n\n"
+        f"📍 Từ sau dòng sheet: <b>{start_after_row}</b>\n"
+        f"📊 Đã gửi trước đó: <b>{sum(counts.values())}</b> users"
+    )
+    if not _start_broadcast_job(chat_id, tele_id, job["message_id"], job["content"], start_after_row, counts,
+                                notice=notice):
+        tg_send(chat_id, "⛔ <b>ĐANG CÓ BROADCAST KHÁC CHẠY</b>\n\nVui lòng đợi broadcast trước hoàn tất.")
 
 # =========================================================
 # 🔑 GET COOKIE QR HANDLER
@@ -2282,19 +4921,25 @@ def handle_get_cookie_qr(chat_id: Any, tele_id: Any, username: str) -> None:
             tg_send(chat_id, format_insufficient_balance_msg(current_balance, PRICE_GET_COOKIE))
             return
 
-    # Cooldown QR (60s) — lấy session gần nhất trong RAM
+    # Cooldown QR (60s) — session gần nhất của user (index theo user)
     current_time = time.time()
-    with qr_lock:
-        user_sessions = [s for s in qr_sessions.values() if s.get("user_id") == tele_id]
+    latest = qr_store.latest_for_user(tele_id)
 
-    if user_sessions:
-        latest_session = max(user_sessions, key=lambda x: x.get("created", 0))
+    if latest:
+        latest_session = latest[1]
         time_since_last = current_time - latest_session.get("created", 0)
         if time_since_last < QR_COOLDOWN_SECONDS:
             wait_time = int(QR_COOLDOWN_SECONDS - time_since_last)
             tg_send(chat_id, f"⏳ <b>VUI LÒNG ĐỢI {wait_time}s</b>\n\nChờ {wait_time} giây nữa trước khi tạo QR mới.")
             return
 
+    # Giới hạn số QR tạo trong cửa sổ (RATE_LIMITS "qr") — chặn mềm, không tính strike
+    allowed, retry_after, _ = rate_limiter.hit(normalize_tele_id(tele_id), [("qr", 1)])
+    if not allowed:
+        wait_time = int(retry_after) + 1
+        tg_send(chat_id, f"⏳ <b>TẠO QR QUÁ NHIỀU</b>\n\nThử lại sau <b>{wait_time}s</b>.")
+        return
+
     tg_send(chat_id, "🔄 <b>Đang tạo mã QR đăng nhập Shopee...</b>")
 
     success, session_id, qr_image = create_qr_session(tele_id)
@@ -2308,7 +4953,7 @@ def handle_get_cookie_qr(chat_id: Any, tele_id: Any, username: str) -> None:
         "2️⃣ <b>Ở Trang Chủ - Góc trên bên trái - Ô Vuông cạnh Shopee Pay - Bấm vào để Quét QR</b>\n"
         "3️⃣ <b>Quét mã bên dưới</b>\n\n"
         "⚠️ QR có hiệu lực trong <b>5 phút</b>\n"
-        "🤖 Bot sẽ <b>tự kiểm tra</b> mỗi <b>3 giây</b> và tự trả cookie sau khi bạn quét.\n"
+        "🤖 Bot sẽ <b>tự kiểm tra</b> liên tục và tự trả cookie sau khi bạn quét.\n"
         "👉 Nếu chưa thấy trả cookie, bấm <b>🔄 Check QR Status</b> ngay dưới ảnh"
     )
 
@@ -2320,43 +4965,11 @@ def handle_get_cookie_qr(chat_id: Any, tele_id: Any, username: str) -> None:
     log_qr(tele_id, username, session_id, "created", (current_balance if BOT1_API_URL else balance), "QR created")
 
     # Lưu thêm thông tin để auto watcher có thể gửi lại cookie
-    with qr_lock:
-        if session_id in qr_sessions:
-            qr_sessions[session_id]["chat_id"] = chat_id
-            qr_sessions[session_id]["username"] = username
-            qr_sessions[session_id]["cancelled"] = False
-            qr_sessions[session_id]["paid"] = False
-            qr_sessions[session_id]["fee"] = PRICE_GET_COOKIE
-
-    # ✅ AUTO (FAST): chờ nhanh trong CHÍNH request này (giúp serverless trả cookie nhanh nếu bạn quét liền)
-    if AUTO_QR:
-        try:
-            tg_send(
-                chat_id,
-                f"🤖 <b>Auto đang bật</b> — bot đang chờ bạn quét trong <b>{AUTO_QR_FAST_SECONDS}s</b>...\\n\\n"
-                f"<i>Nếu bạn quét muộn hơn, vẫn có thể bấm 🔄 Check QR Status.</i>"
-            )
-
-            started_fast = time.time()
-            while time.time() - started_fast < AUTO_QR_FAST_SECONDS:
-                ok, status, has_token = check_qr_status(session_id)
-                st = (status or "").strip().upper()
-
-                if ok and (has_token or st in SCANNED_STATUSES or (st and st not in PENDING_STATUSES)):
-                    ok2, cookie2 = get_qr_cookie(session_id)
-                    if ok2 and cookie2:
-                        _send_cookie_success(chat_id, tele_id, username, session_id, cookie2)
-                        return
-
-                time.sleep(QR_POLL_INTERVAL)
-
-            # ✅ AUTO (BG): fallback thread (chỉ ổn định khi bot chạy server luôn-on)
-            t = threading.Thread(target=_auto_watch_qr_and_send_cookie, args=(session_id,), daemon=True)
-            t.start()
-
-        except Exception:
-            pass
+    qr_store.update(session_id, chat_id=chat_id, username=username, fee=PRICE_GET_COOKIE)
 
+    # ✅ AUTO: giao session cho QR scheduler (không giữ request, không tạo thread riêng)
+    if AUTO_QR:
+        schedule_qr_watch(session_id, QR_POLL_FAST)
 
     tg_send(
         chat_id,
@@ -2366,113 +4979,181 @@ def handle_get_cookie_qr(chat_id: Any, tele_id: Any, username: str) -> None:
         get_cookie_keyboard()
     )
 
-def _auto_watch_qr_and_send_cookie(session_id: str):
+# =========================================================
+# 🔥 QR WATCH SCHEDULER (heap due-time + worker pool)
+# =========================================================
+qr_watch_heap: List[Tuple[float, int, str]] = []  # (due_ts, seq, session_id)
+qr_watch_cond = threading.Condition()
+qr_watch_seq = 0
+qr_watch_executor = ThreadPoolExecutor(max_workers=QR_WATCH_WORKERS, thread_name_prefix="qr-watch")
+_qr_scheduler_pid = None
+
+def _qr_poll_interval(age: float) -> float:
+    """Poll dày lúc mới tạo, thưa dần về sau"""
+    if age < 30:
+        return QR_POLL_FAST
+    if age < 120:
+        return QR_POLL_INTERVAL
+    return QR_POLL_SLOW
+
+def schedule_qr_watch(session_id: str, delay: float) -> None:
+    global qr_watch_seq
+    _ensure_qr_scheduler()
+    with qr_watch_cond:
+        qr_watch_seq += 1
+        heapq.heappush(qr_watch_heap, (time.time() + delay, qr_watch_seq, session_id))
+        qr_watch_cond.notify()
+
+def qr_scheduler_worker():
+    """Lấy mọi session đến hạn → giao cho worker pool"""
+    while True:
+        with qr_watch_cond:
+            while True:
+                current = time.time()
+                if qr_watch_heap and qr_watch_heap[0][0] <= current:
+                    break
+                qr_watch_cond.wait(timeout=(qr_watch_heap[0][0] - current) if qr_watch_heap else None)
+
+            due = []
+            while qr_watch_heap and qr_watch_heap[0][0] <= current:
+                due.append(heapq.heappop(qr_watch_heap)[2])
+
+        qr_watch_executor.submit(_run_qr_watch_round, due)
+
+def _ensure_qr_scheduler() -> None:
+    global _qr_scheduler_pid
+    if _qr_scheduler_pid == os.getpid():
+        return
+    with qr_watch_cond:
+        if _qr_scheduler_pid == os.getpid():
+            return
+        threading.Thread(target=qr_scheduler_worker, name="qr-scheduler", daemon=True).start()
+        _qr_scheduler_pid = os.getpid()
+
+def resume_qr_watchers() -> int:
+    """Sau restart (store bền): giao lại cho scheduler mọi session còn sống có chat_id"""
+    if not AUTO_QR:
+        return 0
+    resumed = 0
+    for sid, sess in qr_store.live():
+        if sess.get("chat_id") and sess.get("status") in ("waiting", "scanned", "paying", "unpaid", "paid"):
+            schedule_qr_watch(sid, QR_POLL_FAST)
+            resumed += 1
+    if resumed:
+        print(f"[QR] ♻️ Resumed {resumed} QR watchers from {QR_STORE} store")
+    return resumed
+
+def _run_qr_watch_round(session_ids: List[str]) -> None:
+    """1 vòng: lấy status mọi session đến hạn theo lô → xử lý từng session"""
+    current = time.time()
+    live = []
+    for sid in session_ids:
+        sess = qr_store.get(sid)
+        if (
+            sess
+            and sess.get("status") in ("waiting", "scanned", "unpaid", "paid")
+            and current - sess.get("created", 0) <= min(QR_TIMEOUT, AUTO_QR_MAX_SECONDS)
+        ):
+            live.append(sid)
+
+    statuses = fetch_qr_statuses(live)
+
+    # Session 1 mình thì xử lý luôn; nhiều thì chia cho worker (get_qr_cookie / gửi tin có thể chậm)
+    if len(session_ids) == 1:
+        _run_qr_watch_tick(session_ids[0], statuses.get(session_ids[0]))
+        return
+    for sid in session_ids:
+        qr_watch_executor.submit(_run_qr_watch_tick, sid, statuses.get(sid))
+
+def _run_qr_watch_tick(session_id: str, prefetched: Optional[Tuple[int, Optional[dict]]] = None) -> None:
+    try:
+        delay = _qr_watch_tick(session_id, prefetched)
+    except Exception as e:
+        delay = None
+        sess = qr_store.get(session_id)
+        if sess:
+            tg_send(
+                sess.get("chat_id"),
+                f"❌ <b>Lỗi theo dõi QR</b>\n\n{esc(str(e))}\n\n"
+                "👉 Bạn có thể bấm <b>🔄 Check QR Status</b> để thử lại.",
+                get_cookie_keyboard()
+            )
+
+    if delay is not None:
+        schedule_qr_watch(session_id, delay)
+
+def _qr_watch_tick(session_id: str, prefetched: Optional[Tuple[int, Optional[dict]]] = None) -> Optional[float]:
     """
-    ✅ RÚT GỌN: Tự động poll QR → lấy cookie → trả về user
-    - Đợi 3s rồi gửi thông báo nhắc quét
-    - Check mỗi 3s cho đến khi quét xong hoặc timeout
+    1 lượt theo dõi QR: poll status → lấy cookie → trả về user
+    Returns: số giây tới lượt kế tiếp, None = dừng theo dõi
     """
-    try:
-        # ✅ Đợi 3 giây trước khi gửi thông báo
-        time.sleep(3)
-        
-        with qr_lock:
-            sess = qr_sessions.get(session_id)
-        
-        if not sess or sess.get("cancelled"):
-            return
-            
-        chat_id = sess.get("chat_id")
-        
-        # ✅ Gửi thông báo nhắc quét (RÚT GỌN)
+    sess = qr_store.get(session_id)
+
+    if not sess or sess.get("status") in ("done", "expired", "cancelled"):
+        return None
+
+    tele_id = sess.get("user_id")
+    chat_id = sess.get("chat_id")
+    username = sess.get("username") or ""
+    age = time.time() - sess.get("created", 0)
+
+    # Thread khác đang trừ tiền → không hết hạn / lấy cookie chen vào, chờ kết quả (quá lâu = bị ngắt → xử lý lại)
+    if sess.get("status") == "paying" and time.time() - float(sess.get("pay_started") or 0) <= QR_PAY_STALE_SECONDS:
+        return QR_POLL_FAST
+    if sess.get("status") == "paying" and sess.get("cookie"):
+        _send_cookie_success(chat_id, tele_id, username, session_id,
+                             sess["cookie"], sess.get("cookie_f"), sess.get("user_info"))
+        return None
+
+    # Timeout tổng
+    if age > AUTO_QR_MAX_SECONDS:
         tg_send(
             chat_id,
-            "⏳ <b>VUI LÒNG QUÉT MÃ QR</b>\n\n"
-            "📱 Mở Shopee App → Quét QR\n"
-            "⚠️ QR có hiệu lực trong 5 phút"
+            "⏰ <b>HẾT THỜI GIAN</b>\n\n"
+            "❌ QR đã hết hiệu lực (5 phút)\n"
+            "👉 Vui lòng tạo QR mới",
+            main_keyboard()
         )
-        
-        started = time.time()
-        last_login_try = 0
-
-        while True:
-            # Timeout tổng
-            if time.time() - started > AUTO_QR_MAX_SECONDS:
-                with qr_lock:
-                    sess = qr_sessions.get(session_id)
-                if sess:
-                    tg_send(
-                        sess.get("chat_id"), 
-                        "⏰ <b>HẾT THỜI GIAN</b>\n\n"
-                        "❌ QR đã hết hiệu lực (5 phút)\n"
-                        "👉 Vui lòng tạo QR mới", 
-                        main_keyboard()
-                    )
-                    log_qr(sess.get("user_id"), sess.get("username",""), session_id, "expired", 0, "Auto timeout")
-                    with qr_lock:
-                        qr_sessions.pop(session_id, None)
-                return
-
-            with qr_lock:
-                sess = qr_sessions.get(session_id)
+        log_qr(tele_id, username, session_id, "expired", 0, "Auto timeout")
+        qr_store.delete(session_id)
+        return None
 
-            if not sess or sess.get("cancelled"):
-                return
+    interval = _qr_poll_interval(age)
 
-            tele_id = sess.get("user_id")
-            chat_id = sess.get("chat_id")
-            username = sess.get("username") or ""
-
-            # Check status (giờ có thêm cookie_st và cookie_f)
-            ok, status, has_token, cookie_st, cookie_f = check_qr_status(session_id)
-
-            # Nếu API status lỗi, thử login thưa thớt
-            if not ok and status in ("API_ERROR", "CHECK_ERROR"):
-                if time.time() - last_login_try > 2:
-                    last_login_try = time.time()
-                    ok2, cookie2, cookie_f2, user_info2 = get_qr_cookie(session_id)
-                    if ok2 and cookie2:
-                        _send_cookie_success(chat_id, tele_id, username, session_id, cookie2, cookie_f2, user_info2)
-                        return
-                time.sleep(QR_POLL_INTERVAL)
-                continue
+    # Check status (giờ có thêm cookie_st và cookie_f)
+    ok, status, has_token, cookie_st, cookie_f = check_qr_status(session_id, prefetched)
 
-            if not ok and status == "EXPIRED":
-                tg_send(
-                    chat_id, 
-                    "⏰ <b>HẾT THỜI GIAN</b>\n\n"
-                    "❌ QR đã hết hiệu lực (5 phút)\n"
-                    "👉 Vui lòng tạo QR mới", 
-                    main_keyboard()
-                )
-                log_qr(tele_id, username, session_id, "expired", 0, "Expired")
-                with qr_lock:
-                    qr_sessions.pop(session_id, None)
-                return
+    # Nếu API status lỗi, thử login thưa thớt
+    if not ok and (status.startswith("API_ERROR") or status == "CHECK_ERROR"):
+        if time.time() - sess.get("last_login_try", 0) > 2:
+            qr_store.update(session_id, last_login_try=time.time())
+            ok2, cookie2, cookie_f2, user_info2 = get_qr_cookie(session_id)
+            if ok2 and cookie2:
+                _send_cookie_success(chat_id, tele_id, username, session_id, cookie2, cookie_f2, user_info2)
+                return None
+        return interval
 
-            # Nếu đã quét
-            st = (status or "").strip().upper()
-            if ok and (has_token or st in SCANNED_STATUSES or (st and st not in PENDING_STATUSES)):
-                ok2, cookie, cookie_f, user_info = get_qr_cookie(session_id)
-                if ok2 and cookie:
-                    _send_cookie_success(chat_id, tele_id, username, session_id, cookie, cookie_f, user_info)
-                    return
+    if not ok and status == "EXPIRED":
+        tg_send(
+            chat_id,
+            "⏰ <b>HẾT THỜI GIAN</b>\n\n"
+            "❌ QR đã hết hiệu lực (5 phút)\n"
+            "👉 Vui lòng tạo QR mới",
+            main_keyboard()
+        )
+        log_qr(tele_id, username, session_id, "expired", 0, "Expired")
+        qr_store.delete(session_id)
+        return None
 
-            time.sleep(QR_POLL_INTERVAL)
+    # Nếu đã quét
+    st = (status or "").strip().upper()
+    if ok and (has_token or st in SCANNED_STATUSES or (st and st not in PENDING_STATUSES)):
+        ok2, cookie, cookie_f2, user_info = get_qr_cookie(session_id)
+        if ok2 and cookie:
+            _send_cookie_success(chat_id, tele_id, username, session_id, cookie, cookie_f2, user_info)
+            return None
 
-    except Exception as e:
-        try:
-            with qr_lock:
-                sess = qr_sessions.get(session_id)
-            if sess:
-                tg_send(
-                    sess.get("chat_id"), 
-                    f"❌ <b>Lỗi theo dõi QR</b>\n\n{esc(str(e))}\n\n"
-                    "👉 Bạn có thể bấm <b>🔄 Check QR Status</b> để thử lại.", 
-                    get_cookie_keyboard()
-                )
-        except Exception:
-            pass
+    return interval
 
 
 def _send_cookie_success(chat_id: Any, tele_id: Any, username: str, session_id: str, 
@@ -2488,11 +5169,10 @@ def _send_cookie_success(chat_id: Any, tele_id: Any, username: str, session_id:
     fee = PRICE_GET_COOKIE if BOT1_API_URL else 0
 
     # Lấy config từ session (nếu có)
-    with qr_lock:
-        sess = qr_sessions.get(session_id, {}) if session_id else {}
+    sess = (qr_store.get(session_id) if session_id else None) or {}
     if sess:
         fee = safe_int(sess.get("fee"), fee)
-        already_paid = bool(sess.get("paid"))
+        already_paid = sess.get("status") in ("paid", "done")
     else:
         already_paid = False
 
@@ -2500,8 +5180,21 @@ def _send_cookie_success(chat_id: Any, tele_id: Any, username: str, session_id:
 
     # ================= PAYMENT (chỉ khi bot1 active) =================
     if BOT1_API_URL and fee > 0 and not already_paid:
+        # Giữ session TRƯỚC khi trừ tiền → hủy / hết hạn không chen vào giữa, 2 thread không cùng thu phí
+        if sess.get("status") == "paying" and time.time() - float(sess.get("pay_started") or 0) > QR_PAY_STALE_SECONDS:
+            # Lần trước bị ngắt giữa chừng (restart) → giữ lại từ đầu (op_key giữ cho lần trừ lặp lại không thu 2 lần)
+            qr_store.transition(session_id, "unpaid")
+        if not qr_store.transition(session_id, "paying", pay_started=time.time()):
+            cur = (qr_store.get(session_id) or {}).get("status")
+            if cur in ("paying", "paid", "done"):
+                tg_send(chat_id, "⏳ <b>Đang xử lý thanh toán cho QR này...</b>", main_keyboard())
+            else:
+                tg_send(chat_id, "❌ <b>QR đã hết hạn hoặc bị hủy</b>\n\nBấm <b>🔑 Get Cookie QR</b> để tạo QR mới.", main_keyboard())
+            return
+
         ok_bal, bal, err = check_balance_bot1(tele_id)
         if not ok_bal:
+            qr_store.transition(session_id, "unpaid")
             tg_send(
                 chat_id,
                 f"⚠️ <b>Lỗi hệ thống thanh toán:</b> {esc(err)}\n\n"
@@ -2512,6 +5205,7 @@ def _send_cookie_success(chat_id: Any, tele_id: Any, username: str, session_id:
             return
 
         if bal < fee:
+            qr_store.transition(session_id, "unpaid")
             tg_send(
                 chat_id,
                 format_insufficient_balance_msg(bal, fee) +
@@ -2522,9 +5216,11 @@ def _send_cookie_success(chat_id: Any, tele_id: Any, username: str, session_id:
             return
 
         ok_d, new_bal, err2 = deduct_balance_bot1(
-            tele_id, fee, "Get Cookie QR Shopee (success)", username
+            tele_id, fee, "Get Cookie QR Shopee (success)", username,
+            op_key=f"get_cookie:{session_id}"
         )
         if not ok_d:
+            qr_store.transition(session_id, "unpaid")
             tg_send(
                 chat_id,
                 f"⚠️ <b>Không trừ được tiền:</b> {esc(err2)}\n\n"
@@ -2535,9 +5231,7 @@ def _send_cookie_success(chat_id: Any, tele_id: Any, username: str, session_id:
             return
 
         balance_after = new_bal
-        with qr_lock:
-            if session_id in qr_sessions:
-                qr_sessions[session_id]["paid"] = True
+        qr_store.transition(session_id, "paid", paid_at=time.time())
 
     elif BOT1_API_URL and fee > 0 and already_paid:
         # Đã thu tiền trước đó (user bấm lại) → lấy số dư mới nhất để hiển thị
@@ -2586,38 +5280,37 @@ def _send_cookie_success(chat_id: Any, tele_id: Any, username: str, session_id:
 
     log_qr(tele_id, username, session_id, "success", balance_after, "Cookie delivered")
 
-    with qr_lock:
-        qr_sessions.pop(session_id, None)
+    qr_store.transition(session_id, "done")
+    qr_store.delete(session_id)
 
 def handle_check_qr_status(chat_id: Any, tele_id: Any, username: str, session_id: Optional[str] = None) -> None:
     """Kiểm tra trạng thái QR (hỗ trợ inline button theo session_id)"""
 
     tele_id = int(tele_id) if safe_text(tele_id).isdigit() else tele_id
 
-    # Lấy session hợp lệ (ưu tiên session_id được truyền vào)
-    with qr_lock:
-        if session_id and session_id in qr_sessions and qr_sessions[session_id].get("user_id") == tele_id:
-            sid = session_id
-        else:
-            user_sessions = [s for s, sess in qr_sessions.items() if sess.get("user_id") == tele_id]
-            sid = max(user_sessions, key=lambda s: qr_sessions[s].get("created", 0)) if user_sessions else None
+    # Lấy session hợp lệ (ưu tiên session_id được truyền vào, sau đó session mới nhất của user)
+    sid, sess = None, None
+    if session_id:
+        s0 = qr_store.get(session_id)
+        if s0 and _qr_user_key(s0.get("user_id")) == _qr_user_key(tele_id):
+            sid, sess = session_id, s0
+    if not sid:
+        latest = qr_store.latest_for_user(tele_id)
+        if latest:
+            sid, sess = latest
 
     if not sid:
         tg_send(chat_id, "❌ <b>Không tìm thấy QR session</b>\n\nBấm <b>🔑 Get Cookie QR</b> để tạo QR mới.", main_keyboard())
         return
 
     # Nếu session đã có cookie (ví dụ: quét xong nhưng chưa thu phí/ chưa gửi) → gửi luôn
-    with qr_lock:
-        sess = qr_sessions.get(sid, {})
-        cached_cookie = safe_text(sess.get("cookie", "")).strip()
-        cached_cookie_f = sess.get("cookie_f")
-        cached_user_info = sess.get("user_info")
-        cancelled = bool(sess.get("cancelled", False))
-
-    if cancelled:
+    cached_cookie = safe_text(sess.get("cookie", "")).strip()
+    cached_cookie_f = sess.get("cookie_f")
+    cached_user_info = sess.get("user_info")
+
+    if sess.get("status") == "cancelled":
         tg_send(chat_id, "❌ <b>QR đã bị hủy</b>\n\nBấm <b>🔑 Get Cookie QR</b> để tạo QR mới.", main_keyboard())
-        with qr_lock:
-            qr_sessions.pop(sid, None)
+        qr_store.delete(sid)
         return
 
     if cached_cookie:
@@ -2636,8 +5329,7 @@ def handle_check_qr_status(chat_id: Any, tele_id: Any, username: str, session_id
                 "👉 Bấm <b>🔑 Get Cookie QR</b> để tạo QR mới.",
                 main_keyboard()
             )
-            with qr_lock:
-                qr_sessions.pop(sid, None)
+            qr_store.delete(sid)
         else:
             tg_send(chat_id, f"❌ <b>Lỗi kiểm tra QR:</b>\n{esc(status)}", get_cookie_keyboard())
         return
@@ -2664,7 +5356,7 @@ def handle_check_qr_status(chat_id: Any, tele_id: Any, username: str, session_id
         chat_id,
         "⏳ <b>CHƯA QUÉT QR</b>\n\n"
         "Mở app Shopee và quét mã QR đã gửi.\n\n"
-        "👉 Sau khi quét, bot sẽ tự check mỗi 3s. Nếu chưa thấy trả cookie, bấm <b>🔄 Check QR Status</b> lại.",
+        "👉 Sau khi quét, bot sẽ tự check liên tục. Nếu chưa thấy trả cookie, bấm <b>🔄 Check QR Status</b> lại.",
         get_cookie_keyboard()
     )
 
@@ -2676,18 +5368,17 @@ def handle_cancel_qr(chat_id: Any, tele_id: Any, username: str, session_id: Opti
 
     cancelled_any = False
 
-    with qr_lock:
-        if session_id and session_id in qr_sessions and qr_sessions[session_id].get("user_id") == tele_id:
-            qr_sessions.pop(session_id, None)
+    s0 = qr_store.get(session_id) if session_id else None
+    if s0 and _qr_user_key(s0.get("user_id")) == _qr_user_key(tele_id):
+        targets = [session_id]
+    else:
+        targets = [sid for sid, _ in qr_store.for_user(tele_id)]
+
+    for sid in targets:
+        # Session đã thu tiền thì không hủy (còn phải gửi cookie)
+        if qr_store.transition(sid, "cancelled"):
+            qr_store.delete(sid)
             cancelled_any = True
-        else:
-            user_sessions = [sid for sid, sess in qr_sessions.items() if sess.get("user_id") == tele_id]
-            if not user_sessions:
-                cancelled_any = False
-            else:
-                for sid in user_sessions:
-                    qr_sessions.pop(sid, None)
-                cancelled_any = True
 
     if not cancelled_any:
         tg_send(chat_id, "❌ <b>Không có QR nào đang chờ</b>", main_keyboard())
@@ -2706,24 +5397,6 @@ def handle_cancel_qr(chat_id: Any, tele_id: Any, username: str, session_id: Opti
 # =========================================================
 # WEBHOOK HANDLER
 # =========================================================
-def _prune_spam_cache_for_user(tid: str, keep_minutes: int = 3) -> None:
-    """Giữ lại vài phút gần nhất để tránh spam_cache phình"""
-    # minute_key format: YYYY-mm-dd HH:MM
-    try:
-        now_dt = now().replace(second=0, microsecond=0)
-        allowed = set()
-        for i in range(keep_minutes):
-            allowed.add((now_dt - timedelta(minutes=i)).strftime("%Y-%m-%d %H:%M"))
-
-        with spam_lock:
-            mp = spam_cache.get(tid, {})
-            for k in list(mp.keys()):
-                if k not in allowed:
-                    mp.pop(k, None)
-            spam_cache[tid] = mp
-    except Exception:
-        pass
-
 def _handle_message(chat_id: Any, tele_id: Any, username: str, text: str, data: Dict[str, Any]) -> None:
     if text == "/start":
         tg_send(
@@ -2747,12 +5420,23 @@ def _handle_message(chat_id: Any, tele_id: Any, username: str, text: str, data:
         )
         return
 
+    if text == "/thongbao_tiep":
+        handle_thongbao_resume(chat_id, tele_id)
+        return
+
     if text.startswith("/thongbao"):
         msg_obj = data.get("message", {})
         message_id = msg_obj.get("message_id", 0)
         handle_thongbao(chat_id, tele_id, username, text, message_id)
         return
 
+    if text == "/cookiehealth":
+        if tele_id not in ADMIN_IDS:
+            tg_send(chat_id, "❌ <b>KHÔNG CÓ QUYỀN</b>\n\nChỉ admin mới được sử dụng lệnh này.")
+            return
+        tg_send(chat_id, format_cookie_health())
+        return
+
     if text == "🔑 Get Cookie QR":
         handle_get_cookie_qr(chat_id, tele_id, username)
         return
@@ -2922,24 +5606,9 @@ def _handle_message(chat_id: Any, tele_id: Any, username: str, text: str, data:
             
             # Check spam
             balance = get_balance(user)
-            minute_key = now().strftime("%Y-%m-%d %H:%M")
-            tid = safe_text(tele_id)
-
-            _prune_spam_cache_for_user(tid, keep_minutes=3)
-
-            with spam_lock:
-                spam_cache.setdefault(tid, {})
-                spam_cache[tid][minute_key] = spam_cache[tid].get(minute_key, 0) + len(phones)
-                count_min = spam_cache[tid][minute_key]
-
-            if count_min > SPAM_LIMIT_PER_MIN:
-                strike, band_until = inc_strike_and_band(row_idx, tele_id, username, count_min)
-                tg_send(
-                    chat_id,
-                    "🚫 <b>SPAM PHÁT HIỆN</b>\n\n"
-                    f"⚠️ Strike: <b>{strike}</b>\n"
-                    f"⏱️ Band tới: <b>{band_until.strftime('%H:%M %d/%m')}</b>"
-                )
+            refusal = _spam_check(tele_id, username, row_idx, "phone", len(phones))
+            if refusal:
+                tg_send(chat_id, refusal)
                 return
             
             # Gửi thông báo đang check
@@ -3040,54 +5709,39 @@ def _handle_message(chat_id: Any, tele_id: Any, username: str, text: str, data:
 
     balance = get_balance(user)
 
-    for val in values:
-        minute_key = now().strftime("%Y-%m-%d %H:%M")
-        tid = safe_text(tele_id)
-
-        _prune_spam_cache_for_user(tid, keep_minutes=3)
-
-        with spam_lock:
-            spam_cache.setdefault(tid, {})
-            spam_cache[tid][minute_key] = spam_cache[tid].get(minute_key, 0) + 1
-            count_min = spam_cache[tid][minute_key]
+    # ✅ Nhiều dòng → check song song, trả kết quả theo thứ tự nhập
+    if len(values) > 1 and BATCH_CHECK_PER_USER > 1:
+        _handle_batch_check(chat_id, tele_id, username, row_idx, balance, values)
+        return
 
-        if count_min > SPAM_LIMIT_PER_MIN:
-            strike, band_until = inc_strike_and_band(row_idx, tele_id, username, count_min)
-            tg_send(
-                chat_id,
-                "🚫 <b>SPAM PHÁT HIỆN</b>\n\n"
-                f"⚠️ Strike: <b>{strike}</b>\n"
-                f"⏱️ Band tới: <b>{band_until.strftime('%H:%M %d/%m')}</b>"
-            )
+    for val in values:
+        refusal = _admit_check(tele_id, username, row_idx, balance, _check_action(val))
+        if refusal:
+            tg_send(chat_id, refusal)
             return
 
-        # FREE LOGIC
-        if balance <= 10000:
-            used = count_today_request(tele_id)
-            if used >= FREE_LIMIT_PER_DAY:
-                tg_send(
-                    chat_id,
-                    "⚠️ <b>HẾT LƯỢT MIỄN PHÍ HÔM NAY</b>\n\n"
-                    f"📊 Đã dùng: {used}/{FREE_LIMIT_PER_DAY} lượt\n"
-                    f"💰 Số dư hiện tại: {balance:,}đ\n\n"
-                    f"💡 <b>Để dùng không giới hạn:</b>\n"
-                    f"👉 Nạp thêm để số dư > 10,000đ tại @nganmiu_bot"
-                )
-                return
-
         # DO CHECK
         if is_cookie(val):
-            result, err = check_shopee_orders(val)
+            # ✅ Stream: đơn nào về trước hiện trước, cuối cùng sửa thành kết quả đầy đủ
+            stream = OrderMessageStream(chat_id) if STREAM_ORDERS else None
+            result, err = check_shopee_orders(val, on_block=stream.add if stream else None, owner=tele_id)
 
             if not result:
                 if err == "cookie_expired":
                     tg_send(chat_id, "🔒 <b>COOKIE KHÔNG HỢP LỆ</b>\n\n❌ Cookie đã <b>hết hạn</b> hoặc <b>bị Shopee khóa</b>.")
                     log_check(tele_id, username, val, balance, "cookie_expired")
-                else:
+                elif err == "no_orders":
                     tg_send(chat_id, "📭 <b>KHÔNG CÓ ĐƠN HÀNG</b>\n\nCookie hợp lệ nhưng hiện <b>không có đơn nào</b>.")
                     log_check(tele_id, username, val, balance, f"no_orders:{err or ''}")
+                else:
+                    # Timeout / Shopee lỗi → không kết luận cookie hỏng hay hết đơn
+                    tg_send(chat_id, f"⚠️ <b>LỖI CHECK</b> — {esc(err or 'unknown')}, thử lại sau")
+                    log_check(tele_id, username, val, balance, f"error:{err or ''}")
             else:
-                tg_send(chat_id, result)
+                if stream:
+                    stream.finish(result)
+                else:
+                    tg_send(chat_id, result)
                 log_check(tele_id, username, val, balance, "check_orders")
 
         elif is_spx(val):
@@ -3102,19 +5756,145 @@ def _handle_message(chat_id: Any, tele_id: Any, username: str, text: str, data:
 
         time.sleep(0.2)
 
-@app.route("/", methods=["POST", "GET"])
-def webhook_root():
-    if request.method == "GET":
-        return jsonify({"ok": True, "msg": "Bot STEP 1 Optimized + QR Login"}), 200
+def _spam_check(tele_id: Any, username: str, row_idx: int, action: str, cost: int = 1) -> Optional[str]:
+    """Tính cost lượt vào limiter (action + tổng "any"); vượt → strike/band, trả tin nhắn từ chối"""
+    allowed, _, count_est = rate_limiter.hit(normalize_tele_id(tele_id), [(action, cost), ("any", cost)])
+    if allowed:
+        return None
 
-    data = request.get_json(silent=True) or {}
+    strike, band_until = inc_strike_and_band(row_idx, tele_id, username, count_est)
+    return (
+        "🚫 <b>SPAM PHÁT HIỆN</b>\n\n"
+        f"⚠️ Strike: <b>{strike}</b>\n"
+        f"⏱️ Band tới: <b>{band_until.strftime('%H:%M %d/%m')}</b>"
+    )
+
+def _check_action(val: str) -> str:
+    if is_cookie(val):
+        return "cookie"
+    return "spx" if is_spx(val) else "ghn"
+
+def _admit_check(tele_id: Any, username: str, row_idx: int, balance: int, action: str,
+                 pending: int = 0, spam: bool = True) -> Optional[str]:
+    """
+    Tính 1 lượt check vào spam + lượt miễn phí
+    pending: số lượt đã nhận trong cùng lô nhưng chưa ghi log (chưa vào bộ đếm ngày)
+    spam=False: lô đã tính spam 1 lần ở ngoài → chỉ xét lượt miễn phí
+    Returns: None nếu được check, ngược lại là tin nhắn từ chối
+    """
+    if spam:
+        refusal = _spam_check(tele_id, username, row_idx, action)
+        if refusal:
+            return refusal
+
+    # FREE LOGIC
+    if balance <= 10000:
+        used = count_today_request(tele_id) + pending
+        if used >= FREE_LIMIT_PER_DAY:
+            return (
+                "⚠️ <b>HẾT LƯỢT MIỄN PHÍ HÔM NAY</b>\n\n"
+                f"📊 Đã dùng: {used}/{FREE_LIMIT_PER_DAY} lượt\n"
+                f"💰 Số dư hiện tại: {balance:,}đ\n\n"
+                f"💡 <b>Để dùng không giới hạn:</b>\n"
+                f"👉 Nạp thêm để số dư > 10,000đ tại @nganmiu_bot"
+            )
+    return None
+
+def _check_one_value(val: str, owner: Any = None) -> Tuple[str, str, str]:
+    """1 dòng (cookie / SPX / GHN) → (loại kết quả, HTML, note log) — chạy được song song"""
+    if is_cookie(val):
+        result, err = check_shopee_orders(val, owner=owner)
+        if result:
+            return ("no_orders" if result == NO_ORDERS_HTML else "live"), result, "check_orders"
+        if err == "cookie_expired":
+            return "expired", "🔒 <b>COOKIE KHÔNG HỢP LỆ</b> — hết hạn hoặc bị Shopee khóa", "cookie_expired"
+        if err == "no_orders":
+            return "no_orders", "📭 <b>KHÔNG CÓ ĐƠN HÀNG</b>", "no_orders:no_orders"
+        # Timeout / lỗi mạng / Shopee lỗi → không phải "không có đơn", đếm riêng
+        return "error", f"⚠️ <b>LỖI CHECK</b> — {esc(err or 'unknown')}, thử lại sau", f"error:{err or ''}"
+    if is_spx(val):
+        return "spx", check_spx(val), "check_spx"
+    return "ghn", check_ghn(val), "check_ghn"
+
+def _handle_batch_check(chat_id: Any, tele_id: Any, username: str, row_idx: int, balance: int, values: List[str]) -> None:
+    """
+    Check nhiều dòng cùng lúc (reseller dán 20–50 cookie)
+    - Cả lô tính spam 1 lượt (limit "batch"), tối đa BATCH_MAX_LINES dòng → dán lô hợp lệ không bị strike
+    - Lượt miễn phí vẫn tính từng dòng theo thứ tự như check lần lượt
+    - Kết quả gửi theo thứ tự nhập, dòng nào xong (và các dòng trước đã gửi) là gửi ngay
+    - Gộp nhiều kết quả vào 1 tin (≤ BATCH_MESSAGE_CHARS) cho đỡ tốn lượt gửi
+    """
+    refusal = _spam_check(tele_id, username, row_idx, "batch")
+    if refusal:
+        tg_send(chat_id, refusal)
+        return
+
+    skipped = max(0, len(values) - BATCH_MAX_LINES)
+    values = values[:BATCH_MAX_LINES]
+
+    admitted: List[str] = []
+    for val in values:
+        refusal = _admit_check(tele_id, username, row_idx, balance, _check_action(val),
+                               pending=len(admitted), spam=False)
+        if refusal:
+            break
+        admitted.append(val)
+
+    total = len(admitted)
+    if total:
+        tg_send(chat_id, f"🔄 <b>Đang check {total} dòng song song...</b>")
+
+    owner = safe_text(tele_id)
+    futures = [batch_check_pool.submit(owner, _check_one_value, val, owner) for val in admitted]
+    counts = {"live": 0, "expired": 0, "no_orders": 0, "error": 0}
+    buf: List[str] = []
+    sep = "\n\n━━━━━━━━━━━━━━━\n\n"
+
+    def flush():
+        if buf:
+            tg_send(chat_id, sep.join(buf))
+            buf.clear()
+
+    for i, (val, fut) in enumerate(zip(admitted, futures), 1):
+        if not fut.done():
+            flush()  # Gửi phần đã xong trước khi chờ dòng chậm
+        try:
+            kind, html_out, note = fut.result()
+        except Exception as e:
+            kind, html_out, note = "error", f"❌ Lỗi: {esc(str(e))}", "error"
+        if kind in counts and is_cookie(val):  # Tổng kết chỉ tính cookie
+            counts[kind] += 1
+        log_check(tele_id, username, val, balance, note)
+
+        block = f"<b>#{i}/{total}</b>\n{html_out}"
+        # Tính cả separator giữa các khối → tin gộp không vượt giới hạn Telegram
+        if buf and sum(len(b) for b in buf) + len(sep) * len(buf) + len(block) > BATCH_MESSAGE_CHARS:
+            flush()
+        buf.append(block)
+    flush()
+
+    n_cookies = sum(1 for v in admitted if is_cookie(v))
+    if n_cookies:
+        tg_send(
+            chat_id,
+            f"📊 <b>TỔNG KẾT {n_cookies} COOKIE</b>\n"
+            f"✅ Live: <b>{counts['live']}</b> | 🔒 Hết hạn: <b>{counts['expired']}</b> | 📭 Không đơn: <b>{counts['no_orders']}</b>"
+            + (f" | ⚠️ Lỗi: <b>{counts['error']}</b>" if counts["error"] else ""),
+            main_keyboard()
+        )
+    if skipped:
+        tg_send(chat_id, f"⚠️ Mỗi lần tối đa <b>{BATCH_MAX_LINES}</b> dòng — bỏ qua <b>{skipped}</b> dòng cuối, gửi lại ở tin sau.")
+    if refusal:
+        tg_send(chat_id, refusal)
 
+def process_update(data: Dict[str, Any]) -> None:
+    """Xử lý 1 update Telegram (message hoặc callback_query)"""
     if "callback_query" in data:
         try:
             handle_callback_query(data)
         except Exception:
             pass
-        return "OK"
+        return
 
     msg = data.get("message") or {}
     chat_id = (msg.get("chat") or {}).get("id")
@@ -3123,7 +5903,7 @@ def webhook_root():
     text = (msg.get("text") or "").strip()
 
     if not chat_id or not tele_id:
-        return "OK"
+        return
 
     try:
         _handle_message(chat_id, tele_id, username, text, data)
@@ -3135,18 +5915,217 @@ def webhook_root():
         except Exception:
             pass
 
+# =========================================================
+# 🔥 FIX 5: UPDATE QUEUE (ack webhook ngay, worker xử lý nền)
+# =========================================================
+# Mỗi chat có 1 deque riêng; chat chỉ nằm trong ready queue khi không có
+# worker nào đang xử lý nó → update của cùng 1 chat luôn chạy tuần tự, đúng thứ tự
+update_chats: Dict[str, deque] = {}
+update_active: set = set()
+update_ready: Queue = Queue()
+update_lock = threading.Lock()
+update_stats = {
+    "depth": 0,
+    "enqueued": 0,
+    "rejected": 0,
+    "processed": 0,
+    "wait_avg_ms": 0.0,
+    "wait_max_ms": 0.0,
+}
+_update_workers_pid = None
+
+def _update_chat_key(data: Dict[str, Any]) -> str:
+    cq = data.get("callback_query")
+    if cq:
+        chat = ((cq.get("message") or {}).get("chat") or {})
+        return safe_text(chat.get("id") or (cq.get("from") or {}).get("id") or "_")
+    msg = data.get("message") or {}
+    return safe_text((msg.get("chat") or {}).get("id") or "_")
+
+def enqueue_update(data: Dict[str, Any]) -> bool:
+    """Đẩy update vào hàng đợi. False nếu hàng đợi đầy"""
+    _ensure_update_workers()
+    key = _update_chat_key(data)
+    with update_lock:
+        if update_stats["depth"] >= UPDATE_QUEUE_MAX:
+            update_stats["rejected"] += 1
+            return False
+
+        update_chats.setdefault(key, deque()).append((time.time(), data))
+        update_stats["depth"] += 1
+        update_stats["enqueued"] += 1
+
+        if key not in update_active:
+            update_active.add(key)
+            update_ready.put(key)
+    return True
+
+def update_worker():
+    """Worker lấy chat sẵn sàng → xử lý 1 update → trả chat lại nếu còn update"""
+    while True:
+        key = update_ready.get()
+        with update_lock:
+            enqueued_at, data = update_chats[key].popleft()
+            update_stats["depth"] -= 1
+            wait_ms = (time.time() - enqueued_at) * 1000
+            update_stats["wait_avg_ms"] = 0.9 * update_stats["wait_avg_ms"] + 0.1 * wait_ms
+            update_stats["wait_max_ms"] = max(update_stats["wait_max_ms"], wait_ms)
+
+        try:
+            process_update(data)
+        except Exception:
+            traceback.print_exc()
+
+        with update_lock:
+            update_stats["processed"] += 1
+            if update_chats.get(key):
+                update_ready.put(key)
+            else:
+                update_chats.pop(key, None)
+                update_active.discard(key)
+
+def _ensure_update_workers() -> None:
+    """Start worker 1 lần / process (an toàn cả với WSGI server fork worker)"""
+    global _update_workers_pid
+    if _update_workers_pid == os.getpid():
+        return
+    with update_lock:
+        if _update_workers_pid == os.getpid():
+            return
+        for i in range(UPDATE_WORKERS):
+            threading.Thread(target=update_worker, name=f"update-{i}", daemon=True).start()
+        _update_workers_pid = os.getpid()
+    print(f"[UPDATE] Started {UPDATE_WORKERS} update workers (pid={os.getpid()})")
+
+def runtime_stats() -> Dict[str, Any]:
+    """Số liệu runtime (GET /stats)"""
+    with update_lock:
+        updates = dict(update_stats)
+        updates["chats_pending"] = len(update_chats)
+    with tg_cond:
+        telegram = dict(tg_stats)
+        telegram["chats_pending"] = len(tg_outbox)
+    with broadcast_lock:
+        broadcast = dict(broadcast_job)
+    return {
+        "updates": updates,
+        "telegram": telegram,
+        "broadcast": broadcast,
+        "dedup_keys": len(dedup_store),
+        "order_cache": order_cache.snapshot(),
+        "shopee_fetch": shopee_fetch_pool.snapshot(),
+        "batch_check": batch_check_pool.snapshot(),
+        "logs": log_writer.snapshot(),
+        "startup": startup_report,
+        "store": {
+            "backend": store.name,
+            "mirror_outbox": store.outbox_size() if getattr(store, "mirror", None) is not None else 0,
+        },
+    }
+
+@app.route("/", methods=["POST", "GET"])
+def webhook_root():
+    if request.method == "GET":
+        return jsonify({"ok": True, "msg": "Bot STEP 1 Optimized + QR Login"}), 200
+
+    data = request.get_json(silent=True) or {}
+
+    # Telegram gửi lại update khi webhook chậm → bỏ qua update_id đã nhận
+    update_id = data.get("update_id")
+    if update_id is not None and not dedup_store.add_if_new(f"u:{update_id}"):
+        print(f"[DEDUP] Bỏ qua update trùng: {update_id}")
+        return "OK"
+
+    if not ASYNC_UPDATES:
+        process_update(data)
+        return "OK"
+
+    if not enqueue_update(data):
+        print(f"[UPDATE] Queue full ({UPDATE_QUEUE_MAX}) → 503")
+        if update_id is not None:
+            dedup_store.discard(f"u:{update_id}")  # để lần Telegram gửi lại được xử lý
+        return "BUSY", 503
+
     return "OK"
 
+@app.route("/stats", methods=["GET"])
+def stats_route():
+    # Số liệu nội bộ (broadcast, queue, store...) → chỉ cho người có STATS_TOKEN
+    if not STATS_TOKEN:
+        return jsonify({"ok": False, "error": "stats disabled (set STATS_TOKEN)"}), 404
+    given = request.headers.get("X-Stats-Token") or request.args.get("token") or ""
+    if not hmac.compare_digest(given.encode(), STATS_TOKEN.encode()):
+        return jsonify({"ok": False, "error": "unauthorized"}), 401
+    return jsonify(runtime_stats()), 200
+
 @app.route("/webhook", methods=["POST", "GET"])
 def webhook_alias():
     return webhook_root()
 
+# =========================================================
+# 🔥 STARTUP THREAD (mở Sheets + seed chạy nền → import xong là nhận webhook)
+# =========================================================
+def startup_worker():
+    """Khởi tạo phần chậm song song với request đầu tiên (handle Sheets dùng chung, tạo 1 lần)"""
+    t_all = time.perf_counter()
+    try:
+        warm_sheets()
+    except Exception as e:
+        print(f"[SHEETS] ⚠️ Khởi tạo lỗi (thử lại khi dùng tới): {e}")
+
+    if store.name == "sqlite" and store.is_empty():
+        t0 = time.perf_counter()
+        try:
+            # Lịch sử trước (users rỗng = chưa import xong → lần sau chạy lại cả 2)
+            checks, broadcasts = store.import_history(sheet_store, now().strftime("%Y-%m-%d"))
+            users, cookies = store.mirror_pull(sheet_store)
+            print(f"[STORE] Import từ Sheet: {users} users, {cookies} cookies, "
+                  f"{checks} log check hôm nay, {broadcasts} dòng BroadcastState")
+            invalidate_user_index()
+        except Exception as e:
+            print(f"[STORE] ⚠️ Import từ Sheet lỗi: {e}")
+        _boot_bg("sqlite import", t0)
+
+    t0 = time.perf_counter()
+    try:
+        seed_daily_counter()
+    except Exception as e:
+        print(f"[LOG] Seed daily counter lỗi: {e}")
+    finally:
+        daily_seeded.set()
+    _boot_bg("seed daily counter", t0)
+    _boot_bg("total", t_all)
+    print("[BOOT] Nền: " + ", ".join(f"{k} {v:.0f}ms" for k, v in startup_report["background"].items()))
+
+_boot_mark("module body")
+startup_thread = threading.Thread(target=startup_worker, daemon=True)
+startup_thread.start()
+
 # =========================================================
 # 🔥 START LOG WORKER THREAD
 # =========================================================
 log_thread = threading.Thread(target=log_worker, daemon=True)
 log_thread.start()
 
+# =========================================================
+# 🔥 USER INDEX REFRESH THREAD
+# =========================================================
+user_index_thread = threading.Thread(target=user_index_worker, daemon=True)
+user_index_thread.start()
+
+# =========================================================
+# 🔥 NOTE WRITE-BEHIND THREAD
+# =========================================================
+note_thread = threading.Thread(target=note_flush_worker, daemon=True)
+note_thread.start()
+
+# =========================================================
+# 🔥 STORE MIRROR THREAD (SQLite ↔ Sheet)
+# =========================================================
+if store.name == "sqlite":
+    store_mirror_thread = threading.Thread(target=store_mirror_worker, daemon=True)
+    store_mirror_thread.start()
+
 # =========================================================
 # 🔥 CLEANUP QR SESSIONS THREAD
 # =========================================================
@@ -3161,6 +6140,18 @@ def cleanup_qr_worker():
 cleanup_thread = threading.Thread(target=cleanup_qr_worker, daemon=True)
 cleanup_thread.start()
 
+# ✅ Store bền (sqlite): session dở dang từ lần chạy trước → watcher chạy tiếp
+try:
+    cleanup_qr_sessions()
+    resume_qr_watchers()
+except Exception as e:
+    print(f"[QR] Resume watchers lỗi: {e}")
+
+_boot_mark("threads")
+startup_report["import_ms"] = round((time.perf_counter() - _BOOT_T0) * 1000, 1)
+print(f"[BOOT] Import {startup_report['import_ms']:.0f}ms: "
+      + ", ".join(f"{k} {v:.0f}ms" for k, v in startup_report["phases"].items()))
+
 # =========================================================
 # RUN
 # =========================================================
@@ -3172,6 +6163,7 @@ if __name__ == "__main__":
     print(f"🔑 Bot Token: {BOT_TOKEN[:20]}...")
     print(f"🔗 QR API: {QR_API_BASE}")
     print("✅ Log worker thread started")
+    print("✅ User index thread started")
     print("✅ QR cleanup thread started")
     print("=" * 50)
 
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+NẠP 1 PHẦN bot.py cho bench / stub (dùng chung, không import cả module)
+
+import bot.py cần TELEGRAM_TOKEN + Google Sheets và bật thread nền (log, outbox, QR...)
+→ chỉ exec các node top-level cần dùng vào namespace riêng
+
+    from bot_loader import load_bot
+    ns = load_bot({"RateLimiter"}, {"time": time, ...})
+"""
+
+import ast
+import os
+from typing import Any, Dict, Iterable, Optional
+
+BOT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+
+
+def node_names(node) -> set:
+    """Tên mà 1 node top-level định nghĩa (def / class / gán biến)"""
+    if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+        return {node.name}
+    if isinstance(node, ast.Assign):
+        return {t.id for t in node.targets if isinstance(t, ast.Name)}
+    if isinstance(node, ast.AnnAssign) and isinstance(node.target, ast.Name):
+        return {node.target.id}
+    return set()
+
+
+def _is_code(node) -> bool:
+    """Import + hàm / class không decorator (route Flask của bot thì bỏ)"""
+    if isinstance(node, ast.Try):
+        return all(isinstance(n, (ast.Import, ast.ImportFrom)) for n in node.body)
+    if isinstance(node, (ast.Import, ast.ImportFrom)):
+        return True
+    if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+        return not node.decorator_list
+    return False
+
+
+def load_bot(
+    names: Iterable[str],
+    ns: Optional[Dict[str, Any]] = None,
+    with_code: bool = False,
+    required: Optional[Iterable[str]] = None,
+) -> Dict[str, Any]:
+    """
+    exec các node của bot.py định nghĩa 1 trong names vào ns (theo thứ tự trong file)
+    - with_code: exec thêm mọi import / hàm / class (engine gọi qua lại nhiều helper);
+      node lỗi (gspread, default arg cần config khác...) bỏ qua
+    - required: tên bắt buộc phải có sau khi nạp (mặc định = names) → thiếu thì thoát
+    """
+    names = set(names)
+    ns = {} if ns is None else ns
+    with open(BOT_FILE, "r", encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+
+    for node in tree.body:
+        if not (node_names(node) & names or (with_code and _is_code(node))):
+            continue
+        code = compile(ast.Module([node], []), BOT_FILE, "exec")
+        if not with_code:
+            exec(code, ns)
+            continue
+        try:
+            exec(code, ns)
+        except Exception:
+            pass
+
+    missing = set(names if required is None else required) - ns.keys()
+    if missing:
+        raise SystemExit(f"[BENCH] bot.py thiếu: {', '.join(sorted(missing))}")
+    return ns
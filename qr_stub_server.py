@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+QR API STUB — giả lập QR_API_BASE để test / benchmark offline
+
+Chạy stub:
+    python qr_stub_server.py --port 8787 --latency 0.08 --scan-after 20
+    → QR_API_BASE=http://127.0.0.1:8787 python bot.py
+
+Benchmark 1 vòng poll N session bằng fetch_qr_statuses của bot.py (tuần tự cũ / song song / batch):
+    python qr_stub_server.py --bench --sessions 200 --latency 0.05
+"""
+
+import os
+import sys
+import time
+import logging
+import uuid
+import random
+import argparse
+import threading
+from typing import Any, Dict
+
+import requests
+from flask import Flask, request, jsonify
+
+from bot_loader import load_bot
+
+
+# ==================================================
+# STUB STATE
+# ==================================================
+app = Flask(__name__)
+
+CONFIG = {
+    "latency": 0.05,      # giây trễ giả lập / request
+    "scan_after": 20.0,   # session tự "được quét" sau N giây
+}
+
+sessions = {}  # {session_id: {"created": ts}}
+sessions_lock = threading.Lock()
+hits = {"create": 0, "status": 0, "batch": 0, "login": 0}
+
+# PNG 1x1 trong suốt (đủ để bot gửi sendPhoto)
+PIXEL_PNG = (
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mNkYAAAAAYAAjCB0C8AAAAASUVORK5CYII="
+)
+
+
+def _status_of(session_id: str) -> dict:
+    with sessions_lock:
+        sess = sessions.get(session_id)
+    if not sess:
+        return {"success": True, "status": "NOT_FOUND", "has_token": False}
+
+    if time.time() - sess["created"] >= CONFIG["scan_after"]:
+        return {
+            "success": True,
+            "status": "SCANNED",
+            "has_token": True,
+            "cookie_st": f"SPC_ST=.stub{session_id[:8]}",
+            "cookie_f": f"SPC_F=stub{session_id[:8]}",
+        }
+    return {"success": True, "status": "WAITING", "has_token": False}
+
+
+def _delay():
+    if CONFIG["latency"] > 0:
+        time.sleep(CONFIG["latency"])
+
+
+@app.route("/api/qr/create", methods=["POST"])
+def api_create():
+    _delay()
+    session_id = uuid.uuid4().hex
+    with sessions_lock:
+        sessions[session_id] = {"created": time.time()}
+        hits["create"] += 1
+    return jsonify({
+        "success": True,
+        "session_id": session_id,
+        "qr_image": "data:image/png;base64," + PIXEL_PNG,
+    })
+
+
+@app.route("/api/qr/status/batch", methods=["POST"])
+def api_status_batch():
+    _delay()
+    ids = (request.get_json(silent=True) or {}).get("session_ids") or []
+    with sessions_lock:
+        hits["batch"] += 1
+    return jsonify({"success": True, "results": {sid: _status_of(sid) for sid in ids}})
+
+
+@app.route("/api/qr/status/<session_id>", methods=["GET"])
+def api_status(session_id):
+    _delay()
+    with sessions_lock:
+        hits["status"] += 1
+    return jsonify(_status_of(session_id))
+
+
+@app.route("/api/qr/login/<session_id>", methods=["POST"])
+def api_login(session_id):
+    _delay()
+    with sessions_lock:
+        hits["login"] += 1
+    st = _status_of(session_id)
+    if st.get("status") != "SCANNED":
+        return jsonify({"success": False, "error": "QR chưa được quét"})
+    return jsonify({"success": True, "cookie": st["cookie_st"], "cookie_f": st["cookie_f"]})
+
+
+@app.route("/stats", methods=["GET"])
+def api_stats():
+    with sessions_lock:
+        return jsonify({"sessions": len(sessions), "hits": dict(hits)})
+
+
+# ==================================================
+# BENCHMARK
+# ==================================================
+def run_server(port: int) -> None:
+    app.run(host="127.0.0.1", port=port, debug=False, threaded=True, use_reloader=False)
+
+
+# config / state phần poll QR của bot.py (hàm + import nạp kèm qua with_code)
+BOT_STATE = {
+    "HTTP_POOL_SIZE", "HTTP_CONNECT_RETRY", "HTTP_DEFAULT_TIMEOUT", "HTTP_HOST_TIMEOUTS",
+    "SHOPEE_MAX_INFLIGHT", "HTTP_HOST_LIMITS", "_http_sessions", "_http_lock", "_http_host_sems",
+    "QR_API_BASE", "QR_STATUS_CONCURRENCY", "QR_STATUS_BATCH",
+    "qr_status_sem", "qr_status_executor", "qr_batch_supported",
+}
+
+
+def load_bot_qr(base: str, concurrency: int) -> Dict[str, Any]:
+    # bot đọc config từ env lúc nạp → set trước khi exec (như chạy bot với QR_API_BASE=stub)
+    os.environ["QR_API_BASE"] = base
+    os.environ["QR_STATUS_CONCURRENCY"] = str(concurrency)
+    os.environ["QR_STATUS_BATCH"] = "auto"
+    return load_bot(
+        BOT_STATE, {"__name__": "bot_qr"}, with_code=True,
+        required={"fetch_qr_statuses", "_fetch_qr_status_batch_api", "_fetch_qr_status_raw", "qr_status_executor"},
+    )
+
+
+def bench(port: int, n_sessions: int, concurrency: int, rounds: int) -> None:
+    base = f"http://127.0.0.1:{port}"
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)  # tắt log từng request
+    threading.Thread(target=run_server, args=(port,), daemon=True).start()
+
+    # Đợi server lên
+    for _ in range(50):
+        try:
+            requests.get(f"{base}/stats", timeout=0.5)
+            break
+        except Exception:
+            time.sleep(0.1)
+
+    bot = load_bot_qr(base, concurrency)
+    ids = [bot["http_post"](f"{base}/api/qr/create", timeout=5).json()["session_id"] for _ in range(n_sessions)]
+    random.shuffle(ids)
+
+    def mode_sequential():
+        # Cách cũ: requests.get module-level từng session → mỗi lần 1 kết nối mới
+        for sid in ids:
+            requests.get(f"{base}/api/qr/status/{sid}", timeout=5).json()
+
+    def mode_parallel():
+        # fetch_qr_statuses khi API không có batch: _fetch_qr_status_raw qua qr_status_executor
+        bot["qr_batch_supported"] = False
+        try:
+            return bot["fetch_qr_statuses"](ids)
+        finally:
+            bot["qr_batch_supported"] = True
+
+    def mode_batch():
+        return bot["fetch_qr_statuses"](ids)
+
+    # 2 đường của bot phải trả cùng kết quả
+    by_batch = bot["_fetch_qr_status_batch_api"](ids)
+    if by_batch is None or by_batch != mode_parallel():
+        raise SystemExit("[BENCH] ❌ batch và song song trả kết quả khác nhau")
+    print("[BENCH] ✅ _fetch_qr_status_batch_api == _fetch_qr_status_raw song song")
+
+    print(f"[BENCH] {n_sessions} sessions, latency {CONFIG['latency'] * 1000:.0f}ms, QR_STATUS_CONCURRENCY={concurrency}")
+    for name, fn in (
+        ("sequential (1 GET/session, no keep-alive)", mode_sequential),
+        (f"fetch_qr_statuses song song x{concurrency}", mode_parallel),
+        ("fetch_qr_statuses batch (1 POST)", mode_batch),
+    ):
+        samples = []
+        for _ in range(rounds):
+            t0 = time.perf_counter()
+            fn()
+            samples.append(time.perf_counter() - t0)
+        samples.sort()
+        print(f"  {name:<45} p50={samples[len(samples) // 2] * 1000:8.1f}ms  max={samples[-1] * 1000:8.1f}ms")
+
+    bot["qr_status_executor"].shutdown(wait=False)
+    print(f"[BENCH] hits: {hits}")
+
+
+# ==================================================
+# RUN
+# ==================================================
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="QR API stub server")
+    ap.add_argument("--port", type=int, default=8787)
+    ap.add_argument("--latency", type=float, default=CONFIG["latency"])
+    ap.add_argument("--scan-after", type=float, default=CONFIG["scan_after"])
+    ap.add_argument("--bench", action="store_true", help="chạy benchmark rồi thoát")
+    ap.add_argument("--sessions", type=int, default=200)
+    ap.add_argument("--concurrency", type=int, default=8)
+    ap.add_argument("--rounds", type=int, default=5)
+    args = ap.parse_args()
+
+    CONFIG["latency"] = args.latency
+    CONFIG["scan_after"] = args.scan_after
+
+    if args.bench:
+        bench(args.port, args.sessions, args.concurrency, args.rounds)
+        sys.exit(0)
+
+    print(f"[STUB] QR API stub on http://127.0.0.1:{args.port} (latency {args.latency}s, scan after {args.scan_after}s)")
+    run_server(args.port)
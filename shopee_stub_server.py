@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+SHOPEE API STUB — giả lập list đơn / chi tiết đơn để test / benchmark offline
+
+Chạy stub:
+    python shopee_stub_server.py --port 8788 --latency 0.08
+    → SHOPEE_API_BASE=http://127.0.0.1:8788/api/v4 python bot.py
+
+Benchmark engine lấy đơn của bot (sequential / thread pool / asyncio):
+    python shopee_stub_server.py --bench --users 20 --checks 10 --latency 0.05
+    (engine asyncio cần: pip install aiohttp)
+
+Cookie chứa "expired" → Shopee trả 403 (cookie_expired), chứa "empty" → không có đơn
+"""
+
+import sys
+import time
+import random
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+import requests
+from flask import Flask, request, jsonify
+
+from bot_loader import load_bot
+
+
+# ==================================================
+# STUB STATE
+# ==================================================
+app = Flask(__name__)
+
+CONFIG = {
+    "latency": 0.05,     # giây trễ cơ bản / request
+    "tail_prob": 0.05,   # xác suất 1 request bị chậm (đuôi p99)
+    "tail": 0.4,         # giây trễ thêm khi bị chậm
+    "orders": 5,         # số đơn / cookie
+}
+
+hits = {"list": 0, "detail": 0}
+hits_lock = threading.Lock()
+
+
+def _delay():
+    d = CONFIG["latency"]
+    if random.random() < CONFIG["tail_prob"]:
+        d += CONFIG["tail"]
+    if d > 0:
+        time.sleep(d)
+
+
+def _order_ids(cookie: str) -> List[int]:
+    base = sum(ord(c) for c in cookie) * 1000
+    return [base + i for i in range(CONFIG["orders"])]
+
+
+def _detail(order_id: int) -> Dict[str, Any]:
+    """Cấu trúc gần giống get_order_detail thật (field cần nằm sâu nhiều tầng)"""
+    return {
+        "error": 0,
+        "data": {
+            "order_id": order_id,
+            "status": {"header_text": "Đang giao", "list_view_text": "Đang giao"},
+            "info_card": {
+                "order_id": order_id,
+                "parcel_cards": [{
+                    "product_info": {"item_groups": [{"items": [
+                        {"item_id": order_id * 10 + k, "name": f"Sản phẩm {order_id}-{k}", "amount": 1}
+                        for k in range(2)
+                    ]}]},
+                    "shipping_info": {
+                        "tracking_number": f"SPXVN{order_id:012d}",
+                        "tracking_info": {"description": "Đơn hàng đang được giao"},
+                        "driver_name": "Tài xế",
+                        "driver_phone": "0900000000",
+                    },
+                }],
+            },
+            "payment_info": {"total_cod": 129000},
+            "address": {
+                "recipient_address": {"name": "Người nhận", "phone": "84*****00", "full_address": "Hà Nội"},
+            },
+        },
+    }
+
+
+@app.route("/api/v4/order/get_all_order_and_checkout_list", methods=["GET"])
+def api_list():
+    _delay()
+    with hits_lock:
+        hits["list"] += 1
+    cookie = request.headers.get("Cookie", "")
+    if "expired" in cookie:
+        return jsonify({"error": 403, "msg": "forbidden"})
+    ids = [] if "empty" in cookie else _order_ids(cookie)[:int(request.args.get("limit", 5))]
+    resp = jsonify({
+        "error": 0,
+        "msg": "",
+        "data": {"order_data": {"details_list": [{"info_card": {"order_id": oid}} for oid in ids]}},
+    })
+    # Shopee thật gia hạn SPC_ST qua Set-Cookie → client không được đem cookie này sang request của user khác
+    resp.set_cookie("SPC_ST", f".refreshed{len(cookie)}", path="/")
+    return resp
+
+
+@app.route("/api/v4/order/get_order_detail", methods=["GET"])
+def api_detail():
+    _delay()
+    with hits_lock:
+        hits["detail"] += 1
+    return jsonify(_detail(int(request.args.get("order_id", 0))))
+
+
+@app.route("/stats", methods=["GET"])
+def api_stats():
+    with hits_lock:
+        return jsonify({"hits": dict(hits)})
+
+
+# ==================================================
+# BOT ENGINES
+# ==================================================
+BOT_STATE = {
+    "HTTP_POOL_SIZE", "HTTP_CONNECT_RETRY", "HTTP_DEFAULT_TIMEOUT", "HTTP_HOST_TIMEOUTS",
+    "MAX_WORKERS", "CHECK_LIMIT", "USE_PARALLEL", "USE_ASYNC_FETCH",
+    "BATCH_CHECK_PER_USER", "SHOPEE_FETCH_WORKERS", "SHOPEE_FETCH_PER_USER", "SHOPEE_QUEUE_TIMEOUT",
+    "SHOPEE_MAX_INFLIGHT", "HTTP_HOST_LIMITS",
+    "TIMEOUT_LIST", "TIMEOUT_DETAIL", "TIMEOUT_RETRY",
+    "_http_sessions", "_http_lock", "_http_host_sems",
+    "UA", "SHOPEE_BASE", "shopee_fetch_pool",
+    "_async_loop", "_async_loop_pid", "_async_loop_lock", "_async_http", "_async_host_sems", "_async_owner_sems",
+}
+
+
+def load_bot_engines(shopee_base: str) -> Dict[str, Any]:
+    ns = load_bot(
+        BOT_STATE, {"__name__": "bot_engines"}, with_code=True,
+        required={"fetch_orders_and_details", "parse_order_list", "shopee_fetch_pool"},
+    )
+    ns["SHOPEE_BASE"] = shopee_base
+    return ns
+
+
+def _canon(result) -> Any:
+    """Kết quả engine → dạng so sánh được (detail về theo thứ tự hoàn thành)"""
+    details, error = result
+    if error:
+        return error
+    return sorted(details, key=lambda d: d["data"]["order_id"])
+
+
+# ==================================================
+# BENCHMARK
+# ==================================================
+def run_server(port: int) -> None:
+    app.run(host="127.0.0.1", port=port, debug=False, threaded=True, use_reloader=False)
+
+
+def bench(port: int, users: int, checks: int) -> None:
+    base = f"http://127.0.0.1:{port}"
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)  # tắt log từng request
+    threading.Thread(target=run_server, args=(port,), daemon=True).start()
+
+    for _ in range(50):
+        try:
+            requests.get(f"{base}/stats", timeout=0.5)
+            break
+        except Exception:
+            time.sleep(0.1)
+
+    bot = load_bot_engines(f"{base}/api/v4")
+    engines = [("sequential", {"USE_PARALLEL": False, "USE_ASYNC_FETCH": False}),
+               ("thread pool", {"USE_PARALLEL": True, "USE_ASYNC_FETCH": False})]
+    if bot.get("aiohttp") is not None:
+        engines.append(("asyncio (aiohttp)", {"USE_PARALLEL": True, "USE_ASYNC_FETCH": True}))
+    else:
+        print("[BENCH] ⚠️ Chưa cài aiohttp → bỏ qua engine asyncio")
+
+    # Cùng input → cùng kết quả parse ở mọi engine
+    samples_in = ["SPC_ST=.bench-a", "SPC_ST=.bench-expired", "SPC_ST=.bench-empty"]
+    reference = None
+    for name, flags in engines:
+        bot.update(flags)
+        got = [_canon(bot["fetch_orders_and_details"](c, CONFIG["orders"])) for c in samples_in]
+        if reference is None:
+            reference = got
+        assert got == reference, f"{name}: kết quả khác engine đầu"
+
+    # Set-Cookie của user A không được lọt sang request của user B.
+    # Cookie jar mặc định bỏ qua host dạng IP → phải gọi qua tên miền (localhost) mới bắt được lỗi này
+    by_name = f"http://localhost:{port}/api/v4"
+    for name, flags in engines:
+        bot.update(flags)
+        bot["SHOPEE_BASE"] = by_name
+        for c in ("SPC_ST=.iso-a", "SPC_ST=.iso-bb", "SPC_ST=.iso-a"):
+            details, error = bot["fetch_orders_and_details"](c, CONFIG["orders"])
+            got = sorted(d["data"]["order_id"] for d in details)
+            assert not error and got == _order_ids(c), f"{name}: cookie của user khác lọt vào request ({c})"
+    bot["SHOPEE_BASE"] = f"{base}/api/v4"
+    print("[BENCH] ✅ Cookie isolation (qua localhost): OK")
+
+    print(
+        f"[BENCH] {users} users x {checks} checks, {CONFIG['orders']} orders/cookie, "
+        f"latency {CONFIG['latency'] * 1000:.0f}ms (+{CONFIG['tail'] * 1000:.0f}ms @ {CONFIG['tail_prob']:.0%})"
+    )
+    for name, flags in engines:
+        bot.update(flags)
+        lat: List[float] = []
+        lat_lock = threading.Lock()
+
+        def one_user(u: int) -> None:
+            for i in range(checks):
+                t0 = time.perf_counter()
+                details, error = bot["fetch_orders_and_details"](f"SPC_ST=.u{u}-{i}", CONFIG["orders"])
+                assert not error and len(details) == CONFIG["orders"], error
+                with lat_lock:
+                    lat.append(time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=users) as ex:
+            list(ex.map(one_user, range(users)))
+        wall = time.perf_counter() - t0
+
+        lat.sort()
+        p50 = lat[len(lat) // 2] * 1000
+        p99 = lat[min(len(lat) - 1, int(len(lat) * 0.99))] * 1000
+        print(f"  {name:<20} p50={p50:8.1f}ms  p99={p99:8.1f}ms  total={wall:6.2f}s")
+
+    print(f"[BENCH] hits: {hits}")
+
+
+# ==================================================
+# RUN
+# ==================================================
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Shopee order API stub server")
+    ap.add_argument("--port", type=int, default=8788)
+    ap.add_argument("--latency", type=float, default=CONFIG["latency"])
+    ap.add_argument("--tail", type=float, default=CONFIG["tail"])
+    ap.add_argument("--tail-prob", type=float, default=CONFIG["tail_prob"])
+    ap.add_argument("--orders", type=int, default=CONFIG["orders"])
+    ap.add_argument("--bench", action="store_true", help="chạy benchmark rồi thoát")
+    ap.add_argument("--users", type=int, default=20)
+    ap.add_argument("--checks", type=int, default=10)
+    args = ap.parse_args()
+
+    CONFIG.update(latency=args.latency, tail=args.tail, tail_prob=args.tail_prob, orders=args.orders)
+
+    if args.bench:
+        bench(args.port, args.users, args.checks)
+        sys.exit(0)
+
+    print(f"[STUB] Shopee API stub on http://127.0.0.1:{args.port}/api/v4 (latency {args.latency}s)")
+    run_server(args.port)